@@ -2,21 +2,25 @@ from __future__ import absolute_import, unicode_literals
 
 import os
 
-import django
 from celery import Celery
-from celery.schedules import crontab
+from celery.signals import beat_init
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "case_tracking.settings")
-django.setup()
+# System checks import the whole web stack (URLconf, admin, DRF) and already run
+# on deploy; set CELERY_SKIP_CHECKS to an empty value to run them in workers too
+os.environ.setdefault("CELERY_SKIP_CHECKS", "1")
 
+# Django is set up by the Celery Django fixup when the worker or beat starts, and
+# by manage.py / WSGI in the other processes, not by importing this module
 app = Celery("tasks")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
 
 
-app.conf.beat_schedule = {
-    "update-case-priority-every-15-minutes": {
-        "task": "core.tasks.update_case_priority",
-        "schedule": crontab(minute="*/30"),  # every 30 minutes
-    },
-}
+@beat_init.connect
+def verify_periodic_tasks(sender, **kwargs):
+    # The schedule lives in settings.CELERY_BEAT_SCHEDULE
+    from core.task_runtime import disable_unknown_periodic_tasks, verify_beat_schedule
+
+    registered = verify_beat_schedule(sender.app)
+    disable_unknown_periodic_tasks(registered)
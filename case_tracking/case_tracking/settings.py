@@ -9,13 +9,14 @@ https://docs.djangoproject.com/en/5.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
+
 import datetime
 import os
 from pathlib import Path
 
 import dj_database_url
 from celery.schedules import crontab
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -36,7 +37,9 @@ ALLOWED_HOSTS = [host.strip() for host in config("ALLOWED_HOSTS").split(",")]
 # Application definition
 
 INSTALLED_APPS = [
-    "django.contrib.admin",
+    # Admin modules are loaded with the URLconf (admin.autodiscover() in urls.py),
+    # so workers and management commands do not import them
+    "django.contrib.admin.apps.SimpleAdminConfig",
     "django.contrib.auth",
     "django.contrib.contenttypes",
     "django.contrib.sessions",
@@ -52,11 +55,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "core.middleware.ProfilingMiddleware",
+    "core.middleware.QueryCountMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "core.middleware.PrimaryStickinessMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "core.middleware.LabMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.locale.LocaleMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
@@ -69,8 +76,8 @@ WSGI_APPLICATION = "case_tracking.wsgi.application"
 
 
 AUTHENTICATION_BACKENDS = (
+    # Also covers ModelBackend (permissions), so a login hashes the password once
     "core.authentication.EmailBackend",
-    "django.contrib.auth.backends.ModelBackend",
     "guardian.backends.ObjectPermissionBackend",
 )
 
@@ -150,11 +157,71 @@ DATABASES = {
     "default": dj_database_url.config(default=config("DATABASE_URL"), conn_max_age=600)
 }
 
+# Read replicas: read-only pages may read from them (see core.routers)
+DATABASE_REPLICAS = []
+for index, url in enumerate(config("DATABASE_REPLICA_URLS", default="", cast=Csv())):
+    alias = f"replica_{index}"
+    DATABASES[alias] = {
+        **dj_database_url.parse(url, conn_max_age=600),
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+# Labs: cases, stages and their logs are scoped to a lab (see core.routers).
+# A lab listed in LAB_DATABASE_URLS ("code=url,...") has its own database.
+DEFAULT_LAB = config("DEFAULT_LAB", default="main")
+LAB_DATABASES = {}
+for entry in config("LAB_DATABASE_URLS", default="", cast=Csv()):
+    code, url = entry.split("=", 1)
+    alias = f"lab_{code}"
+    DATABASES[alias] = dj_database_url.parse(url, conn_max_age=600)
+    LAB_DATABASES[code] = alias
+
+DATABASE_ROUTERS = ["core.routers.LabRouter", "core.routers.PrimaryReplicaRouter"]
+# Covering indexes (INCLUDE) exist on PostgreSQL only, other databases build them
+# without the included columns
+SILENCED_SYSTEM_CHECKS = ["models.W040"]
+# Only scan stations with a token (core.authentication) may call the scan API
+SCAN_REQUIRE_STATION_TOKEN = config(
+    "SCAN_REQUIRE_STATION_TOKEN", default=False, cast=bool
+)
+# Queries slower than this are recorded with their EXPLAIN plan (core.query_log), 0 disables
+SLOW_QUERY_THRESHOLD_MS = config("SLOW_QUERY_THRESHOLD_MS", default=200, cast=float)
+# Seconds between EXPLAIN captures of the same query in one process
+SLOW_QUERY_EXPLAIN_INTERVAL = config(
+    "SLOW_QUERY_EXPLAIN_INTERVAL", default=300, cast=int
+)
+# X-Query-Count response header for load testing (core.middleware.QueryCountMiddleware)
+QUERY_COUNT_HEADER = config("QUERY_COUNT_HEADER", default=False, cast=bool)
+
+# Seconds a client reads from the primary after its own write
+DATABASE_REPLICA_STICKINESS = config("DATABASE_REPLICA_STICKINESS", default=5, cast=int)
+
+# Cache (reference data, board fragments); per-process memory if CACHE_URL is not set
+CACHE_URL = config("CACHE_URL", default="")
+if CACHE_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
 # Celery settings
 CELERY_TIMEZONE = "UTC"
 CELERY_TASK_TRACK_STARTED = True
 CELERY_BROKER_URL = config("CELERY_BROKER_URL")
 CELERY_TASK_TIME_LIMIT = 30 * 60  # 30 minutes
+# Redis used for the periodic task locks (see core.task_runtime)
+TASK_LOCK_URL = config("TASK_LOCK_URL", default="") or CELERY_BROKER_URL
+# Primary key span handled by one shard of a maintenance task
+TASK_SHARD_SIZE = config("TASK_SHARD_SIZE", default=5000, cast=int)
 
 # Celery Beat settings
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
@@ -164,17 +231,29 @@ CELERY_BEAT_SCHEDULE = {
         "schedule": 1800.0,  # 30 minutes
     },
     "delete-outdated-logs-every-day": {
-        "task": "cases.tasks.delete_outdated_case_stage_logs",
+        "task": "core.tasks.delete_outdated_case_stage_logs",
         "schedule": crontab(hour=0, minute=0),  # Every midnight
     },
     "archive-completed-cases-every-day": {
-        "task": "cases.tasks.archive_completed_cases",
+        "task": "core.tasks.archive_completed_cases",
         "schedule": 1800.0,  # 30 min
     },
     "backup-database-daily": {
-        "task": "cases.tasks.backup_database",
+        "task": "core.tasks.backup_database",
         "schedule": crontab(hour=2, minute=0),
     },
+    "backup-case-stage-logs-hourly": {
+        "task": "core.tasks.backup_case_stage_logs",
+        "schedule": crontab(minute=30),
+    },
+    "aggregate-employee-productivity-every-5-minutes": {
+        "task": "core.tasks.aggregate_employee_productivity",
+        "schedule": 300.0,  # 5 minutes
+    },
+    "verify-database-backup-daily": {
+        "task": "core.tasks.verify_database_backup",
+        "schedule": crontab(hour=4, minute=0),
+    },
 }
 
 CELERY_RESULT_BACKEND = config("CELERY_BROKER_URL")
@@ -210,6 +289,8 @@ LOGGING = {
 
 # Constance
 CONSTANCE_BACKEND = "constance.backends.database.DatabaseBackend"
+# Seconds a process keeps its snapshot of the values (see core.config_snapshot)
+CONSTANCE_SNAPSHOT_TTL = config("CONSTANCE_SNAPSHOT_TTL", default=30, cast=int)
 
 CONSTANCE_CONFIG = {
     "CASE_STAGE_LOG_EXPIRES_AFTER": (
@@ -228,17 +309,44 @@ CONSTANCE_CONFIG = {
         "Done",
         "The name of the last stage group (must match the stage group name in Stage)",
     ),
+    "PROFILING_SAMPLE_RATE": (
+        0.0,
+        "Fraction of requests to profile, from 0 (off) to 1",
+    ),
+    "PROFILING_TASK_SAMPLE_RATE": (
+        0.0,
+        "Fraction of Celery task runs to profile, from 0 (off) to 1",
+    ),
+    "WORK_QUEUE_LEASE": (
+        datetime.timedelta(minutes=15),
+        "How long a case taken from a stage work queue stays reserved for the employee",
+    ),
 }
+# Number of slowest profiles kept (core.profiling)
+PROFILING_BUFFER_SIZE = config("PROFILING_BUFFER_SIZE", default=50, cast=int)
+
 
+# Backups (core.backup) are written locally; BACKUP_OFFSITE also copies them
+# to the dbbackup storage (Dropbox)
+BACKUP_DIR = config("BACKUP_DIR", default=str(BASE_DIR / "backups"))
+# Threads compressing a backup, 0 means one per CPU core
+BACKUP_COMPRESSION_WORKERS = config("BACKUP_COMPRESSION_WORKERS", default=0, cast=int)
+BACKUP_OFFSITE = config("BACKUP_OFFSITE", default=False, cast=bool)
+# Scratch PostgreSQL database the restore check loads backups into
+BACKUP_VERIFY_DATABASE_URL = config("BACKUP_VERIFY_DATABASE_URL", default="")
 
 # dbbackup
-DBBACKUP_STORAGE = "storages.backends.dropbox.DropboxStorage"
-DBBACKUP_STORAGE_OPTIONS = {
-    "app_key": config("DROPBOX_APP_KEY"),
-    "app_secret": config("DROPBOX_APP_SECRET"),
-    "oauth2_access_token": config("DROPBOX_ACCESS_TOKEN"),
-    "root_path": "/backups/",
-}
+if BACKUP_OFFSITE:
+    DBBACKUP_STORAGE = "storages.backends.dropbox.DropboxStorage"
+    DBBACKUP_STORAGE_OPTIONS = {
+        "app_key": config("DROPBOX_APP_KEY"),
+        "app_secret": config("DROPBOX_APP_SECRET"),
+        "oauth2_access_token": config("DROPBOX_ACCESS_TOKEN"),
+        "root_path": "/backups/",
+    }
+else:
+    DBBACKUP_STORAGE = "django.core.files.storage.FileSystemStorage"
+    DBBACKUP_STORAGE_OPTIONS = {"location": BACKUP_DIR}
 DROPBOX_REDIRECT_URI = config(
     "DROPBOX_REDIRECT_URI", "http://localhost:8000/dropbox/callback/"
 )
@@ -0,0 +1,22 @@
+"""
+Settings for the test suite: the production settings plus the databases the
+tests need. manage.py uses them for the test command; other runners should set
+DJANGO_SETTINGS_MODULE=case_tracking.test_settings.
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASE_REPLICAS, DATABASES
+
+# Тесты всегда проверяют чтение с реплики: без DATABASE_REPLICA_URLS реплика -
+# зеркало основной тестовой базы
+if not DATABASE_REPLICAS:
+    DATABASES["replica_0"] = {**DATABASES["default"], "TEST": {"MIRROR": "default"}}
+    DATABASE_REPLICAS.append("replica_0")
+
+# Отдельная база лаборатории (core.tests.LabDatabaseTests); в LAB_DATABASES её
+# включает сам тест
+if "lab_x" not in DATABASES:
+    lab_x = {**DATABASES["default"], "TEST": {}}
+    if lab_x["ENGINE"] != "django.db.backends.sqlite3":
+        lab_x["TEST"]["NAME"] = f"test_{lab_x['NAME']}_lab_x"
+    DATABASES["lab_x"] = lab_x
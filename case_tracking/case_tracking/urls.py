@@ -20,6 +20,9 @@ from django.contrib import admin
 from django.contrib.auth.views import LogoutView
 from django.urls import path
 
+# INSTALLED_APPS uses SimpleAdminConfig: the admin modules are loaded here
+admin.autodiscover()
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("custom_admin/", custom_admin_site.urls),
@@ -40,10 +43,41 @@ urlpatterns = [
     path("employee/dashboard/", views.employee_dashboard, name="employee_dashboard"),
     path("archived_cases/", views.archived_case, name="archived_cases"),
     path("returned_cases/", views.returned_case, name="returned_cases"),
+    path("cases/<int:case_id>/timeline/", views.case_timeline, name="case_timeline"),
+    path("board/as-of/", views.board_as_of, name="board_as_of"),
     path(
         "api/cases/scan_barcodes/",
-        viewsets.CaseViewSet.as_view({"post": "scan_barcodes"}),
+        viewsets.CaseViewSet.as_view(
+            {"post": "scan_barcodes"}, **viewsets.CaseViewSet.scan_barcodes.kwargs
+        ),
         name="scan_barcodes",
     ),
+    path(
+        "api/cases/validate_barcode/",
+        viewsets.CaseViewSet.as_view(
+            {"get": "validate_barcode"},
+            **viewsets.CaseViewSet.validate_barcode.kwargs,
+        ),
+        name="validate_barcode",
+    ),
+    path(
+        "api/cases/next_case/",
+        viewsets.CaseViewSet.as_view(
+            {"post": "next_case"}, **viewsets.CaseViewSet.next_case.kwargs
+        ),
+        name="next_case",
+    ),
+    path(
+        "api/cases/release_case/",
+        viewsets.CaseViewSet.as_view(
+            {"post": "release_case"}, **viewsets.CaseViewSet.release_case.kwargs
+        ),
+        name="release_case",
+    ),
+    path(
+        "api/cases/<int:pk>/timeline/",
+        viewsets.CaseViewSet.as_view({"get": "timeline"}),
+        name="case_timeline_api",
+    ),
     path("scan-barcodes/", views.scan_barcodes_page, name="scan_barcodes_page"),
 ]
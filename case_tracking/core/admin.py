@@ -1,9 +1,11 @@
 from django import forms
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.admin import AdminSite
 from django.contrib.auth.admin import Group, UserAdmin
 from django.shortcuts import render
-from django.urls import path
+from django.urls import path, reverse
+from django.utils.html import format_html
+from django_celery_beat import admin as celery_beat_admin  # noqa: F401
 from django_celery_beat.models import (
     ClockedSchedule,
     CrontabSchedule,
@@ -12,9 +14,24 @@ from django_celery_beat.models import (
     SolarSchedule,
 )
 
-from .admin_views import CaseProcessing
-from .models import Case, CaseStageLog, CustomUser, NextStage, Stage
+from . import reference_data
+from .admin_paging import CursorChangeList, EstimatedCountPaginator
+from .admin_views import CaseProcessing, ProfileDetail, ProfileList
+from .labs import lab_codes
+from .models import (
+    BackupRecord,
+    Case,
+    CaseStageLog,
+    CustomUser,
+    Lab,
+    NextStage,
+    ScanStation,
+    SlowQuery,
+    Stage,
+)
 
+# Модели beat регистрирует django_celery_beat.admin (импортирован выше), даже если
+# этот модуль загружен раньше admin.autodiscover()
 admin.site.unregister(Group)
 admin.site.unregister(PeriodicTask)
 admin.site.unregister(IntervalSchedule)
@@ -40,6 +57,16 @@ class CustomAdminSite(AdminSite):
                 self.admin_view(CaseProcessing.as_view()),
                 name="",
             ),
+            path(
+                "profiles/",
+                self.admin_view(ProfileList.as_view()),
+                name="profiles",
+            ),
+            path(
+                "profiles/<int:pk>/",
+                self.admin_view(ProfileDetail.as_view()),
+                name="profile_detail",
+            ),
         ]
         return custom_urls + urls
 
@@ -69,11 +96,79 @@ class CaseAdminForm(forms.ModelForm):
         return current_stage
 
 
+def timeline_link(case_id):
+    return format_html(
+        '<a href="{}">Timeline</a>', reverse("case_timeline", args=[case_id])
+    )
+
+
+def with_employee_names(rows, field):
+    """
+    Evaluate a changelist page and set ``employee_name`` on every row from the
+    user in ``field``, using the cached reference data instead of a join: users
+    are stored on the main database, not on the lab's.
+    """
+    names = dict(reference_data.employee_choices())
+    rows = list(rows)
+    for row in rows:
+        row.employee_name = names.get(getattr(row, field), "-")
+    return rows
+
+
+class StageListFilter(admin.SimpleListFilter):
+    """
+    Stage filter built from the cached reference data instead of a Stage query
+    on every changelist page.
+    """
+
+    title = "stage"
+    parameter_name = "stage"
+    field_name = "stage"
+
+    def lookups(self, request, model_admin):
+        return reference_data.stage_choices()
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{f"{self.field_name}_id": self.value()})
+        return queryset
+
+
+class CurrentStageListFilter(StageListFilter):
+    title = "current stage"
+    parameter_name = "current_stage"
+    field_name = "current_stage"
+
+
+class LabListFilter(admin.SimpleListFilter):
+    """
+    Lab filter listing the known labs instead of the distinct values of the
+    whole table.
+    """
+
+    title = "lab"
+    parameter_name = "lab"
+
+    def lookups(self, request, model_admin):
+        return [(code, code) for code in lab_codes()]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(lab=self.value())
+        return queryset
+
+
+@admin.register(Lab)
+class LabAdmin(admin.ModelAdmin):
+    list_display = ("code", "name")
+    search_fields = ("code", "name")
+
+
 @admin.register(Stage)
 class StageAdmin(admin.ModelAdmin):
-    list_display = ("name", "display_name")
+    list_display = ("name", "display_name", "lab")
     search_fields = ("name",)
-    list_filter = ("name",)
+    list_filter = ("lab", "name")
 
 
 @admin.register(NextStage)
@@ -89,16 +184,35 @@ class CaseAdmin(admin.ModelAdmin):
     list_display = (
         "case_number",
         "priority",
-        "last_updated_by",
+        "updated_by",
         "current_stage",
         "created_at",
         "archived",
         "is_returned",
+        "timeline",
     )
-    list_filter = ("priority", "current_stage", "archived")
+    list_select_related = ("current_stage",)
+    list_filter = (LabListFilter, "priority", CurrentStageListFilter, "archived")
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     search_fields = ("case_number", "current_stage", "archived")
     readonly_fields = ("created_at", "updated_at")
 
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        changelist.result_list = with_employee_names(
+            changelist.result_list, "last_updated_by_id"
+        )
+        return changelist
+
+    @admin.display(description="Last updated by", ordering="last_updated_by_id")
+    def updated_by(self, obj):
+        return obj.employee_name
+
+    @admin.display(description="Timeline")
+    def timeline(self, obj):
+        return timeline_link(obj.pk)
+
     def save_model(self, request, obj, form, change):
         user = request.user
         if change and "current_stage" in form.changed_data:
@@ -112,9 +226,94 @@ class CaseAdmin(admin.ModelAdmin):
 
 @admin.register(CaseStageLog)
 class CaseStageLogAdmin(admin.ModelAdmin):
-    list_display = ("case", "stage", "user", "start_time", "reason")
-    list_filter = ("stage",)
+    list_display = ("case", "stage", "employee", "start_time", "reason", "timeline")
+    list_select_related = ("case", "stage")
+    list_filter = (StageListFilter,)
     search_fields = ("case__case_number",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # Постраничный переход по курсору (start_time, id) вместо OFFSET
+    cursor_field = "start_time"
+    sortable_by = ()
+
+    def get_changelist(self, request, **kwargs):
+        return CursorChangeList
+
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        changelist.result_list = with_employee_names(changelist.result_list, "user_id")
+        return changelist
+
+    @admin.display(description="User")
+    def employee(self, obj):
+        return obj.employee_name
+
+    @admin.display(description="Timeline")
+    def timeline(self, obj):
+        return timeline_link(obj.case_id)
+
+
+@admin.register(BackupRecord)
+class BackupRecordAdmin(admin.ModelAdmin):
+    list_display = (
+        "started_at",
+        "kind",
+        "database",
+        "table",
+        "status",
+        "duration",
+        "size",
+        "rows",
+    )
+    list_filter = ("kind", "status", "database")
+    readonly_fields = [field.name for field in BackupRecord._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(SlowQuery)
+class SlowQueryAdmin(admin.ModelAdmin):
+    list_display = (
+        "fingerprint",
+        "count",
+        "total_time",
+        "max_time",
+        "call_site",
+        "last_seen",
+    )
+    list_filter = ("database",)
+    search_fields = ("normalized_sql", "call_site")
+    readonly_fields = [field.name for field in SlowQuery._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(ScanStation)
+class ScanStationAdmin(admin.ModelAdmin):
+    list_display = ("name", "lab", "is_active", "created_at")
+    list_filter = ("is_active",)
+    fields = ("name", "lab", "is_active", "created_at")
+    actions = ["rotate_tokens"]
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            self.show_token(request, obj, obj.set_new_token())
+        super().save_model(request, obj, form, change)
+
+    @admin.action(description="Issue new tokens")
+    def rotate_tokens(self, request, queryset):
+        for station in queryset:
+            token = station.set_new_token()
+            station.save()
+            self.show_token(request, station, token)
+
+    def show_token(self, request, station, token):
+        # Токен показывается один раз, в базе хранится только хеш
+        messages.warning(
+            request, f"Token for {station.name}: {token} (shown only once)"
+        )
 
 
 @admin.register(CustomUser)
@@ -124,7 +323,10 @@ class CustomUserAdmin(UserAdmin):
     list_editable = ("is_staff", "role")
     fieldsets = (
         (None, {"fields": ("email", "password")}),
-        ("Personal info", {"fields": ("first_name", "last_name", "role", "barcode")}),
+        (
+            "Personal info",
+            {"fields": ("first_name", "last_name", "role", "barcode", "lab")},
+        ),
         (
             "Permissions",
             {
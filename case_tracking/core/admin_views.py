@@ -1,16 +1,53 @@
 import logging
 
-from core.forms import CaseProcessingForm
-from core.models import Case, NextStage, ReturnReason, Stage
+from constance import config
+from core.config_snapshot import get_config
+from core.forms import CaseProcessingForm, ProfilingSettingsForm
+from core.models import (
+    Case,
+    CaseConflict,
+    CustomUser,
+    NextStage,
+    ProfileRecord,
+    ReturnReason,
+    Stage,
+)
+from core.permissions import case_permissions
+from core.routers import current_lab
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
-from django.shortcuts import redirect, render
+from django.core.exceptions import PermissionDenied
+from django.db import router, transaction
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404, redirect, render
+from django.template.loader import render_to_string
 from django.utils.decorators import method_decorator
 from django.views import View
-from guardian.shortcuts import get_objects_for_user
 
 logger = logging.getLogger(__name__)
 
+BULK_ACTION_PERMISSIONS = {
+    "transition": "core.manage_case",
+    "archive": "core.archive_cases",
+    "return": "core.return_cases",
+}
+
+
+def case_row(case, permissions):
+    """
+    ``(case_text, next_stages, case, case_perms)`` of one case on the case
+    processing page.
+    """
+    next_stages = NextStage.objects.filter(current=case.current_stage)
+    case_text = (
+        f"Case #{case.case_number}: {case.priority} - state: {case.current_stage.name}"
+    )
+    return case_text, next_stages, case, permissions.get_perms(case)
+
+
+def is_async(request):
+    return request.headers.get("x-requested-with") == "XMLHttpRequest"
+
 
 @method_decorator(staff_member_required, name="dispatch")
 class CaseProcessing(View):
@@ -23,32 +60,47 @@ class CaseProcessing(View):
             case_id = request.GET.get("case_id")
             show_all = request.GET.get("show_all") == "true"
 
-            cases = Case.objects.prefetch_related("current_stage").filter(
-                archived=False, is_returned=False
+            permissions = case_permissions(request)
+            cases = permissions.prefetch(
+                Case.objects.select_related("current_stage").filter(
+                    lab=current_lab(), archived=False, is_returned=False
+                )
             )
 
-            if not request.user.has_perm("core.view_case_processing_all_cases"):
-                cases = get_objects_for_user(request.user, "manage_cases", cases)
+            if not (
+                request.user.has_perm("core.view_case_processing_all_cases")
+                or request.user.has_perm("core.manage_case")
+            ):
+                # Права на объекты лежат на основной базе, а кейсы могут быть в
+                # базе лаборатории, поэтому без подзапроса
+                cases = [
+                    case
+                    for case in cases
+                    if permissions.has_perm("core.manage_case", case)
+                ]
 
             for case in cases:
                 choices_cases.append((case.pk, f"{case.case_number} ({case.priority})"))
 
             if not show_all and case_id:
-                cases = cases.filter(pk=case_id)
+                cases = [case for case in cases if str(case.pk) == case_id]
 
-            if not cases.exists():
+            if not cases:
                 if not choices_cases:
                     context["no_active_cases"] = True
                 else:
                     messages.error(request, "You have no rights to view it.")
                 return render(request, "admin/case_processing.html", context)
 
+            stage_ids = set()
             for case in cases:
-                next_stages = NextStage.objects.filter(current=case.current_stage)
-                case_text = f"Case #{case.case_number}: {case.priority} - state: {case.current_stage.name}"
-                cases_data.append((case_text, next_stages, case))
+                cases_data.append(case_row(case, permissions))
+                stage_ids.add(case.current_stage_id)
 
             context["cases_data"] = cases_data
+            context["bulk_stages"] = Stage.objects.filter(
+                next_state__current__in=stage_ids
+            ).distinct()
             context["form"] = CaseProcessingForm(choices_cases, case_id)
             context["no_active_cases"] = False
             context["return_reasons"] = ReturnReason.objects.all()
@@ -59,14 +111,20 @@ class CaseProcessing(View):
             return render(request, "admin/error.html", {"error": str(e)})
 
     def post(self, request):
+        permissions = case_permissions(request)
         try:
             user = request.user
 
-            if "transition" in request.POST:
-                case = Case.objects.get(pk=request.POST["case_id"])
+            if "bulk_action" in request.POST:
+                self.bulk_action(request, permissions)
+
+            elif "transition" in request.POST:
+                case = Case.objects.get(lab=current_lab(), pk=request.POST["case_id"])
                 new_stage = Stage.objects.get(pk=request.POST["transition"])
 
-                if request.user.has_perm("core.manage_cases", case):
+                if new_stage.lab != case.lab:
+                    messages.error(request, "The stage belongs to another lab.")
+                elif permissions.has_perm("core.manage_case", case):
                     case.transition_stage(new_stage=new_stage, user=user)
                     case.refresh_from_db()
                     messages.success(
@@ -77,8 +135,8 @@ class CaseProcessing(View):
                     messages.error(request, "You have no rights to see that stage.")
 
             elif "archive" in request.POST:
-                case = Case.objects.get(pk=request.POST["case_id"])
-                if request.user.has_perm("core.archive_cases", case):
+                case = Case.objects.get(lab=current_lab(), pk=request.POST["case_id"])
+                if permissions.has_perm("core.archive_cases", case):
                     case.archive_case()
                     case.last_updated_by = user
                     case.save()
@@ -89,7 +147,7 @@ class CaseProcessing(View):
                     messages.error(request, "You have no rights to archive a case.")
 
             elif "return" in request.POST:
-                case = Case.objects.get(pk=request.POST["case_id"])
+                case = Case.objects.get(lab=current_lab(), pk=request.POST["case_id"])
                 reason = (
                     ReturnReason.objects.get(pk=request.POST["return_reason_id"])
                     if "return_reason_id" in request.POST
@@ -97,7 +155,7 @@ class CaseProcessing(View):
                 )
                 description = request.POST.get("core.return_description")
 
-                if request.user.has_perm("core.return_cases", case):
+                if permissions.has_perm("core.return_cases", case):
                     try:
                         case.process_return(reason=reason, description=description)
                         case.last_updated_by = user
@@ -110,10 +168,15 @@ class CaseProcessing(View):
                 else:
                     messages.error(request, "You have no rights to return cases.")
 
+        except CaseConflict as e:
+            messages.error(request, str(e))
         except Exception as e:
             logger.error(f"Error in post CaseProcessing: {e}")
             messages.error(request, "An error occurred while processing the request")
 
+        if is_async(request) and "case_id" in request.POST:
+            return self.case_fragment(request, permissions, request.POST["case_id"])
+
         # После любой операции возвращаемся к списку без параметров case_id
         base_url = request.path
         query_string = request.GET.copy()
@@ -123,3 +186,158 @@ class CaseProcessing(View):
             f"{base_url}?{query_string.urlencode()}" if query_string else base_url
         )
         return redirect(full_url)
+
+    def case_fragment(self, request, permissions, case_id):
+        """
+        Answer an asynchronous single-case action with its messages and the
+        re-rendered row of the case, or ``removed`` if the case left the page.
+        Only this case is loaded, not the whole list of active cases.
+        """
+        try:
+            case = (
+                Case.objects.select_related("current_stage")
+                .filter(
+                    lab=current_lab(), pk=case_id, archived=False, is_returned=False
+                )
+                .first()
+            )
+        except ValueError:
+            case = None
+        visible = case is not None and (
+            request.user.has_perm("core.view_case_processing_all_cases")
+            or permissions.has_perm("core.manage_case", case)
+        )
+        html = ""
+        if visible:
+            case_text, next_stages, case, case_perms = case_row(case, permissions)
+            html = render_to_string(
+                "admin/case_processing_row.html",
+                {
+                    "case_text": case_text,
+                    "next_stages": next_stages,
+                    "case": case,
+                    "case_perms": case_perms,
+                    "return_reasons": (
+                        ReturnReason.objects.all()
+                        if "return_cases" in case_perms
+                        else ()
+                    ),
+                },
+                request=request,
+            )
+        return JsonResponse(
+            {
+                "case_id": case_id,
+                "removed": not visible,
+                "html": html,
+                "messages": [
+                    {"level": message.tags, "text": str(message)}
+                    for message in messages.get_messages(request)
+                ],
+            }
+        )
+
+    def bulk_action(self, request, permissions):
+        """
+        Apply one action to all selected cases in a single transaction.
+        """
+        action = request.POST["bulk_action"]
+        perm = BULK_ACTION_PERMISSIONS[action]
+        cases = permissions.prefetch(
+            Case.objects.filter(
+                lab=current_lab(),
+                pk__in=request.POST.getlist("case_ids"),
+                archived=False,
+                is_returned=False,
+            )
+        )
+        if not cases:
+            messages.error(request, "Select at least one case.")
+            return
+
+        allowed_ids = [case.pk for case in cases if permissions.has_perm(perm, case)]
+        selected = Case.objects.filter(lab=current_lab(), pk__in=allowed_ids)
+
+        # Кейсы лаборатории могут храниться в её собственной базе
+        with transaction.atomic(using=router.db_for_write(Case)):
+            if action == "transition":
+                new_stage = Stage.objects.get(
+                    lab=current_lab(), pk=request.POST["transition"]
+                )
+                updated = selected.bulk_transition(new_stage, user=request.user)
+                summary = f"{updated} case(s) transitioned to {new_stage.name}"
+            elif action == "archive":
+                updated = selected.bulk_archive(user=request.user)
+                summary = f"{updated} case(s) archived"
+            else:
+                reason_id = request.POST.get("return_reason_id")
+                updated = selected.bulk_return(
+                    user=request.user,
+                    reason=(
+                        ReturnReason.objects.get(pk=reason_id) if reason_id else None
+                    ),
+                    description=request.POST.get("return_description"),
+                )
+                summary = f"{updated} case(s) returned"
+
+        messages.success(request, summary)
+        denied = len(cases) - len(allowed_ids)
+        if denied:
+            messages.error(request, f"You have no rights to {action} {denied} case(s).")
+        skipped = len(allowed_ids) - updated
+        if skipped:
+            messages.warning(
+                request,
+                f"{skipped} case(s) skipped: action not allowed in their state.",
+            )
+
+
+def _require_manager(request):
+    # Профили содержат SQL и пути к коду - только для менеджеров
+    if request.user.role != CustomUser.MANAGER and not request.user.is_superuser:
+        raise PermissionDenied
+
+
+@method_decorator(staff_member_required, name="dispatch")
+class ProfileList(View):
+    """
+    The slowest sampled requests and task runs, and the sample rates.
+    """
+
+    def get(self, request, form=None):
+        _require_manager(request)
+        snapshot = get_config()
+        form = form or ProfilingSettingsForm(
+            initial={
+                "request_rate": snapshot.PROFILING_SAMPLE_RATE,
+                "task_rate": snapshot.PROFILING_TASK_SAMPLE_RATE,
+            }
+        )
+        context = {
+            "form": form,
+            "profiles": ProfileRecord.objects.defer("stats", "queries"),
+        }
+        return render(request, "admin/profiles.html", context)
+
+    def post(self, request):
+        _require_manager(request)
+        if "clear" in request.POST:
+            ProfileRecord.objects.all().delete()
+            messages.success(request, "Profiles cleared")
+            return redirect("case_processing:profiles")
+
+        form = ProfilingSettingsForm(request.POST)
+        if not form.is_valid():
+            return self.get(request, form)
+        config.PROFILING_SAMPLE_RATE = form.cleaned_data["request_rate"]
+        config.PROFILING_TASK_SAMPLE_RATE = form.cleaned_data["task_rate"]
+        messages.success(request, "Profiling settings saved")
+        return redirect("case_processing:profiles")
+
+
+@method_decorator(staff_member_required, name="dispatch")
+class ProfileDetail(View):
+    def get(self, request, pk):
+        _require_manager(request)
+        profile = get_object_or_404(ProfileRecord, pk=pk)
+        return render(request, "admin/profile_detail.html", {"profile": profile})
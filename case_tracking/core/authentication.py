@@ -1,14 +1,140 @@
+import hmac
+import time
+
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+from .models import ScanStation
+
+STATION_TOKENS_KEY = "scan_stations:tokens"
+STATION_TOKENS_TIMEOUT = 60 * 60
+# Кеш в памяти процесса не сбрасывается сигналами из других процессов:
+# отозванный токен там действует не дольше этого
+LOCAL_STATION_TOKENS_TIMEOUT = 30
+# Неизвестный токен перечитывает хеши из базы не чаще раза за столько секунд в процессе
+STATION_TOKENS_RELOAD_INTERVAL = 5
+# Первые символы хеша служат ключом поиска, весь хеш сравнивается за постоянное время
+SELECTOR_LENGTH = 16
+
+# Время последней перезагрузки токенов из-за неизвестного selector в этом процессе
+_reloaded_at = None
 
 
 class EmailBackend(ModelBackend):
     def authenticate(self, request, email=None, password=None, **kwargs):
         UserModel = get_user_model()
+        email = email or kwargs.get("username")
+        if email is None or password is None:
+            return None
         try:
             user = UserModel.objects.get(email=email)
         except UserModel.DoesNotExist:
+            # Хешируем пароль и для несуществующего пользователя, чтобы время
+            # ответа не выдавало, есть ли такой email
+            UserModel().set_password(password)
             return None
-        if user.check_password(password):
+        if user.check_password(password) and self.user_can_authenticate(user):
             return user
         return None
+
+
+def station_tokens(reload=False):
+    """
+    Return ``{selector: (token_hash, station_id, name, lab)}`` of the active
+    stations, from the database if ``reload`` is set.
+    """
+    tokens = None if reload else cache.get(STATION_TOKENS_KEY)
+    if tokens is None:
+        tokens = {
+            token_hash[:SELECTOR_LENGTH]: (token_hash, pk, name, lab)
+            for pk, name, token_hash, lab in ScanStation.objects.filter(
+                is_active=True
+            ).values_list("id", "name", "token_hash", "lab")
+        }
+        cache.set(STATION_TOKENS_KEY, tokens, station_tokens_timeout())
+    return tokens
+
+
+def station_tokens_timeout():
+    """
+    How long the token hashes stay cached: an hour in a shared cache, which
+    invalidate_station_tokens() clears for every process, and only
+    LOCAL_STATION_TOKENS_TIMEOUT in a per-process one.
+    """
+    if isinstance(caches["default"], LocMemCache):
+        return LOCAL_STATION_TOKENS_TIMEOUT
+    return STATION_TOKENS_TIMEOUT
+
+
+def invalidate_station_tokens():
+    cache.delete(STATION_TOKENS_KEY)
+
+
+def find_station(selector):
+    """
+    The cached token entry for a selector. A per-process cache may predate a
+    station created or rotated in another process, so an unknown selector
+    reloads the tokens, at most once per STATION_TOKENS_RELOAD_INTERVAL.
+    """
+    global _reloaded_at
+    station = station_tokens().get(selector)
+    if station is not None:
+        return station
+    current = time.monotonic()
+    if (
+        _reloaded_at is not None
+        and current - _reloaded_at < STATION_TOKENS_RELOAD_INTERVAL
+    ):
+        return None
+    _reloaded_at = current
+    return station_tokens(reload=True).get(selector)
+
+
+class StationUser:
+    """
+    The request user of a scan station. The employee making a scan is identified
+    by the badge barcode in the request, not by the station.
+    """
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+    is_staff = False
+    is_superuser = False
+
+    def __init__(self, station_id, name, lab=""):
+        self.station_id = station_id
+        self.name = name
+        self.lab = lab
+
+    def __str__(self):
+        return f"Scan station {self.name}"
+
+
+class StationTokenAuthentication(BaseAuthentication):
+    """
+    ``Authorization: Station <token>``, checked against the cached token hashes
+    without loading a session or a user from the database.
+    """
+
+    keyword = "Station"
+
+    def authenticate(self, request):
+        header = get_authorization_header(request).split()
+        if not header or header[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(header) != 2:
+            raise AuthenticationFailed("Invalid station token header.")
+
+        token_hash = ScanStation.hash_token(header[1].decode(errors="replace"))
+        station = find_station(token_hash[:SELECTOR_LENGTH])
+        if station is None or not hmac.compare_digest(station[0], token_hash):
+            raise AuthenticationFailed("Invalid station token.")
+        return StationUser(*station[1:]), station[1]
+
+    def authenticate_header(self, request):
+        return self.keyword
@@ -0,0 +1,454 @@
+"""
+Database backups to the local BACKUP_DIR, so they run without network access.
+
+A full backup streams the database dump (pg_dump for PostgreSQL, iterdump for
+SQLite) through ``compress_chunks``. That function gzips fixed-size chunks on a
+thread pool (zlib releases the GIL) and writes them in order as consecutive gzip
+members, which gunzip and ``gzip.open`` read as one file. Append-mostly tables
+such as CaseStageLog are also backed up incrementally: new rows and rows closed
+since the previous run, as JSON lines. Every run is stored as a BackupRecord with
+its duration. ``verify_backup`` restores a full backup into a scratch database,
+times it and compares the row counts. Labs with their own database
+(``settings.LAB_DATABASES``) are backed up and verified separately from the
+primary, see ``backup_databases``.
+"""
+
+import gzip
+import json
+import os
+import sqlite3
+import subprocess
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import dj_database_url
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Q
+
+from .models import BackupRecord, Case, CaseStageLog, CustomUser, Stage
+
+CHUNK_SIZE = 4 * 1024 * 1024
+# Инкрементальная копия повторно выгружает строки за это время до прошлого запуска:
+# строка с меньшим pk могла зафиксироваться уже после него
+COMMIT_WINDOW = timedelta(minutes=10)
+# Таблицы, по которым сверяется восстановленная копия
+VERIFIED_MODELS = (Stage, CustomUser, Case, CaseStageLog)
+
+
+class BackupError(Exception):
+    pass
+
+
+def backup_databases():
+    """
+    Aliases of the databases to back up: the primary and every lab database.
+    """
+    return [DEFAULT_DB_ALIAS, *sorted(set(settings.LAB_DATABASES.values()))]
+
+
+def backup_dir():
+    path = Path(settings.BACKUP_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def compression_workers():
+    return settings.BACKUP_COMPRESSION_WORKERS or os.cpu_count() or 1
+
+
+def compress_chunks(chunks, target, workers=None, level=6):
+    """
+    Gzip an iterable of byte chunks into ``target`` using several threads.
+    Only a few chunks per worker are kept in memory. Returns the input size.
+    """
+    workers = workers or compression_workers()
+    size = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for chunk in chunks:
+            size += len(chunk)
+            pending.append(pool.submit(gzip.compress, chunk, level, mtime=0))
+            if len(pending) >= workers * 2:
+                target.write(pending.popleft().result())
+        while pending:
+            target.write(pending.popleft().result())
+    return size
+
+
+def _text_chunks(lines, size=CHUNK_SIZE):
+    buffer, buffered = [], 0
+    for line in lines:
+        data = line.encode()
+        buffer.append(data)
+        buffered += len(data)
+        if buffered >= size:
+            yield b"".join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def _pg_command(program, settings_dict):
+    command = [program]
+    if settings_dict.get("HOST"):
+        command += ["--host", settings_dict["HOST"]]
+    if settings_dict.get("PORT"):
+        command += ["--port", str(settings_dict["PORT"])]
+    if settings_dict.get("USER"):
+        command += ["--username", settings_dict["USER"]]
+    env = dict(os.environ)
+    if settings_dict.get("PASSWORD"):
+        env["PGPASSWORD"] = settings_dict["PASSWORD"]
+    return command, env
+
+
+def _pg_dump_chunks(settings_dict, snapshot=None):
+    command, env = _pg_command("pg_dump", settings_dict)
+    command += ["--no-owner", "--clean", "--if-exists"]
+    if snapshot:
+        command += ["--snapshot", snapshot]
+    command.append(settings_dict["NAME"])
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=stderr, env=env
+        )
+        try:
+            yield from iter(lambda: process.stdout.read(CHUNK_SIZE), b"")
+            process.stdout.close()
+            if process.wait() != 0:
+                stderr.seek(0)
+                raise BackupError(
+                    f"pg_dump failed: {stderr.read().decode(errors='replace')}"
+                )
+        finally:
+            # Потребитель остановился раньше (ошибка сжатия или записи)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+
+def table_counts(using=DEFAULT_DB_ALIAS):
+    return {
+        model._meta.db_table: model.objects.using(using).count()
+        for model in VERIFIED_MODELS
+    }
+
+
+@contextmanager
+def snapshot_dump(using=DEFAULT_DB_ALIAS):
+    """
+    Yield ``(counts, chunks)``: the row counts of a database and its SQL dump in
+    chunks, both read from one snapshot, so rows committed during the dump
+    change neither. The chunks must be consumed inside the block.
+    """
+    connection = connections[using]
+    if connection.vendor not in ("postgresql", "sqlite"):
+        raise BackupError(f"Backups of {connection.vendor} databases are not supported")
+    outermost = not connection.in_atomic_block
+    with transaction.atomic(using=using):
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                if outermost:
+                    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                counts = table_counts(using)
+                # pg_dump читает тот же снимок, пока эта транзакция открыта
+                cursor.execute("SELECT pg_export_snapshot()")
+                snapshot = cursor.fetchone()[0]
+            yield counts, _pg_dump_chunks(connection.settings_dict, snapshot)
+        else:
+            # iterdump читает в той же транзакции, что и подсчёт строк
+            counts = table_counts(using)
+            yield counts, _text_chunks(
+                f"{line}\n" for line in connection.connection.iterdump()
+            )
+
+
+def _timestamp(moment):
+    return f"{moment:%Y%m%d-%H%M%S-%f}"
+
+
+def _file_name(prefix, record, suffix):
+    # Имена копий основной базы не меняются
+    if record.database != DEFAULT_DB_ALIAS:
+        prefix = f"{prefix}-{record.database}"
+    return f"{prefix}-{_timestamp(record.started_at)}{suffix}"
+
+
+def _store_offsite(path):
+    # Копия в хранилище dbbackup (Dropbox), если включено
+    if settings.BACKUP_OFFSITE:
+        from dbbackup.storage import get_storage
+
+        with open(path, "rb") as backup_file:
+            get_storage().write_file(backup_file, path.name)
+
+
+def _run(record, write):
+    """
+    Time ``write(record)``, save the record and re-raise failures as BackupError.
+    """
+    started = time.perf_counter()
+    try:
+        write(record)
+    except BackupError as e:
+        record.status = BackupRecord.FAILED
+        record.error = str(e)
+        raise
+    except Exception as e:
+        record.status = BackupRecord.FAILED
+        record.error = str(e)
+        raise BackupError(str(e)) from e
+    finally:
+        record.duration = time.perf_counter() - started
+        record.save()
+    return record
+
+
+def full_backup(using=DEFAULT_DB_ALIAS):
+    """
+    Write a compressed SQL dump of the whole database ``using`` and return its
+    record.
+    """
+    record = BackupRecord(kind=BackupRecord.FULL, database=using)
+    path = backup_dir() / _file_name("full", record, ".sql.gz")
+
+    def write(record):
+        partial = path.with_suffix(".partial")
+        try:
+            with snapshot_dump(using) as (counts, chunks), open(
+                partial, "wb"
+            ) as target:
+                raw_size = compress_chunks(chunks, target)
+        except BaseException:
+            # Недописанные файлы при повторных сбоях заполнили бы диск
+            partial.unlink(missing_ok=True)
+            raise
+        record.rows = sum(counts.values())
+        record.details = {
+            "vendor": connections[using].vendor,
+            "counts": counts,
+            "raw_size": raw_size,
+        }
+        partial.replace(path)
+        record.path = str(path)
+        record.size = path.stat().st_size
+        _store_offsite(path)
+
+    return _run(record, write)
+
+
+def incremental_backup(model=CaseStageLog, using=DEFAULT_DB_ALIAS):
+    """
+    Back up the rows of an append-mostly table of the database ``using`` added
+    or closed (end_time set) since the previous incremental backup of that
+    database. The first run exports the whole table.
+    Rows started or closed within COMMIT_WINDOW before the previous run are
+    exported again, in case they committed after it; restore_incremental
+    upserts, so repeated rows are harmless.
+    """
+    table = model._meta.db_table
+    previous = (
+        BackupRecord.objects.filter(
+            kind=BackupRecord.INCREMENTAL,
+            database=using,
+            table=table,
+            status=BackupRecord.SUCCESS,
+        )
+        .order_by("-started_at")
+        .first()
+    )
+    record = BackupRecord(kind=BackupRecord.INCREMENTAL, database=using, table=table)
+    path = backup_dir() / _file_name(table, record, ".jsonl.gz")
+
+    def write(record):
+        queryset = model.objects.using(using)
+        last_pk = 0
+        if previous is not None:
+            last_pk = previous.details["last_pk"]
+            window = datetime.fromisoformat(previous.details["since"]) - COMMIT_WINDOW
+            queryset = queryset.filter(
+                Q(pk__gt=last_pk) | Q(start_time__gte=window) | Q(end_time__gte=window)
+            )
+        attnames = [field.attname for field in model._meta.concrete_fields]
+        pk_name = model._meta.pk.attname
+        exported = {"rows": 0, "last_pk": last_pk}
+
+        def lines():
+            rows = queryset.values(*attnames).order_by("pk").iterator(chunk_size=5000)
+            for row in rows:
+                exported["rows"] += 1
+                exported["last_pk"] = max(exported["last_pk"], row[pk_name])
+                yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+
+        with open(path, "wb") as target:
+            compress_chunks(_text_chunks(lines()), target)
+        record.rows = exported["rows"]
+        record.details = {
+            "last_pk": exported["last_pk"],
+            "since": record.started_at.isoformat(),
+            "previous": previous.pk if previous else None,
+        }
+        record.path = str(path)
+        record.size = path.stat().st_size
+        _store_offsite(path)
+
+    return _run(record, write)
+
+
+def restore_incremental(
+    path, model=CaseStageLog, batch_size=1000, using=DEFAULT_DB_ALIAS
+):
+    """
+    Apply an incremental backup on top of a restored full backup of the database
+    ``using`` (insert or update by primary key).
+    """
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    restored = 0
+    batch = []
+    with gzip.open(path, "rt") as source:
+        for line in source:
+            batch.append(model(**json.loads(line)))
+            if len(batch) >= batch_size:
+                restored += _upsert(model, batch, fields, using)
+                batch = []
+    if batch:
+        restored += _upsert(model, batch, fields, using)
+    return restored
+
+
+def _upsert(model, objects, fields, using):
+    model.objects.using(using).bulk_create(
+        objects,
+        update_conflicts=True,
+        unique_fields=[model._meta.pk.name],
+        update_fields=[field.name for field in fields],
+    )
+    return len(objects)
+
+
+def _sql_statements(lines):
+    """
+    Split a stream of SQL lines into complete statements; a statement may span
+    lines (text values with newlines).
+    """
+    buffer = ""
+    for line in lines:
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            yield buffer
+            buffer = ""
+    if buffer.strip():
+        yield buffer
+
+
+def _restore_sqlite(path):
+    scratch = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False)
+    scratch.close()
+    # Транзакциями управляют BEGIN/COMMIT из дампа
+    database = sqlite3.connect(scratch.name, isolation_level=None)
+    try:
+        with gzip.open(path, "rt") as source:
+            for statement in _sql_statements(source):
+                database.execute(statement)
+        return {
+            table: database.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+            for table in (model._meta.db_table for model in VERIFIED_MODELS)
+        }
+    finally:
+        database.close()
+        os.unlink(scratch.name)
+
+
+def _restore_postgresql(path):
+    if not settings.BACKUP_VERIFY_DATABASE_URL:
+        raise BackupError("BACKUP_VERIFY_DATABASE_URL is not set")
+    settings_dict = dj_database_url.parse(settings.BACKUP_VERIFY_DATABASE_URL)
+    command, env = _pg_command("psql", settings_dict)
+    command += [
+        "--quiet",
+        "--set",
+        "ON_ERROR_STOP=1",
+        "--dbname",
+        settings_dict["NAME"],
+    ]
+
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    with gzip.open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+            process.stdin.write(chunk)
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        raise BackupError(f"psql failed: {stderr.decode(errors='replace')}")
+
+    counts = {}
+    for model in VERIFIED_MODELS:
+        table = model._meta.db_table
+        output = subprocess.run(
+            command
+            + [
+                "--tuples-only",
+                "--no-align",
+                "--command",
+                f'SELECT COUNT(*) FROM "{table}"',
+            ],
+            capture_output=True,
+            env=env,
+            check=True,
+        )
+        counts[table] = int(output.stdout)
+    return counts
+
+
+def verify_backup(backup=None, using=DEFAULT_DB_ALIAS):
+    """
+    Restore a full backup (the latest one of the database ``using`` by default)
+    into a scratch database and compare its row counts with those recorded at
+    backup time.
+    """
+    if backup is None:
+        backup = (
+            BackupRecord.objects.filter(
+                kind=BackupRecord.FULL, database=using, status=BackupRecord.SUCCESS
+            )
+            .order_by("-started_at")
+            .first()
+        )
+        if backup is None:
+            raise BackupError(f"There is no backup of {using} to verify")
+    record = BackupRecord(
+        kind=BackupRecord.VERIFY, database=backup.database, path=backup.path
+    )
+
+    def write(record):
+        record.details = {"backup": backup.pk, "backup_duration": backup.duration}
+        vendor = backup.details.get("vendor")
+        if vendor == "sqlite":
+            restored = _restore_sqlite(backup.path)
+        elif vendor == "postgresql":
+            restored = _restore_postgresql(backup.path)
+        else:
+            raise BackupError(f"Cannot restore a {vendor} backup")
+
+        expected = backup.details.get("counts", {})
+        record.rows = sum(restored.values())
+        record.details.update(restored=restored, expected=expected)
+        mismatched = sorted(
+            table for table, count in expected.items() if restored.get(table) != count
+        )
+        if mismatched:
+            raise BackupError(f"Row counts differ for {', '.join(mismatched)}")
+
+    return _run(record, write)
@@ -0,0 +1,134 @@
+"""
+Code 128 barcodes and print-ready label sheets (HTML pages with inline SVG).
+
+This module only uses the standard library: label pages are rendered in worker
+processes (see core.labels), which import it without setting up Django.
+"""
+
+from html import escape
+
+# Ширины штрихов и пробелов символов Code 128, значения 0..106 (106 - стоп)
+PATTERNS = (
+    "212222 222122 222221 121223 121322 131222 122213 122312 132212 221213 "
+    "221312 231212 112232 122132 122231 113222 123122 123221 223211 221132 "
+    "221231 213212 223112 312131 311222 321122 321221 312212 322112 322211 "
+    "212123 212321 232121 111323 131123 131321 112313 132113 132311 211313 "
+    "231113 231311 112133 112331 132131 113123 113321 133121 313121 211331 "
+    "231131 213113 213311 213131 311123 311321 331121 312113 312311 332111 "
+    "314111 221411 431111 111224 111422 121124 121421 141122 141221 112214 "
+    "112412 122114 122411 142112 142211 241211 221114 413111 241112 134111 "
+    "111242 121142 121241 114212 124112 124211 411212 421112 421211 212141 "
+    "214121 412121 111143 111341 131141 114113 114311 411113 411311 113141 "
+    "114131 311141 411131 211412 211214 211232 2331112"
+).split()
+
+CODE_C = 99
+START_B = 104
+START_C = 105
+STOP = 106
+QUIET_ZONE = 10
+
+# Лист A4, 3 x 8 этикеток 70 x 37 мм
+PAGE_COLUMNS = 3
+PAGE_ROWS = 8
+LABELS_PER_PAGE = PAGE_COLUMNS * PAGE_ROWS
+LABEL_WIDTH_MM = 70
+LABEL_HEIGHT_MM = 37
+
+SHEET_HEADER = f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Labels</title>
+<style>
+@page {{ size: A4; margin: 0; }}
+body {{ margin: 0; font-family: sans-serif; }}
+.page {{
+    width: 210mm; height: 296mm; page-break-after: always; box-sizing: border-box;
+    display: grid;
+    grid-template-columns: repeat({PAGE_COLUMNS}, {LABEL_WIDTH_MM}mm);
+    grid-template-rows: repeat({PAGE_ROWS}, {LABEL_HEIGHT_MM}mm);
+}}
+.label {{
+    display: flex; flex-direction: column; align-items: center; justify-content: center;
+    overflow: hidden; font-size: 3mm;
+}}
+.label svg {{ width: 62mm; height: 18mm; }}
+.label .caption {{ font-size: 2.6mm; }}
+</style>
+</head>
+<body>
+"""
+SHEET_FOOTER = "</body>\n</html>\n"
+
+
+def _symbols(text):
+    """
+    Code 128 symbol values of ``text`` without the check symbol and stop. A
+    trailing run of at least four digits is encoded two digits per symbol.
+    """
+    if not text.isascii() or not text.isprintable():
+        raise ValueError(f"Cannot encode {text!r} as Code 128")
+    digits = len(text) - len(text.rstrip("0123456789"))
+    digits -= digits % 2
+    if digits < 4:
+        digits = 0
+    head, tail = text[: len(text) - digits], text[len(text) - digits :]
+
+    if head:
+        symbols = [START_B] + [ord(char) - 32 for char in head]
+        if tail:
+            symbols.append(CODE_C)
+    else:
+        symbols = [START_C]
+    symbols += [int(tail[index : index + 2]) for index in range(0, len(tail), 2)]
+    return symbols
+
+
+def code128_widths(text):
+    """
+    Module widths of the Code 128 barcode of ``text``, starting with a bar and
+    alternating bars and spaces.
+    """
+    symbols = _symbols(text)
+    check = (symbols[0] + sum(i * s for i, s in enumerate(symbols[1:], 1))) % 103
+    symbols += [check, STOP]
+    return [int(width) for symbol in symbols for width in PATTERNS[symbol]]
+
+
+def barcode_svg(text, height=40):
+    widths = code128_widths(text)
+    total = sum(widths) + 2 * QUIET_ZONE
+    bars = []
+    x = QUIET_ZONE
+    for index, width in enumerate(widths):
+        if index % 2 == 0:
+            bars.append(f'<rect x="{x}" width="{width}" height="{height}"/>')
+        x += width
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {total} {height}" '
+        f'preserveAspectRatio="none" shape-rendering="crispEdges">{"".join(bars)}</svg>'
+    )
+
+
+def render_label(barcode, caption=""):
+    caption_html = f'<div class="caption">{escape(caption)}</div>' if caption else ""
+    return (
+        f'<div class="label">{barcode_svg(barcode)}'
+        f"<div>{escape(barcode)}</div>{caption_html}</div>"
+    )
+
+
+def render_pages(labels):
+    """
+    Render ``[(barcode, caption), ...]`` as consecutive sheet pages.
+    """
+    pages = []
+    for start in range(0, len(labels), LABELS_PER_PAGE):
+        page = labels[start : start + LABELS_PER_PAGE]
+        pages.append(
+            '<div class="page">'
+            + "".join(render_label(barcode, caption) for barcode, caption in page)
+            + "</div>\n"
+        )
+    return "".join(pages)
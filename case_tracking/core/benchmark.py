@@ -0,0 +1,617 @@
+"""
+Performance regression harness: synthetic lab data and timed, query-counted scenarios.
+"""
+
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+
+import django
+from celery import current_app
+from constance import config
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core import signals
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    close_old_connections,
+    connection,
+    connections,
+    transaction,
+)
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils.timezone import now
+
+from . import reference_data, tasks
+from .labels import case_labels, write_label_sheets
+from .models import (
+    BackupRecord,
+    Case,
+    CaseStageLog,
+    CustomUser,
+    NextStage,
+    ReturnReason,
+    Stage,
+)
+
+REPORT_VERSION = 1
+
+SCALES = {
+    "small": {"employees": 50, "stages": 8, "cases": 2_000, "logs_per_case": 3},
+    "medium": {"employees": 1_000, "stages": 24, "cases": 100_000, "logs_per_case": 4},
+    "large": {"employees": 5_000, "stages": 48, "cases": 2_000_000, "logs_per_case": 4},
+}
+
+# Cold starts measured by run_startup_benchmarks, each in a new interpreter
+STARTUP_COMMANDS = {
+    "startup_django_setup": ["-c", "import django; django.setup()"],
+    "startup_celery_worker": [
+        "-c",
+        "from case_tracking.celery import app; app.loader.import_default_modules()",
+    ],
+    "startup_manage_help": ["manage.py", "help"],
+    "startup_manage_check": ["manage.py", "check"],
+}
+
+BENCH_EMAIL_DOMAIN = "bench.local"
+MANAGER_EMAIL = f"manager@{BENCH_EMAIL_DOMAIN}"
+
+SCENARIOS = {}
+
+
+def scenario(name, mutates=False, optional=False):
+    """
+    Register a benchmark scenario. Mutating scenarios run inside a rolled back
+    transaction so that every iteration measures the same amount of work.
+    """
+
+    def decorator(func):
+        SCENARIOS[name] = {"func": func, "mutates": mutates, "optional": optional}
+        return func
+
+    return decorator
+
+
+@contextmanager
+def _auto_now_disabled(model, field_name):
+    field = model._meta.get_field(field_name)
+    field.auto_now = False
+    try:
+        yield
+    finally:
+        field.auto_now = True
+
+
+@contextmanager
+def _eager_tasks():
+    # Шарды выполняются в этом же процессе, чтобы замер включал всю работу задачи
+    conf = current_app.conf
+    previous = conf.task_always_eager
+    conf.task_always_eager = True
+    try:
+        yield
+    finally:
+        conf.task_always_eager = previous
+
+
+def _log(stdout, message):
+    if stdout is not None:
+        stdout.write(message)
+
+
+def generate_dataset(
+    employees,
+    stages,
+    cases,
+    logs_per_case,
+    active_ratio=0.05,
+    returned_ratio=0.01,
+    urgent_ratio=0.1,
+    batch_size=5_000,
+    seed=0,
+    stdout=None,
+):
+    """
+    Fill the current database with a synthetic lab: employees with badges, a stage
+    graph with forward, skip and return transitions, cases and their stage logs.
+    Rows are written with bulk_create, so model save() and signals are bypassed.
+    """
+    if stages < 2:
+        raise ValueError("At least two stages are required")
+
+    rng = random.Random(seed)
+    started = now()
+
+    stage_objects = []
+    for index in range(stages):
+        if index == 0:
+            group = config.FIRST_STAGE_GROUP
+        elif index == stages - 1:
+            group = config.LAST_STAGE_GROUP
+        else:
+            group = f"group_{index:03d}"
+        stage_objects.append(
+            Stage(
+                name=f"stage_{index:03d}",
+                barcode=f"STG{index:05d}",
+                display_name=f"Stage {index}",
+                stage_group=group,
+            )
+        )
+    stage_objects = Stage.objects.bulk_create(stage_objects)
+    first_stage, last_stage = stage_objects[0], stage_objects[-1]
+
+    transitions = []
+    for index, stage in enumerate(stage_objects[:-1]):
+        following = stage_objects[index + 1]
+        transitions.append(
+            NextStage(
+                signal="next",
+                display_name=f"To {following.display_name}",
+                current=stage,
+                next=following,
+            )
+        )
+        if index + 2 < stages and rng.random() < 0.3:
+            skipped = stage_objects[index + 2]
+            transitions.append(
+                NextStage(
+                    signal="skip",
+                    display_name=f"Skip to {skipped.display_name}",
+                    current=stage,
+                    next=skipped,
+                )
+            )
+        if index > 0:
+            transitions.append(
+                NextStage(
+                    signal="return",
+                    display_name=f"Return to {first_stage.display_name}",
+                    current=stage,
+                    next=first_stage,
+                )
+            )
+    NextStage.objects.bulk_create(transitions)
+    _log(stdout, f"Created {stages} stages and {len(transitions)} transitions")
+
+    reasons = ReturnReason.objects.bulk_create(
+        [ReturnReason(reason=value) for value, _ in ReturnReason.REASON_CHOICES]
+    )
+
+    unusable_password = make_password(None)
+    CustomUser.objects.bulk_create(
+        [
+            CustomUser(
+                email=f"employee{index}@{BENCH_EMAIL_DOMAIN}",
+                first_name=f"Employee{index}",
+                last_name="Bench",
+                barcode=f"EMP{index:07d}",
+                password=unusable_password,
+            )
+            for index in range(employees)
+        ],
+        batch_size=batch_size,
+    )
+    CustomUser.objects.create_superuser(
+        MANAGER_EMAIL, None, role=CustomUser.MANAGER, first_name="Manager"
+    )
+    employee_ids = list(
+        CustomUser.objects.filter(barcode__startswith="EMP").values_list(
+            "id", flat=True
+        )
+    )
+    _log(stdout, f"Created {employees} employees")
+
+    material_values = [value for value, _ in Case.MATERIAL_CHOICES]
+    log_count = 0
+    with _auto_now_disabled(Case, "updated_at"):
+        for offset in range(0, cases, batch_size):
+            batch = []
+            paths = []
+            for index in range(offset, min(offset + batch_size, cases)):
+                active = rng.random() < active_ratio
+                current_index = rng.randrange(stages) if active else stages - 1
+                path = list(range(current_index + 1))[-logs_per_case:]
+                created_at = started - timedelta(hours=rng.randint(1, 24 * 90))
+
+                dwell = [timedelta(minutes=rng.randint(5, 240)) for _ in path]
+                updated_at = created_at + sum(dwell[:-1], timedelta())
+                returned = active and rng.random() < returned_ratio
+                batch.append(
+                    Case(
+                        case_number=f"BENCH-{index:09d}",
+                        barcode=f"C{index:010d}",
+                        priority=(
+                            "urgent" if rng.random() < urgent_ratio else "standard"
+                        ),
+                        material=rng.choice(material_values),
+                        current_stage=stage_objects[current_index],
+                        last_updated_by_id=(
+                            rng.choice(employee_ids) if employee_ids else None
+                        ),
+                        created_at=created_at,
+                        updated_at=min(updated_at, started),
+                        archived=not active,
+                        archived_at=None if active else started,
+                        is_returned=returned,
+                        return_reason=rng.choice(reasons) if returned else None,
+                    )
+                )
+                paths.append((path, dwell, active))
+
+            batch = Case.objects.bulk_create(batch)
+
+            logs = []
+            for case, (path, dwell, active) in zip(batch, paths):
+                start_time = case.created_at
+                for step, stage_index in enumerate(path):
+                    is_last = step == len(path) - 1
+                    end_time = start_time + dwell[step]
+                    logs.append(
+                        CaseStageLog(
+                            case=case,
+                            stage=stage_objects[stage_index],
+                            user_id=rng.choice(employee_ids) if employee_ids else None,
+                            start_time=start_time,
+                            end_time=None if active and is_last else end_time,
+                            is_returned=case.is_returned and is_last,
+                        )
+                    )
+                    start_time = end_time
+            CaseStageLog.objects.bulk_create(logs, batch_size=batch_size)
+            log_count += len(logs)
+            _log(stdout, f"Created {offset + len(batch)}/{cases} cases")
+
+    # bulk_create не отправляет сигналы
+    reference_data.invalidate_stages()
+    reference_data.invalidate_employees()
+    return {
+        "employees": employees,
+        "stages": stages,
+        "transitions": len(transitions),
+        "cases": cases,
+        "case_stage_logs": log_count,
+        "last_stage": last_stage.pk,
+    }
+
+
+def dataset_summary():
+    return {
+        "employees": CustomUser.objects.count(),
+        "stages": Stage.objects.count(),
+        "transitions": NextStage.objects.count(),
+        "cases": Case.objects.count(),
+        "active_cases": Case.objects.filter(archived=False).count(),
+        "case_stage_logs": CaseStageLog.objects.count(),
+    }
+
+
+class BenchmarkContext:
+    """
+    Fixtures shared by the scenarios, resolved once before any timing starts.
+    """
+
+    def __init__(self):
+        self.first_stage = Stage.objects.get(stage_group=config.FIRST_STAGE_GROUP)
+        self.employee = (
+            CustomUser.objects.filter(is_active=True, barcode__isnull=False)
+            .order_by("pk")
+            .first()
+        )
+        self.manager = CustomUser.objects.filter(is_superuser=True).first()
+        if self.manager is None:
+            self.manager = CustomUser.objects.create_superuser(
+                MANAGER_EMAIL, None, role=CustomUser.MANAGER
+            )
+        self.active_case = (
+            Case.objects.filter(archived=False, is_returned=False)
+            .exclude(current_stage=self.first_stage)
+            .order_by("pk")
+            .first()
+        )
+        self.transition = (
+            NextStage.objects.filter(current=self.active_case.current_stage)
+            .select_related("next")
+            .first()
+            if self.active_case
+            else None
+        )
+        self.other_stage = (
+            Stage.objects.exclude(pk=self.first_stage.pk)
+            .exclude(pk=getattr(self.active_case, "current_stage_id", None))
+            .first()
+        )
+        self.client = Client()
+        self.manager_client = Client()
+        self.manager_client.force_login(self.manager)
+        self.counter = 0
+
+    def next_barcode(self):
+        self.counter += 1
+        return f"BENCH-NEW-{self.counter:08d}"
+
+
+@scenario("scan_create_case", mutates=True)
+def scan_create_case(ctx):
+    return ctx.client.post(
+        reverse("scan_barcodes"),
+        {
+            "employee_barcode": ctx.employee.barcode,
+            "case_barcode": ctx.next_barcode(),
+            "stage_barcode": ctx.first_stage.barcode,
+        },
+        content_type="application/json",
+    )
+
+
+@scenario("scan_return_case", mutates=True)
+def scan_return_case(ctx):
+    return ctx.client.post(
+        reverse("scan_barcodes"),
+        {
+            "employee_barcode": ctx.employee.barcode,
+            "case_barcode": ctx.active_case.barcode,
+            "stage_barcode": ctx.first_stage.barcode,
+            "reason": "defect",
+        },
+        content_type="application/json",
+    )
+
+
+@scenario("scan_rejected_transition", mutates=True)
+def scan_rejected_transition(ctx):
+    return ctx.client.post(
+        reverse("scan_barcodes"),
+        {
+            "employee_barcode": ctx.employee.barcode,
+            "case_barcode": ctx.active_case.barcode,
+            "stage_barcode": ctx.other_stage.barcode,
+        },
+        content_type="application/json",
+    )
+
+
+@scenario("board_case_list")
+def board_case_list(ctx):
+    return ctx.client.get(reverse("case_list"))
+
+
+@scenario("board_archived_cases")
+def board_archived_cases(ctx):
+    return ctx.client.get(reverse("archived_cases"))
+
+
+@scenario("board_returned_cases")
+def board_returned_cases(ctx):
+    return ctx.client.get(reverse("returned_cases"))
+
+
+@scenario("admin_processing_list")
+def admin_processing_list(ctx):
+    return ctx.manager_client.get(reverse("case_processing:"))
+
+
+@scenario("admin_processing_transition", mutates=True)
+def admin_processing_transition(ctx):
+    return ctx.manager_client.post(
+        reverse("case_processing:"),
+        {"case_id": ctx.active_case.pk, "transition": ctx.transition.next_id},
+    )
+
+
+@scenario("labels_generate_10k", mutates=True)
+def labels_generate_10k(ctx):
+    with open(os.devnull, "w") as target:
+        return write_label_sheets(case_labels(10_000), target)
+
+
+@scenario("task_check_and_update_case_priorities", mutates=True)
+def task_check_and_update_case_priorities(ctx):
+    with _eager_tasks():
+        return tasks.check_and_update_case_priorities()
+
+
+@scenario("task_delete_outdated_case_stage_logs", mutates=True)
+def task_delete_outdated_case_stage_logs(ctx):
+    with _eager_tasks():
+        return tasks.delete_outdated_case_stage_logs()
+
+
+@scenario("task_archive_completed_cases", mutates=True)
+def task_archive_completed_cases(ctx):
+    with _eager_tasks():
+        return tasks.archive_completed_cases()
+
+
+@scenario("task_backup_database", optional=True)
+def task_backup_database(ctx):
+    return tasks.backup_database()
+
+
+@scenario("task_verify_database_backup", optional=True)
+def task_verify_database_backup(ctx):
+    if not BackupRecord.objects.filter(kind=BackupRecord.FULL).exists():
+        tasks.backup_database()
+    return tasks.verify_database_backup()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _written_databases():
+    """
+    Aliases a scenario may write to: the primary and the lab databases (cases of
+    a lab with its own database, tasks that fan out to every lab). Replicas are
+    only read.
+    """
+    labs = set(settings.LAB_DATABASES.values()) - {DEFAULT_DB_ALIAS}
+    return [DEFAULT_DB_ALIAS, *sorted(labs)]
+
+
+def _run_once(func, ctx, mutates):
+    aliases = _written_databases()
+    with ExitStack() as stack:
+        for alias in aliases:
+            stack.enter_context(transaction.atomic(using=alias))
+        queries = [
+            stack.enter_context(CaptureQueriesContext(connections[alias]))
+            for alias in aliases
+        ]
+        started = time.perf_counter()
+        result = func(ctx)
+        elapsed = time.perf_counter() - started
+        if mutates:
+            for alias in aliases:
+                transaction.set_rollback(True, using=alias)
+    query_count = sum(len(captured) for captured in queries)
+    return elapsed * 1000, query_count, getattr(result, "status_code", None)
+
+
+def run_benchmarks(iterations=5, warmup=1, only=None, include_optional=False):
+    """
+    Run the registered scenarios against the current database and return a report.
+    """
+    names = [
+        name
+        for name, entry in SCENARIOS.items()
+        if (only is None or name in only)
+        and (include_optional or not entry["optional"])
+    ]
+
+    signals.request_started.disconnect(close_old_connections)
+    signals.request_finished.disconnect(close_old_connections)
+    try:
+        with override_settings(ALLOWED_HOSTS=["testserver", *settings.ALLOWED_HOSTS]):
+            ctx = BenchmarkContext()
+            results = {}
+            for name in names:
+                entry = SCENARIOS[name]
+                for _ in range(warmup):
+                    _run_once(entry["func"], ctx, entry["mutates"])
+                timings = []
+                query_counts = []
+                for _ in range(iterations):
+                    elapsed, query_count, status_code = _run_once(
+                        entry["func"], ctx, entry["mutates"]
+                    )
+                    timings.append(elapsed)
+                    query_counts.append(query_count)
+                results[name] = {
+                    "iterations": iterations,
+                    "status": status_code,
+                    "queries": max(query_counts),
+                    "min_ms": round(min(timings), 3),
+                    "median_ms": round(statistics.median(timings), 3),
+                    "p95_ms": round(percentile(timings, 0.95), 3),
+                    "max_ms": round(max(timings), 3),
+                }
+    finally:
+        signals.request_started.connect(close_old_connections)
+        signals.request_finished.connect(close_old_connections)
+
+    return {
+        "version": REPORT_VERSION,
+        "created_at": now().isoformat(),
+        "environment": {
+            "vendor": connection.vendor,
+            "django": django.get_version(),
+            "python": platform.python_version(),
+        },
+        "dataset": dataset_summary(),
+        "scenarios": results,
+    }
+
+
+def _timed_process(args):
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, *args],
+        cwd=settings.BASE_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    elapsed = (time.perf_counter() - started) * 1000
+    if completed.returncode:
+        raise RuntimeError(
+            f"{' '.join(args)} failed: {completed.stderr.decode(errors='replace')}"
+        )
+    return elapsed
+
+
+def run_startup_benchmarks(iterations=5, warmup=1, only=None):
+    """
+    Time the cold start of Django, a Celery worker (loading the task modules)
+    and short management commands, each in a fresh interpreter. The report has
+    the same format as ``run_benchmarks``, so it can be compared with a baseline.
+    """
+    results = {}
+    for name, args in STARTUP_COMMANDS.items():
+        if only is not None and name not in only:
+            continue
+        for _ in range(warmup):
+            _timed_process(args)
+        timings = [_timed_process(args) for _ in range(iterations)]
+        results[name] = {
+            "iterations": iterations,
+            "status": 0,
+            "queries": 0,
+            "min_ms": round(min(timings), 3),
+            "median_ms": round(statistics.median(timings), 3),
+            "p95_ms": round(percentile(timings, 0.95), 3),
+            "max_ms": round(max(timings), 3),
+        }
+    return {
+        "version": REPORT_VERSION,
+        "created_at": now().isoformat(),
+        "environment": {
+            "vendor": connection.vendor,
+            "django": django.get_version(),
+            "python": platform.python_version(),
+        },
+        "dataset": None,
+        "scenarios": results,
+    }
+
+
+def compare_reports(report, baseline, tolerance=0.25):
+    """
+    Compare a report against a stored baseline and return a list of regressions:
+    a scenario regresses when its median time grows by more than ``tolerance``
+    or when it issues more queries than before.
+    """
+    regressions = []
+    for name, result in report["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        if result["queries"] > previous["queries"]:
+            regressions.append(
+                f"{name}: queries {previous['queries']} -> {result['queries']}"
+            )
+        if result["median_ms"] > previous["median_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: median {previous['median_ms']}ms -> {result['median_ms']}ms"
+            )
+    return regressions
+
+
+def write_report(report, path):
+    with open(path, "w") as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+
+
+def load_report(path):
+    with open(path) as fp:
+        return json.load(fp)
@@ -0,0 +1,84 @@
+"""
+Process-local snapshot of the constance settings.
+
+With the database backend every ``config.X`` access is a query. The hot paths
+(scans, periodic tasks) read a snapshot instead: all values are loaded with one
+query, and the stages named by FIRST_STAGE_GROUP / LAST_STAGE_GROUP are resolved
+at most once per snapshot and lab. A snapshot is replaced when constance reports a change
+in this process, when a Stage changes, or after CONSTANCE_SNAPSHOT_TTL seconds
+(which bounds staleness for changes made by other processes).
+"""
+
+import threading
+import time
+
+from constance.utils import get_values
+from django.conf import settings
+
+from .models import Stage
+from .routers import current_lab
+
+_lock = threading.Lock()
+_version = 0
+_snapshot = None
+
+
+def snapshot_ttl():
+    return getattr(settings, "CONSTANCE_SNAPSHOT_TTL", 30)
+
+
+class ConfigSnapshot:
+    def __init__(self, version):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.values = get_values()
+        self._stages = {}
+
+    def __getattr__(self, key):
+        try:
+            return self.__dict__["values"][key]
+        except KeyError as e:
+            raise AttributeError(key) from e
+
+    def is_stale(self):
+        return (
+            self.version != _version
+            or time.monotonic() - self.loaded_at > snapshot_ttl()
+        )
+
+    def stage_for_group(self, stage_group):
+        key = (current_lab(), stage_group)
+        if key not in self._stages:
+            self._stages[key] = Stage.objects.get(lab=key[0], stage_group=stage_group)
+        return self._stages[key]
+
+    @property
+    def first_stage(self):
+        return self.stage_for_group(self.FIRST_STAGE_GROUP)
+
+    @property
+    def last_stage(self):
+        return self.stage_for_group(self.LAST_STAGE_GROUP)
+
+
+def get_config():
+    """
+    Return the current snapshot, loading a new one if it is missing or stale.
+    """
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is None or snapshot.is_stale():
+        with _lock:
+            if _snapshot is None or _snapshot.is_stale():
+                _snapshot = ConfigSnapshot(_version)
+            snapshot = _snapshot
+    return snapshot
+
+
+def invalidate(**kwargs):
+    """
+    Bump the version so the next get_config() call loads a fresh snapshot.
+    """
+    global _version
+    with _lock:
+        _version += 1
@@ -1,4 +1,5 @@
-from core.models import CustomUser, Stage
+from core import reference_data
+from core.models import CustomUser
 from django import forms
 from django.contrib.auth.forms import AuthenticationForm
 
@@ -46,10 +47,7 @@ class EmployeeBarcodeAssignForm(forms.Form):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields["employee_id"].choices = [
-            (employee.id, employee.get_full_name())
-            for employee in CustomUser.objects.all().order_by("last_name", "first_name")
-        ]
+        self.fields["employee_id"].choices = reference_data.employee_choices()
 
 
 class StageBarcodeAssignForm(forms.Form):
@@ -65,7 +63,13 @@ class StageBarcodeAssignForm(forms.Form):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields["stage_id"].choices = [
-            (stage.id, stage.display_name)
-            for stage in Stage.objects.all().order_by("name")
-        ]
+        self.fields["stage_id"].choices = reference_data.stage_choices()
+
+
+class ProfilingSettingsForm(forms.Form):
+    request_rate = forms.FloatField(
+        label="Requests to profile (fraction)", min_value=0, max_value=1
+    )
+    task_rate = forms.FloatField(
+        label="Task runs to profile (fraction)", min_value=0, max_value=1
+    )
@@ -0,0 +1,86 @@
+"""
+The case board as it was at a past moment, rebuilt from the stage logs.
+
+A case was on a stage at ``at`` if the log of that stage covers ``at``:
+``start_time <= at < end_time``, or the log is still open. Archiving a case
+closes its open log, so an archived case is on no stage after archived_at. On PostgreSQL the
+logs are looked up by containment in ``tstzrange(start_time, end_time)``. That
+expression has a GiST index (migration 0013), so a lookup walks only the
+intervals around ``at`` instead of every log started before it. Other databases
+compare the two columns.
+
+Only retained logs can be rebuilt: delete_outdated_case_stage_logs removes logs
+older than CASE_STAGE_LOG_EXPIRES_AFTER.
+"""
+
+from django.db import connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+from . import reference_data
+from .models import CaseStageLog
+from .routers import current_lab
+
+INTERVAL_INDEX = "log_interval_gist_idx"
+# Выражение должно совпадать с выражением индекса INTERVAL_INDEX
+INTERVAL_CONTAINS = (
+    "tstzrange(core_casestagelog.start_time, core_casestagelog.end_time, '[)')"
+    " @> %s::timestamptz"
+)
+
+
+def logs_at(at):
+    """
+    Stage logs of the current lab that were open at ``at``: one per case that
+    existed then.
+    """
+    logs = CaseStageLog.objects.filter(lab=current_lab())
+    if connections[logs.db].vendor == "postgresql":
+        return logs.filter(
+            RawSQL(INTERVAL_CONTAINS, (at,), output_field=BooleanField())
+        )
+    return logs.filter(start_time__lte=at).exclude(end_time__lte=at)
+
+
+def board_at(at):
+    """
+    Return the stages occupied at ``at``, ordered by name, as
+    ``{"stage", "display_name", "cases"}``. Cases are ordered by the time they
+    entered the stage and carry their number, who scanned them in and how long
+    they had been on the stage by then.
+    """
+    logs = logs_at(at).values_list(
+        "case_id",
+        "case__case_number",
+        "stage__name",
+        "stage__display_name",
+        "user_id",
+        "start_time",
+        "is_returned",
+    )
+    # Сотрудники хранятся на основной базе, а не в базе лаборатории
+    employees = {pk: full_name for pk, full_name, _ in reference_data.employees()}
+    stages = {}
+    for (
+        case_id,
+        case_number,
+        name,
+        display_name,
+        user_id,
+        start_time,
+        is_returned,
+    ) in logs.order_by("stage__name", "start_time", "case_id"):
+        stage = stages.setdefault(
+            name, {"stage": name, "display_name": display_name, "cases": []}
+        )
+        stage["cases"].append(
+            {
+                "id": case_id,
+                "case_number": case_number,
+                "user": employees.get(user_id),
+                "since": start_time,
+                "on_stage": at - start_time,
+                "is_returned": is_returned,
+            }
+        )
+    return list(stages.values())
@@ -0,0 +1,141 @@
+"""
+Generated barcodes and label sheets.
+
+Barcodes are ``<prefix><number>`` with a fixed-width number taken from a
+BarcodeSequence. ``allocate_barcodes`` reserves a whole range with one locked
+update instead of checking every code for uniqueness; the first allocation for a
+prefix starts after the largest matching barcode already in the table. Sheets
+are rendered by core.barcodes on a process pool and written page by page, so a
+batch of any size is streamed to the output file.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import transaction
+
+from . import barcodes, reference_data
+from .models import BarcodeSequence, Case, CustomUser, Stage
+
+DIGITS = 10
+PAGES_PER_TASK = 10
+KINDS = {
+    "case": ("CS", Case),
+    "stage": ("ST", Stage),
+    "employee": ("EM", CustomUser),
+}
+
+
+def _pattern(prefix):
+    return rf"^{prefix}[0-9]{{{DIGITS}}}$"
+
+
+def format_barcode(prefix, number):
+    return f"{prefix}{number:0{DIGITS}d}"
+
+
+def _sequence(kind):
+    prefix, model = KINDS[kind]
+    sequence = BarcodeSequence.objects.filter(prefix=prefix).first()
+    if sequence is not None:
+        return sequence
+    # Штрихкоды с тем же форматом могли быть введены вручную
+    largest = (
+        model.objects.filter(barcode__regex=_pattern(prefix))
+        .order_by("-barcode")
+        .values_list("barcode", flat=True)
+        .first()
+    )
+    sequence, _ = BarcodeSequence.objects.get_or_create(
+        prefix=prefix,
+        defaults={"last_value": int(largest[len(prefix) :]) if largest else 0},
+    )
+    return sequence
+
+
+def allocate_barcodes(kind, count):
+    """
+    Reserve ``count`` new barcodes for ``kind`` (case, stage or employee) and
+    return them as a range of numbers: format them with ``format_barcode``.
+    """
+    if count < 1:
+        raise ValueError("count must be positive")
+    sequence = _sequence(kind)
+    with transaction.atomic():
+        sequence = BarcodeSequence.objects.select_for_update().get(pk=sequence.pk)
+        start = sequence.last_value + 1
+        sequence.last_value += count
+        sequence.save(update_fields=["last_value", "updated_at"])
+    return range(start, start + count)
+
+
+def case_labels(count):
+    """
+    Allocate barcodes for ``count`` new cases. The cases themselves are created
+    when a label is first scanned.
+    """
+    prefix = KINDS["case"][0]
+    return (
+        (format_barcode(prefix, number), "")
+        for number in allocate_barcodes("case", count)
+    )
+
+
+def assign_missing_barcodes(kind):
+    """
+    Give a generated barcode to every stage or employee without one and return
+    their labels.
+    """
+    prefix, model = KINDS[kind]
+    objects = list(model.objects.filter(barcode__isnull=True).order_by("pk"))
+    if not objects:
+        return []
+    for obj, number in zip(objects, allocate_barcodes(kind, len(objects))):
+        obj.barcode = format_barcode(prefix, number)
+    # bulk_update обходит сигналы, поэтому справочники сбрасываем сами
+    model.objects.bulk_update(objects, ["barcode"], batch_size=1000)
+    if model is Stage:
+        reference_data.invalidate_stages()
+        return [(stage.barcode, stage.display_name) for stage in objects]
+    reference_data.invalidate_employees()
+    return [(employee.barcode, employee.full_name) for employee in objects]
+
+
+def _tasks(labels, size):
+    batch = []
+    for label in labels:
+        batch.append(label)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_label_sheets(labels, target, workers=None):
+    """
+    Render an iterable of ``(barcode, caption)`` as HTML label sheets into the
+    text file ``target``. Pages are rendered on ``workers`` processes and written
+    in order, keeping only a few batches in memory. Returns the number of labels.
+    """
+    workers = workers or os.cpu_count() or 1
+    size = PAGES_PER_TASK * barcodes.LABELS_PER_PAGE
+    written = 0
+    target.write(barcodes.SHEET_HEADER)
+    if workers == 1:
+        for batch in _tasks(labels, size):
+            target.write(barcodes.render_pages(batch))
+            written += len(batch)
+    else:
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for batch in _tasks(labels, size):
+                written += len(batch)
+                pending.append(pool.submit(barcodes.render_pages, batch))
+                if len(pending) >= workers * 2:
+                    target.write(pending.popleft().result())
+            while pending:
+                target.write(pending.popleft().result())
+    target.write(barcodes.SHEET_FOOTER)
+    return written
@@ -0,0 +1,99 @@
+"""
+Labs and cross-lab queries.
+
+Cases, stages and their logs are scoped to a lab and routed to its database by
+core.routers. A query that covers several labs is fanned out: ``fan_out_labs``
+runs it once per lab, in parallel threads, each working in its own lab (and so
+on its own database connection), and the results are merged by the caller.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, Q
+
+from .models import Case, Lab
+from .routers import current_lab, lab_database, using_lab
+
+
+def lab_codes():
+    """
+    Codes of the default lab, the labs with their own database and the labs
+    registered in the admin.
+    """
+    return sorted(
+        {
+            settings.DEFAULT_LAB,
+            *settings.LAB_DATABASES,
+            *Lab.objects.values_list("code", flat=True),
+        }
+    )
+
+
+def _in_lab(func, lab):
+    with using_lab(lab):
+        try:
+            return func()
+        finally:
+            # Потоки пула не переиспользуют соединения Django
+            connections.close_all()
+
+
+def fan_out_labs(func, labs=None, max_workers=None):
+    """
+    Run ``func()`` in every lab and return ``{lab: result}``. Labs run in
+    parallel threads; a single lab, or ``max_workers=1``, runs in place.
+    """
+    labs = lab_codes() if labs is None else list(labs)
+    if len(labs) <= 1 or max_workers == 1:
+        results = {}
+        for lab in labs:
+            with using_lab(lab):
+                results[lab] = func()
+        return results
+    with ThreadPoolExecutor(max_workers=max_workers or len(labs)) as pool:
+        futures = {lab: pool.submit(_in_lab, func, lab) for lab in labs}
+        return {lab: future.result() for lab, future in futures.items()}
+
+
+def lab_summary():
+    """
+    Case counts of the current lab, overall and per current stage.
+    """
+    cases = Case.objects.filter(lab=current_lab())
+    totals = cases.aggregate(
+        active=Count("pk", filter=Q(archived=False, is_returned=False)),
+        urgent=Count("pk", filter=Q(archived=False, priority="urgent")),
+        returned=Count("pk", filter=Q(archived=False, is_returned=True)),
+        archived=Count("pk", filter=Q(archived=True)),
+    )
+    totals["stages"] = dict(
+        cases.filter(archived=False)
+        .values_list("current_stage__name")
+        .annotate(count=Count("pk"))
+        .order_by()
+    )
+    return totals
+
+
+def cross_lab_report(labs=None, max_workers=None):
+    """
+    ``lab_summary`` of every lab, queried in parallel, with the merged totals.
+    """
+    per_lab = fan_out_labs(lab_summary, labs, max_workers)
+    total = {"active": 0, "urgent": 0, "returned": 0, "archived": 0, "stages": {}}
+    for summary in per_lab.values():
+        for key, value in summary.items():
+            if key == "stages":
+                for stage, count in value.items():
+                    total["stages"][stage] = total["stages"].get(stage, 0) + count
+            else:
+                total[key] += value
+    return {
+        "labs": {
+            lab: {"database": lab_database(lab), **summary}
+            for lab, summary in per_lab.items()
+        },
+        "total": total,
+    }
@@ -0,0 +1,333 @@
+"""
+Scan-station load simulator.
+
+Every simulated station is a thread with its own keep-alive HTTP connection to a
+running server. It scans like a real station: an employee badge, then a case and
+a stage. Most scans create new cases on the first stage. Some scans return an
+active case whose current stage has a return transition (a NextStage to the
+first stage). A few are mis-scans onto a later stage, which the API rejects.
+Optionally every field is pre-validated first, as the scan page does.
+
+``run_capacity_test`` runs the simulation at growing numbers of stations and
+reports throughput, latency percentiles, error rates and, when the server has
+QUERY_COUNT_HEADER enabled, the database queries per request. Together these
+form a capacity curve.
+"""
+
+import http.client
+import json
+import random
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode, urlsplit
+
+from django.db.models import Exists, OuterRef
+from django.urls import reverse
+from django.utils.timezone import now
+
+from .benchmark import percentile
+from .config_snapshot import get_config
+from .middleware import QUERY_COUNT_HEADER
+from .models import Case, CustomUser, NextStage, ReturnReason, Stage
+
+REPORT_VERSION = 1
+RETURN_POOL_SIZE = 10_000
+
+
+class Workload:
+    """
+    The barcodes stations scan, read from the database once before the run.
+    Cases returned during the run leave the pool: they are on the first stage.
+    """
+
+    def __init__(self, return_ratio=0.1, mistake_ratio=0.02):
+        first_stage = get_config().first_stage
+        self.first_stage = first_stage.barcode
+        self.return_ratio = return_ratio
+        self.mistake_ratio = mistake_ratio
+        self.employees = list(
+            CustomUser.objects.filter(is_active=True, barcode__isnull=False)
+            .order_by("pk")
+            .values_list("barcode", flat=True)[:1000]
+        )
+        if not self.employees:
+            raise ValueError("There are no active employees with a barcode")
+        self.later_stages = list(
+            Stage.objects.filter(lab=first_stage.lab, barcode__isnull=False)
+            .exclude(pk=first_stage.pk)
+            .values_list("barcode", flat=True)
+        )
+        self.reasons = sorted(
+            set(
+                ReturnReason.objects.exclude(reason="other").values_list(
+                    "reason", flat=True
+                )
+            )
+        )
+        return_transition = NextStage.objects.filter(
+            current=OuterRef("current_stage"), next=first_stage
+        )
+        self.returnable = list(
+            Case.objects.filter(
+                lab=first_stage.lab, archived=False, barcode__isnull=False
+            )
+            .exclude(current_stage=first_stage)
+            .filter(Exists(return_transition))
+            .order_by("pk")
+            .values_list("barcode", flat=True)[:RETURN_POOL_SIZE]
+        )
+        self.run_id = f"{int(time.time()):x}"
+        self._lock = threading.Lock()
+
+    def _take_returnable(self, rng):
+        with self._lock:
+            if not self.returnable:
+                return None
+            index = rng.randrange(len(self.returnable))
+            self.returnable[index], self.returnable[-1] = (
+                self.returnable[-1],
+                self.returnable[index],
+            )
+            return self.returnable.pop()
+
+    def next_scan(self, rng, employee, station, number):
+        """
+        Return ``(kind, payload)`` of the next scan of a station.
+        """
+        draw = rng.random()
+        if draw < self.mistake_ratio and self.later_stages:
+            with self._lock:
+                case = rng.choice(self.returnable) if self.returnable else None
+            if case is not None:
+                return "mistake", {
+                    "employee_barcode": employee,
+                    "case_barcode": case,
+                    "stage_barcode": rng.choice(self.later_stages),
+                }
+        if draw < self.mistake_ratio + self.return_ratio:
+            case = self._take_returnable(rng)
+            if case is not None:
+                payload = {
+                    "employee_barcode": employee,
+                    "case_barcode": case,
+                    "stage_barcode": self.first_stage,
+                }
+                if self.reasons:
+                    payload["reason"] = rng.choice(self.reasons)
+                else:
+                    payload["custom_reason"] = "Load simulation"
+                return "return", payload
+        return "create", {
+            "employee_barcode": employee,
+            "case_barcode": f"SIM{self.run_id}-{station}-{number}",
+            "stage_barcode": self.first_stage,
+        }
+
+
+class StationClient:
+    """
+    One keep-alive connection of a simulated station.
+    """
+
+    def __init__(self, base_url, token=None, timeout=30):
+        parts = urlsplit(base_url)
+        connection_class = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.connection = connection_class(parts.netloc, timeout=timeout)
+        self.prefix = parts.path.rstrip("/")
+        self.headers = {"Content-Type": "application/json"}
+        if token:
+            self.headers["Authorization"] = f"Station {token}"
+
+    def request(self, method, path, body=None):
+        """
+        Return ``(status, latency_ms, queries)``; status is None if the request
+        failed, queries is None if the server does not report them.
+        """
+        started = time.perf_counter()
+        try:
+            self.connection.request(
+                method,
+                self.prefix + path,
+                body=json.dumps(body) if body is not None else None,
+                headers=self.headers,
+            )
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return None, (time.perf_counter() - started) * 1000, None
+        queries = response.getheader(QUERY_COUNT_HEADER)
+        return (
+            response.status,
+            (time.perf_counter() - started) * 1000,
+            int(queries) if queries is not None else None,
+        )
+
+    def close(self):
+        self.connection.close()
+
+
+def _station(index, client, workload, deadline, options, samples):
+    rng = random.Random(options["seed"] * 100_003 + index)
+    employee = rng.choice(workload.employees)
+    scan_url = reverse("scan_barcodes")
+    validate_url = reverse("validate_barcode")
+    number = 0
+    while time.monotonic() < deadline:
+        number += 1
+        kind, payload = workload.next_scan(rng, employee, index, number)
+        if options["validate"]:
+            for field, params in (
+                ("employee", {}),
+                ("case", {}),
+                ("stage", {"case": payload["case_barcode"]}),
+            ):
+                query = urlencode(
+                    {"field": field, "barcode": payload[f"{field}_barcode"], **params}
+                )
+                samples.append(
+                    ("validate",) + client.request("GET", f"{validate_url}?{query}")
+                )
+        samples.append((kind,) + client.request("POST", scan_url, payload))
+        if options["think_ms"]:
+            time.sleep(rng.uniform(0.5, 1.5) * options["think_ms"] / 1000)
+
+
+def _outcome(kind, status):
+    if status is None or status >= 500:
+        return "errors"
+    if status == 409:
+        return "conflicts"
+    if status >= 400:
+        # Ошибочный скан должен быть отклонён, остальные 4xx - ошибки
+        return "rejected" if kind == "mistake" else "errors"
+    return "errors" if kind == "mistake" else "ok"
+
+
+def summarize(stations, samples, elapsed):
+    """
+    Aggregate ``(kind, status, latency_ms, queries)`` samples of one level.
+    """
+    latencies = [sample[2] for sample in samples]
+    outcomes = Counter(_outcome(sample[0], sample[1]) for sample in samples)
+    queries = [sample[3] for sample in samples if sample[3] is not None]
+    total = len(samples)
+    summary = {
+        "stations": stations,
+        "requests": total,
+        "scans": sum(1 for sample in samples if sample[0] != "validate"),
+        "kinds": dict(Counter(sample[0] for sample in samples)),
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0,
+        "ok": outcomes["ok"],
+        "rejected": outcomes["rejected"],
+        "conflicts": outcomes["conflicts"],
+        "errors": outcomes["errors"],
+        "error_rate": round(outcomes["errors"] / total, 4) if total else 0,
+        "queries_mean": round(sum(queries) / len(queries), 1) if queries else None,
+        "queries_max": max(queries) if queries else None,
+    }
+    for name, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+        summary[name] = round(percentile(latencies, fraction), 3) if total else None
+    summary["max_ms"] = round(max(latencies), 3) if total else None
+    return summary
+
+
+def run_level(base_url, stations, duration, workload, token=None, **options):
+    """
+    Run ``stations`` simulated stations for ``duration`` seconds.
+    """
+    options = {"seed": 0, "validate": False, "think_ms": 0, **options}
+    samples = []
+    clients = [StationClient(base_url, token) for _ in range(stations)]
+    started = time.monotonic()
+    deadline = started + duration
+    threads = [
+        threading.Thread(
+            target=_station,
+            args=(index, client, workload, deadline, options, samples),
+            daemon=True,
+        )
+        for index, client in enumerate(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    for client in clients:
+        client.close()
+    return summarize(stations, samples, elapsed)
+
+
+def capacity(levels, max_p95_ms, max_error_rate):
+    """
+    The largest number of stations whose level met both limits, with its
+    throughput, or None if no level did.
+    """
+    passing = [
+        level
+        for level in levels
+        if level["requests"]
+        and level["p95_ms"] <= max_p95_ms
+        and level["error_rate"] <= max_error_rate
+    ]
+    if not passing:
+        return None
+    best = max(passing, key=lambda level: level["stations"])
+    return {"stations": best["stations"], "throughput_rps": best["throughput_rps"]}
+
+
+def run_capacity_test(
+    base_url,
+    station_levels,
+    duration,
+    token=None,
+    max_p95_ms=500,
+    max_error_rate=0.01,
+    return_ratio=0.1,
+    mistake_ratio=0.02,
+    stdout=None,
+    **options,
+):
+    """
+    Run one level per entry of ``station_levels`` and return the report.
+    """
+    workload = Workload(return_ratio=return_ratio, mistake_ratio=mistake_ratio)
+    levels = []
+    for stations in station_levels:
+        level = run_level(base_url, stations, duration, workload, token, **options)
+        levels.append(level)
+        if stdout is not None:
+            stdout.write(format_level(level))
+    return {
+        "version": REPORT_VERSION,
+        "created_at": now().isoformat(),
+        "target": base_url,
+        "settings": {
+            "duration_s": duration,
+            "return_ratio": return_ratio,
+            "mistake_ratio": mistake_ratio,
+            "max_p95_ms": max_p95_ms,
+            "max_error_rate": max_error_rate,
+            **options,
+        },
+        "levels": levels,
+        "capacity": capacity(levels, max_p95_ms, max_error_rate),
+    }
+
+
+def format_level(level):
+    queries = "-" if level["queries_mean"] is None else level["queries_mean"]
+    return (
+        f"{level['stations']:>4} stations: {level['throughput_rps']:>8} req/s, "
+        f"p50 {level['p50_ms']} ms, p95 {level['p95_ms']} ms, "
+        f"p99 {level['p99_ms']} ms, errors {level['error_rate']:.2%}, "
+        f"rejected {level['rejected']}, conflicts {level['conflicts']}, "
+        f"queries/request {queries}"
+    )
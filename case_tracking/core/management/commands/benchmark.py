@@ -0,0 +1,114 @@
+from core.benchmark import (
+    SCALES,
+    SCENARIOS,
+    compare_reports,
+    dataset_summary,
+    generate_dataset,
+    load_report,
+    run_benchmarks,
+    run_startup_benchmarks,
+    write_report,
+)
+from core.models import Case
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a synthetic lab in a throwaway test database, run the timed "
+        "benchmark scenarios and write a JSON report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+        parser.add_argument("--employees", type=int)
+        parser.add_argument("--stages", type=int)
+        parser.add_argument("--cases", type=int)
+        parser.add_argument("--logs-per-case", type=int)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--iterations", type=int, default=5)
+        parser.add_argument("--warmup", type=int, default=1)
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            choices=sorted(SCENARIOS),
+            help="Run only the given scenario (may be repeated).",
+        )
+        parser.add_argument(
+            "--include-backup",
+            action="store_true",
+            help="Also run the backup_database task.",
+        )
+        parser.add_argument(
+            "--startup",
+            action="store_true",
+            help="Only time the cold start of Django, a Celery worker and "
+            "management commands; no database is created.",
+        )
+        parser.add_argument(
+            "--keepdb",
+            action="store_true",
+            help="Keep the benchmark database and its data between runs.",
+        )
+        parser.add_argument("--output", default="benchmark-report.json")
+        parser.add_argument("--baseline", help="Report to compare the results with.")
+        parser.add_argument("--tolerance", type=float, default=0.25)
+
+    def handle(self, *args, **options):
+        if options["startup"]:
+            report = run_startup_benchmarks(
+                iterations=options["iterations"], warmup=options["warmup"]
+            )
+        else:
+            report = self.run_dataset_benchmarks(options)
+
+        write_report(report, options["output"])
+        for name, result in report["scenarios"].items():
+            self.stdout.write(
+                f"{name:45} {result['median_ms']:>10.2f} ms  "
+                f"p95 {result['p95_ms']:>10.2f} ms  {result['queries']:>6} queries"
+            )
+        self.stdout.write(f"Report written to {options['output']}")
+
+        if options["baseline"]:
+            regressions = compare_reports(
+                report, load_report(options["baseline"]), options["tolerance"]
+            )
+            if regressions:
+                raise CommandError(
+                    "Performance regressions:\n" + "\n".join(regressions)
+                )
+            self.stdout.write(self.style.SUCCESS("No regressions against baseline"))
+
+    def run_dataset_benchmarks(self, options):
+        spec = dict(SCALES[options["scale"]])
+        for key in spec:
+            if options.get(key) is not None:
+                spec[key] = options[key]
+
+        verbosity = options["verbosity"]
+        keepdb = options["keepdb"]
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(
+            verbosity=verbosity, autoclobber=True, serialize=False, keepdb=keepdb
+        )
+        try:
+            if Case.objects.exists():
+                self.stdout.write("Reusing the existing benchmark dataset")
+            else:
+                generate_dataset(
+                    seed=options["seed"],
+                    stdout=self.stdout if verbosity > 1 else None,
+                    **spec,
+                )
+            self.stdout.write(f"Dataset: {dataset_summary()}")
+
+            return run_benchmarks(
+                iterations=options["iterations"],
+                warmup=options["warmup"],
+                only=options["scenario"],
+                include_optional=options["include_backup"],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity, keepdb)
@@ -0,0 +1,37 @@
+import json
+
+from core.labs import cross_lab_report
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Case counts of every lab, queried in parallel, with the merged totals."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lab", action="append", dest="labs", help="Only this lab (repeatable)."
+        )
+        parser.add_argument("--workers", type=int, default=None)
+        parser.add_argument("--json", action="store_true", help="Print JSON.")
+
+    def handle(self, *args, labs, workers, **options):
+        report = cross_lab_report(labs, max_workers=workers)
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+            return
+
+        rows = [
+            (f"{lab} ({summary['database']})", summary)
+            for lab, summary in report["labs"].items()
+        ]
+        rows.append(("total", report["total"]))
+        for name, summary in rows:
+            stages = ", ".join(
+                f"{stage}: {count}"
+                for stage, count in sorted(summary["stages"].items())
+            )
+            self.stdout.write(
+                f"{name}: {summary['active']} active, {summary['urgent']} urgent, "
+                f"{summary['returned']} returned, {summary['archived']} archived"
+                + (f" [{stages}]" if stages else "")
+            )
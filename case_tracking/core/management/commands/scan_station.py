@@ -0,0 +1,31 @@
+from core.models import ScanStation
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Create a scan station or issue a new token for an existing one. The "
+        "token is printed once and is not stored."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("name")
+        parser.add_argument(
+            "--rotate",
+            action="store_true",
+            help="Replace the token of an existing station.",
+        )
+
+    def handle(self, *args, name, rotate, **options):
+        station = ScanStation.objects.filter(name=name).first()
+        if station is None:
+            station = ScanStation(name=name)
+        elif not rotate:
+            raise CommandError(
+                f"Station {name} already exists, use --rotate to replace its token"
+            )
+
+        token = station.set_new_token()
+        station.save()
+        self.stdout.write(f"Station: {station.name}")
+        self.stdout.write(f"Token: {token}")
@@ -0,0 +1,98 @@
+from core.benchmark import write_report
+from core.load_simulation import run_capacity_test
+from core.models import ScanStation
+from django.core.management.base import BaseCommand, CommandError
+
+SIMULATOR_STATION = "Load simulator"
+
+
+def station_levels(value):
+    try:
+        levels = sorted({int(level) for level in value.split(",")})
+    except ValueError as e:
+        raise CommandError(f"Invalid --stations value: {value}") from e
+    if not levels or levels[0] < 1:
+        raise CommandError("--stations must list positive numbers")
+    return levels
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate scan stations against a running server (which must use this "
+        "database) at growing concurrency and write a capacity report. Start the "
+        "server with QUERY_COUNT_HEADER=True to include query counts. Creates "
+        "real cases and returns: run it against a test deployment."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000")
+        parser.add_argument(
+            "--stations",
+            default="1,2,4,8,16,32",
+            help="Comma-separated numbers of concurrent stations, one level each.",
+        )
+        parser.add_argument(
+            "--duration", type=float, default=10, help="Seconds per level."
+        )
+        parser.add_argument(
+            "--token",
+            help=f"Station token; by default the '{SIMULATOR_STATION}' station "
+            "is created or gets a new token.",
+        )
+        parser.add_argument("--return-ratio", type=float, default=0.1)
+        parser.add_argument("--mistake-ratio", type=float, default=0.02)
+        parser.add_argument(
+            "--validate",
+            action="store_true",
+            help="Pre-validate every field before the scan, like the scan page.",
+        )
+        parser.add_argument(
+            "--think-ms", type=int, default=0, help="Average pause between scans."
+        )
+        parser.add_argument("--max-p95-ms", type=float, default=500)
+        parser.add_argument("--max-error-rate", type=float, default=0.01)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", default="capacity-report.json")
+
+    def handle(self, *args, **options):
+        token = options["token"]
+        if not token:
+            station = ScanStation.objects.filter(name=SIMULATOR_STATION).first()
+            station = station or ScanStation(name=SIMULATOR_STATION)
+            token = station.set_new_token()
+            station.is_active = True
+            station.save()
+
+        try:
+            report = run_capacity_test(
+                options["url"],
+                station_levels(options["stations"]),
+                options["duration"],
+                token=token,
+                max_p95_ms=options["max_p95_ms"],
+                max_error_rate=options["max_error_rate"],
+                return_ratio=options["return_ratio"],
+                mistake_ratio=options["mistake_ratio"],
+                stdout=self.stdout,
+                seed=options["seed"],
+                validate=options["validate"],
+                think_ms=options["think_ms"],
+            )
+        except ValueError as e:
+            raise CommandError(str(e)) from e
+
+        write_report(report, options["output"])
+        if report["capacity"] is None:
+            self.stdout.write(
+                self.style.WARNING(
+                    "No level stayed within the latency and error limits"
+                )
+            )
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Capacity: {report['capacity']['stations']} stations, "
+                    f"{report['capacity']['throughput_rps']} req/s"
+                )
+            )
+        self.stdout.write(f"Report written to {options['output']}")
@@ -0,0 +1,54 @@
+from core.models import SlowQuery
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+ORDERINGS = {
+    "total": "-total_time",
+    "max": "-max_time",
+    "count": "-count",
+    "mean": "-mean",
+}
+
+
+class Command(BaseCommand):
+    help = "List the slowest queries recorded by the slow-query log, by fingerprint."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument("--order", choices=sorted(ORDERINGS), default="total")
+        parser.add_argument(
+            "--explain", action="store_true", help="Show the captured plans."
+        )
+        parser.add_argument(
+            "--reset", action="store_true", help="Delete the recorded queries."
+        )
+
+    def handle(self, *args, limit, order, explain, reset, **options):
+        if reset:
+            deleted, _ = SlowQuery.objects.all().delete()
+            self.stdout.write(f"Deleted {deleted} slow queries")
+            return
+
+        queries = SlowQuery.objects.annotate(
+            mean=F("total_time") / F("count")
+        ).order_by(ORDERINGS[order])[:limit]
+        if not queries:
+            self.stdout.write("No slow queries recorded")
+            return
+
+        for query in queries:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"{query.fingerprint[:12]}  {query.count} runs, "
+                    f"total {query.total_time:.2f}s, mean {query.mean_time * 1000:.1f}ms, "
+                    f"max {query.max_time * 1000:.1f}ms, {query.database}"
+                )
+            )
+            self.stdout.write(
+                f"  at {query.call_site or '-'}, last {query.last_seen:%Y-%m-%d %H:%M}"
+            )
+            self.stdout.write(f"  {query.normalized_sql[:500]}")
+            if explain and query.explain:
+                for line in query.explain.splitlines():
+                    self.stdout.write(f"    {line}")
+            self.stdout.write("")
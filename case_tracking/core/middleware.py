@@ -0,0 +1,108 @@
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from .models import ProfileRecord
+from .profiling import Profiler, request_sample_rate, sampled
+from .routers import pinned_to_primary, using_lab
+
+PRIMARY_PIN_COOKIE = "primary_pin"
+QUERY_COUNT_HEADER = "X-Query-Count"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
+
+
+class PrimaryStickinessMiddleware:
+    """
+    Read-your-writes for replica reads: after a successful write request (e.g. a
+    scan) the client gets a short-lived cookie, and while it is present all its
+    reads go to the primary instead of a possibly lagging replica.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with pinned_to_primary(PRIMARY_PIN_COOKIE in request.COOKIES):
+            response = self.get_response(request)
+
+        if (
+            settings.DATABASE_REPLICAS
+            and request.method not in SAFE_METHODS
+            and response.status_code < 400
+        ):
+            response.set_cookie(
+                PRIMARY_PIN_COOKIE,
+                "1",
+                max_age=settings.DATABASE_REPLICA_STICKINESS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
+
+
+class LabMiddleware:
+    """
+    Work in the lab of the request user (or scan station). The user is only
+    loaded when a lab-scoped query needs the lab; API views authenticate later,
+    so the lab is resolved lazily from the final request user.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with using_lab(lambda: getattr(request.user, "lab", "")):
+            return self.get_response(request)
+
+
+class QueryCountMiddleware:
+    """
+    With QUERY_COUNT_HEADER enabled, report the number of database queries made
+    for a request in the X-Query-Count response header (used by the station
+    load simulator to measure a running server).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.QUERY_COUNT_HEADER:
+            return self.get_response(request)
+
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(count))
+            response = self.get_response(request)
+        response[QUERY_COUNT_HEADER] = str(queries)
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profile a sample of requests (PROFILING_SAMPLE_RATE, see core.profiling).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not sampled(request_sample_rate()):
+            return self.get_response(request)
+
+        profiler = Profiler()
+        if not profiler.start():
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.stop()
+        profiler.save(ProfileRecord.REQUEST, f"{request.method} {request.path}")
+        return response
@@ -0,0 +1,77 @@
+# Generated by Django 5.1 on 2026-10-19 08:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0002_stage_stage_group"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="case",
+            index=models.Index(
+                condition=models.Q(("archived", False), ("is_returned", False)),
+                fields=["-created_at"],
+                name="case_active_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="case",
+            index=models.Index(
+                condition=models.Q(("archived", False), ("is_returned", False)),
+                fields=["priority", "updated_at"],
+                name="case_active_priority_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="case",
+            index=models.Index(
+                condition=models.Q(("archived", False)),
+                fields=["current_stage", "updated_at"],
+                name="case_open_stage_updated_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="case",
+            index=models.Index(
+                condition=models.Q(("archived", True)),
+                fields=["-created_at"],
+                name="case_archived_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="case",
+            index=models.Index(
+                condition=models.Q(("archived", False), ("is_returned", True)),
+                fields=["-created_at"],
+                name="case_returned_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="casestagelog",
+            index=models.Index(
+                fields=["case", "-start_time"], name="log_case_start_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="casestagelog",
+            index=models.Index(
+                fields=["case", "stage", "-start_time"], name="log_case_stage_start_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="casestagelog",
+            index=models.Index(
+                condition=models.Q(("end_time__isnull", True)),
+                fields=["case"],
+                name="log_open_case_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="casestagelog",
+            index=models.Index(fields=["start_time"], name="log_start_time_idx"),
+        ),
+    ]
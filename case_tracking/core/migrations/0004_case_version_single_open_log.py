@@ -0,0 +1,51 @@
+# Generated by Django 5.1 on 2026-10-19 08:25
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def close_duplicate_open_logs(apps, schema_editor):
+    """
+    Keep only the latest open log of each case before enforcing a single open log.
+    """
+    CaseStageLog = apps.get_model("core", "CaseStageLog")
+    duplicates = (
+        CaseStageLog.objects.filter(end_time__isnull=True)
+        .values("case_id")
+        .annotate(open_logs=Count("id"), latest=Max("start_time"))
+        .filter(open_logs__gt=1)
+    )
+    for row in duplicates:
+        open_logs = CaseStageLog.objects.filter(
+            case_id=row["case_id"], end_time__isnull=True
+        ).order_by("-start_time", "-id")
+        keep = open_logs.first()
+        open_logs.exclude(pk=keep.pk).update(end_time=row["latest"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0003_hot_query_indexes"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="casestagelog",
+            name="log_open_case_idx",
+        ),
+        migrations.AddField(
+            model_name="case",
+            name="version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(close_duplicate_open_logs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="casestagelog",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("end_time__isnull", True)),
+                fields=("case",),
+                name="log_one_open_per_case",
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1 on 2026-10-19 08:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0004_case_version_single_open_log"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="case",
+            index=models.Index(fields=["updated_at"], name="case_updated_idx"),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.1 on 2026-10-19 08:33
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0005_case_updated_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BackupRecord",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("full", "Full backup"),
+                            ("incremental", "Incremental backup"),
+                            ("verify", "Restore check"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("success", "Success"), ("failed", "Failed")],
+                        default="success",
+                        max_length=20,
+                    ),
+                ),
+                ("table", models.CharField(blank=True, max_length=100)),
+                ("path", models.CharField(blank=True, max_length=500)),
+                ("size", models.PositiveBigIntegerField(default=0)),
+                ("rows", models.PositiveBigIntegerField(default=0)),
+                ("started_at", models.DateTimeField(default=django.utils.timezone.now)),
+                ("duration", models.FloatField(default=0)),
+                ("details", models.JSONField(blank=True, default=dict)),
+                ("error", models.TextField(blank=True)),
+            ],
+            options={
+                "verbose_name": "Backup",
+                "verbose_name_plural": "Backups",
+                "ordering": ["-started_at"],
+                "indexes": [
+                    models.Index(
+                        fields=["kind", "table", "-started_at"],
+                        name="backup_kind_started_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1 on 2026-10-19 08:49
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0009_barcode_sequence"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProfileRecord",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("request", "Request"), ("task", "Celery task")],
+                        max_length=20,
+                    ),
+                ),
+                ("name", models.CharField(max_length=255)),
+                ("created_at", models.DateTimeField(default=django.utils.timezone.now)),
+                ("duration", models.FloatField()),
+                ("query_count", models.PositiveIntegerField(default=0)),
+                ("query_time", models.FloatField(default=0)),
+                ("stats", models.TextField(blank=True)),
+                ("queries", models.JSONField(blank=True, default=list)),
+            ],
+            options={
+                "verbose_name": "Profile",
+                "verbose_name_plural": "Profiles",
+                "ordering": ["-duration"],
+            },
+        ),
+    ]
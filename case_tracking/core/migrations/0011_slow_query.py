@@ -0,0 +1,44 @@
+# Generated by Django 5.1 on 2026-10-19 08:51
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0010_profile_record"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SlowQuery",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("fingerprint", models.CharField(max_length=40, unique=True)),
+                ("normalized_sql", models.TextField()),
+                ("sample_sql", models.TextField(blank=True)),
+                ("call_site", models.CharField(blank=True, max_length=255)),
+                ("database", models.CharField(default="default", max_length=50)),
+                ("count", models.PositiveBigIntegerField(default=0)),
+                ("total_time", models.FloatField(default=0)),
+                ("max_time", models.FloatField(default=0)),
+                ("explain", models.TextField(blank=True)),
+                ("first_seen", models.DateTimeField(default=django.utils.timezone.now)),
+                ("last_seen", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                "verbose_name": "Slow query",
+                "verbose_name_plural": "Slow queries",
+                "ordering": ["-total_time"],
+            },
+        ),
+    ]
@@ -0,0 +1,174 @@
+# Generated by Django 5.1 on 2026-10-19 08:58
+
+import core.routers
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0011_slow_query"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Lab",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("code", models.SlugField(max_length=32, unique=True)),
+                ("name", models.CharField(max_length=100)),
+            ],
+            options={
+                "verbose_name": "Lab",
+                "verbose_name_plural": "Labs",
+                "ordering": ["code"],
+            },
+        ),
+        migrations.AddField(
+            model_name="case",
+            name="lab",
+            field=models.CharField(
+                db_index=True, default=core.routers.current_lab, max_length=32
+            ),
+        ),
+        migrations.AddField(
+            model_name="casestagelog",
+            name="lab",
+            field=models.CharField(
+                db_index=True, default=core.routers.current_lab, max_length=32
+            ),
+        ),
+        migrations.AddField(
+            model_name="customuser",
+            name="lab",
+            field=models.CharField(
+                blank=True,
+                help_text="Lab code, the default lab if empty",
+                max_length=32,
+            ),
+        ),
+        migrations.AddField(
+            model_name="nextstage",
+            name="lab",
+            field=models.CharField(
+                db_index=True, default=core.routers.current_lab, max_length=32
+            ),
+        ),
+        migrations.AddField(
+            model_name="scanstation",
+            name="lab",
+            field=models.CharField(
+                blank=True,
+                help_text="Lab code, the default lab if empty",
+                max_length=32,
+            ),
+        ),
+        migrations.AddField(
+            model_name="stage",
+            name="lab",
+            field=models.CharField(
+                db_index=True, default=core.routers.current_lab, max_length=32
+            ),
+        ),
+        migrations.AlterField(
+            model_name="case",
+            name="barcode",
+            field=models.CharField(db_index=True, max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name="case",
+            name="case_number",
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AlterField(
+            model_name="case",
+            name="last_updated_by",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="cases_updated",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="case",
+            name="return_reason",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="cases",
+                to="core.returnreason",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="casestagelog",
+            name="user",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="stage_logs",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="stage",
+            name="barcode",
+            field=models.CharField(db_index=True, max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name="stage",
+            name="name",
+            field=models.CharField(db_index=True, max_length=32),
+        ),
+        migrations.AlterField(
+            model_name="stage",
+            name="stage_group",
+            field=models.CharField(db_index=True, max_length=32, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name="case",
+            constraint=models.UniqueConstraint(
+                fields=("lab", "case_number"), name="case_lab_number_uniq"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="case",
+            constraint=models.UniqueConstraint(
+                fields=("lab", "barcode"), name="case_lab_barcode_uniq"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="stage",
+            constraint=models.UniqueConstraint(
+                fields=("lab", "name"), name="stage_lab_name_uniq"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="stage",
+            constraint=models.UniqueConstraint(
+                fields=("lab", "barcode"), name="stage_lab_barcode_uniq"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="stage",
+            constraint=models.UniqueConstraint(
+                fields=("lab", "stage_group"), name="stage_lab_group_uniq"
+            ),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1 on 2026-10-19 09:10
+
+from django.db import migrations
+
+INDEX = "log_interval_gist_idx"
+
+
+def create_interval_index(apps, schema_editor):
+    """
+    GiST index of the log intervals for core.history, PostgreSQL only: other
+    databases answer as-of queries from the start_time index.
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(
+        f"CREATE INDEX IF NOT EXISTS {INDEX} ON core_casestagelog "
+        "USING gist (tstzrange(start_time, end_time, '[)'))"
+    )
+
+
+def drop_interval_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(f"DROP INDEX IF EXISTS {INDEX}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0012_labs"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_interval_index, drop_interval_index),
+    ]
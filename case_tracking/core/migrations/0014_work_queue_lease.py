@@ -0,0 +1,41 @@
+# Generated by Django 5.1 on 2026-10-19 09:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0013_log_interval_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="case",
+            name="claimed_by",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="claimed_cases",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddField(
+            model_name="case",
+            name="claimed_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="case",
+            index=models.Index(
+                condition=models.Q(("archived", False), ("is_returned", False)),
+                fields=["lab", "current_stage", "-priority", "created_at"],
+                include=("claimed_until", "claimed_by"),
+                name="case_stage_queue_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1 on 2026-10-19 12:40
+
+from django.db import migrations, models
+
+
+def fill_last_time(apps, schema_editor):
+    """
+    Start the (start_time, pk) position of existing checkpoints at the log
+    they stopped on.
+    """
+    AggregationCheckpoint = apps.get_model("core", "AggregationCheckpoint")
+    CaseStageLog = apps.get_model("core", "CaseStageLog")
+    for checkpoint in AggregationCheckpoint.objects.filter(last_id__gt=0):
+        checkpoint.last_time = (
+            CaseStageLog.objects.filter(pk=checkpoint.last_id)
+            .values_list("start_time", flat=True)
+            .first()
+        )
+        checkpoint.save(update_fields=["last_time"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0014_work_queue_lease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="aggregationcheckpoint",
+            name="last_time",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_last_time, migrations.RunPython.noop),
+    ]
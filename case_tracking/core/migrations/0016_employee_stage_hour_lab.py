@@ -0,0 +1,82 @@
+# Generated by Django 5.1 on 2026-10-19 09:33
+
+import core.routers
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+CHECKPOINT = "employee_productivity"
+
+
+def split_by_lab(apps, schema_editor):
+    """
+    Give the aggregated rows the lab of their stage and a productivity
+    checkpoint to every lab on the primary database, which the single
+    checkpoint covered. Labs with their own database start from their first log.
+    """
+    EmployeeStageHour = apps.get_model("core", "EmployeeStageHour")
+    Stage = apps.get_model("core", "Stage")
+    Lab = apps.get_model("core", "Lab")
+    AggregationCheckpoint = apps.get_model("core", "AggregationCheckpoint")
+    EmployeeStageHour.objects.update(
+        lab=Subquery(Stage.objects.filter(pk=OuterRef("stage_id")).values("lab")[:1])
+    )
+    checkpoint = AggregationCheckpoint.objects.filter(name=CHECKPOINT).first()
+    if checkpoint is None:
+        return
+    labs = {settings.DEFAULT_LAB, *Lab.objects.values_list("code", flat=True)}
+    AggregationCheckpoint.objects.bulk_create(
+        AggregationCheckpoint(
+            name=f"{CHECKPOINT}:{lab}",
+            last_id=checkpoint.last_id,
+            last_time=checkpoint.last_time,
+        )
+        for lab in sorted(labs - set(settings.LAB_DATABASES))
+    )
+    checkpoint.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0015_checkpoint_last_time"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="employeestagehour",
+            name="employee_stage_hour_unique",
+        ),
+        migrations.RemoveIndex(
+            model_name="employeestagehour",
+            name="employee_stage_hour_idx",
+        ),
+        migrations.AddField(
+            model_name="employeestagehour",
+            name="lab",
+            field=models.CharField(default=core.routers.current_lab, max_length=32),
+        ),
+        migrations.AlterField(
+            model_name="employeestagehour",
+            name="stage",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="core.stage",
+            ),
+        ),
+        migrations.RunPython(split_by_lab, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="employeestagehour",
+            index=models.Index(fields=["lab", "hour"], name="employee_stage_hour_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="employeestagehour",
+            constraint=models.UniqueConstraint(
+                fields=("lab", "user", "stage", "hour"),
+                name="employee_stage_hour_unique",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-19 09:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0016_employee_stage_hour_lab"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="backuprecord",
+            name="database",
+            field=models.CharField(default="default", max_length=100),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-19 09:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0017_backup_database"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="case",
+            name="case_updated_idx",
+        ),
+        migrations.AddIndex(
+            model_name="case",
+            index=models.Index(
+                fields=["lab", "updated_at"], name="case_lab_updated_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1 on 2026-10-19 13:20
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce, Now
+
+
+def close_archived_case_logs(apps, schema_editor):
+    """
+    End the open logs of already archived cases at their archived_at, so they
+    leave the board history as newly archived cases do. Runs in every database,
+    lab databases included.
+    """
+    Case = apps.get_model("core", "Case")
+    CaseStageLog = apps.get_model("core", "CaseStageLog")
+    using = schema_editor.connection.alias
+    archived_at = Case.objects.using(using).filter(pk=OuterRef("case_id"))
+    CaseStageLog.objects.using(using).filter(
+        end_time__isnull=True,
+        case__in=Case.objects.using(using).filter(archived=True),
+    ).update(end_time=Coalesce(Subquery(archived_at.values("archived_at")[:1]), Now()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0018_case_lab_updated_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(close_archived_case_logs, migrations.RunPython.noop),
+    ]
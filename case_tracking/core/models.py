@@ -1,9 +1,33 @@
+import hashlib
+import secrets
+
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
-from django.db import models, transaction
+from django.db import models, router, transaction
+from django.db.models import Exists, F, OuterRef
 from django.utils.timezone import now
 from guardian.mixins import GuardianUserMixin
 
+from .routers import current_lab
+
+
+class Lab(models.Model):
+    """
+    A lab whose cases and stages are kept apart from the other labs (see
+    core.routers).
+    """
+
+    code = models.SlugField(max_length=32, unique=True)
+    name = models.CharField(max_length=100)
+
+    class Meta:
+        ordering = ["code"]
+        verbose_name = "Lab"
+        verbose_name_plural = "Labs"
+
+    def __str__(self):
+        return self.name or self.code
+
 
 class CustomUserManager(BaseUserManager):
     use_in_migrations = True
@@ -63,6 +87,9 @@ class CustomUser(AbstractBaseUser, PermissionsMixin, GuardianUserMixin):
         help_text="Unique bar code",
     )  # Переносим barcode из Employee
     is_active = models.BooleanField(default=True)  # Для деактивации пользователей
+    lab = models.CharField(
+        max_length=32, blank=True, help_text="Lab code, the default lab if empty"
+    )
 
     objects = CustomUserManager()
 
@@ -88,16 +115,26 @@ class Stage(models.Model):
     Represents a stage in the workflow.
     """
 
-    name = models.CharField(max_length=32, unique=True, db_index=True)
-    barcode = models.CharField(max_length=50, unique=True, db_index=True, null=True)
+    lab = models.CharField(max_length=32, default=current_lab, db_index=True)
+    name = models.CharField(max_length=32, db_index=True)
+    barcode = models.CharField(max_length=50, db_index=True, null=True)
     display_name = models.CharField(max_length=64)
     note = models.TextField(blank=True, null=True)
-    stage_group = models.CharField(max_length=32, unique=True, db_index=True, null=True)
+    stage_group = models.CharField(max_length=32, db_index=True, null=True)
 
     class Meta:
         ordering = ["name"]
         verbose_name = "Stage"
         verbose_name_plural = "Stages"
+        constraints = [
+            models.UniqueConstraint(fields=["lab", "name"], name="stage_lab_name_uniq"),
+            models.UniqueConstraint(
+                fields=["lab", "barcode"], name="stage_lab_barcode_uniq"
+            ),
+            models.UniqueConstraint(
+                fields=["lab", "stage_group"], name="stage_lab_group_uniq"
+            ),
+        ]
 
     def __str__(self):
         return f"{self.pk} {self.display_name}"
@@ -108,6 +145,7 @@ class NextStage(models.Model):
     Represents a transition between two stages.
     """
 
+    lab = models.CharField(max_length=32, default=current_lab, db_index=True)
     signal = models.CharField(max_length=32)
     display_name = models.CharField(max_length=64)
 
@@ -147,6 +185,101 @@ class ReturnReason(models.Model):
         return self.custom_reason or self.reason
 
 
+class CaseConflict(Exception):
+    """
+    Raised when a case was changed by someone else since it was loaded.
+    """
+
+
+class CaseQuerySet(models.QuerySet):
+    """
+    Set-based counterparts of the Case state changes, used for bulk actions.
+    """
+
+    def bulk_transition(self, new_stage, user=None):
+        """
+        Move every case of the stage's lab that has a transition to new_stage from
+        its current stage.
+        Open logs are closed and new logs inserted in bulk. Returns the number of
+        moved cases.
+        """
+        allowed = NextStage.objects.filter(
+            current=OuterRef("current_stage"), next=new_stage
+        )
+        case_ids = list(
+            self.filter(Exists(allowed), lab=new_stage.lab)
+            .exclude(current_stage=new_stage)
+            .values_list("pk", flat=True)
+        )
+        if not case_ids:
+            return 0
+
+        timestamp = now()
+        with transaction.atomic(using=self.db):
+            CaseStageLog.objects.using(self.db).filter(
+                case_id__in=case_ids, end_time__isnull=True
+            ).update(end_time=timestamp)
+            CaseStageLog.objects.using(self.db).bulk_create(
+                [
+                    CaseStageLog(
+                        lab=new_stage.lab,
+                        case_id=case_id,
+                        stage=new_stage,
+                        user=user,
+                        start_time=timestamp,
+                    )
+                    for case_id in case_ids
+                ]
+            )
+            self.model.objects.using(self.db).filter(pk__in=case_ids).update(
+                current_stage=new_stage,
+                last_updated_by=user,
+                updated_at=timestamp,
+                claimed_by=None,
+                claimed_until=None,
+                version=F("version") + 1,
+            )
+        return len(case_ids)
+
+    def bulk_archive(self, user=None):
+        """
+        Archive every case of the set that is not archived yet and close its
+        open log, so it leaves the board. Returns the number of archived cases.
+        """
+        case_ids = list(self.filter(archived=False).values_list("pk", flat=True))
+        if not case_ids:
+            return 0
+
+        timestamp = now()
+        with transaction.atomic(using=self.db):
+            CaseStageLog.objects.using(self.db).filter(
+                case_id__in=case_ids, end_time__isnull=True
+            ).update(end_time=timestamp)
+            return (
+                self.model.objects.using(self.db)
+                .filter(pk__in=case_ids, archived=False)
+                .update(
+                    archived=True,
+                    archived_at=timestamp,
+                    last_updated_by=user,
+                    updated_at=timestamp,
+                    version=F("version") + 1,
+                )
+            )
+
+    def bulk_return(self, user=None, reason=None, description=None):
+        fields = {
+            "is_returned": True,
+            "return_description": description,
+            "last_updated_by": user,
+            "updated_at": now(),
+            "version": F("version") + 1,
+        }
+        if reason:
+            fields["return_reason"] = reason
+        return self.filter(is_returned=False).update(**fields)
+
+
 class Case(models.Model):
     """
     Represents a case in the system.
@@ -163,14 +296,17 @@ class Case(models.Model):
         ("emax", "EMAX"),
     ]
 
-    case_number = models.CharField(max_length=100, unique=True)
-    barcode = models.CharField(max_length=50, unique=True, db_index=True, null=True)
+    lab = models.CharField(max_length=32, default=current_lab, db_index=True)
+    case_number = models.CharField(max_length=100)
+    barcode = models.CharField(max_length=50, db_index=True, null=True)
+    # Сотрудники и причины возврата общие: в базе лаборатории их строк нет
     last_updated_by = models.ForeignKey(
         "CustomUser",
         on_delete=models.SET_NULL,
         null=True,
         blank=True,
         related_name="cases_updated",
+        db_constraint=False,
     )
     priority = models.CharField(
         max_length=10, choices=PRIORITY_CHOICES, default="standard"
@@ -196,9 +332,25 @@ class Case(models.Model):
         null=True,
         blank=True,
         related_name="cases",
+        db_constraint=False,
     )
     is_returned = models.BooleanField(default=False)
     return_description = models.TextField(blank=True, null=True)
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # Аренда из очереди этапа (core.work_queue), сбрасывается при переходе
+    claimed_by = models.ForeignKey(
+        "CustomUser",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="claimed_cases",
+        db_constraint=False,
+    )
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    objects = CaseQuerySet.as_manager()
+    # Включается в _save_versioned(): только там UPDATE сравнивает версию
+    _compare_version = False
 
     def __str__(self):
         return f"Case #{self.case_number} - {self.priority}"
@@ -213,56 +365,153 @@ class Case(models.Model):
             ("archive_cases", "Can archive a specific case"),
             ("return_cases", "Can return a specific case"),
         ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["lab", "case_number"], name="case_lab_number_uniq"
+            ),
+            models.UniqueConstraint(
+                fields=["lab", "barcode"], name="case_lab_barcode_uniq"
+            ),
+        ]
+        indexes = [
+            # Active board (case_list, CaseProcessing) ordered by the default ordering
+            models.Index(
+                fields=["-created_at"],
+                condition=models.Q(archived=False, is_returned=False),
+                name="case_active_created_idx",
+            ),
+            # check_and_update_case_priorities
+            models.Index(
+                fields=["priority", "updated_at"],
+                condition=models.Q(archived=False, is_returned=False),
+                name="case_active_priority_idx",
+            ),
+            # archive_completed_cases
+            models.Index(
+                fields=["current_stage", "updated_at"],
+                condition=models.Q(archived=False),
+                name="case_open_stage_updated_idx",
+            ),
+            # archived_case
+            models.Index(
+                fields=["-created_at"],
+                condition=models.Q(archived=True),
+                name="case_archived_created_idx",
+            ),
+            # Stage work queue: urgent first, then oldest (core.work_queue)
+            models.Index(
+                fields=["lab", "current_stage", "-priority", "created_at"],
+                include=["claimed_until", "claimed_by"],
+                condition=models.Q(archived=False, is_returned=False),
+                name="case_stage_queue_idx",
+            ),
+            # Change marker of the boards of a lab: max(updated_at)
+            models.Index(fields=["lab", "updated_at"], name="case_lab_updated_idx"),
+            # returned_case
+            models.Index(
+                fields=["-created_at"],
+                condition=models.Q(is_returned=True, archived=False),
+                name="case_returned_created_idx",
+            ),
+        ]
+
+    @property
+    def database(self):
+        return self._state.db or router.db_for_write(Case, instance=self)
 
     def save(self, *args, **kwargs):
-        # Проверяем, существует ли объект в базе
-        if self.pk is not None:  # Обновление существующего кейса
-            try:
-                old_case = Case.objects.get(pk=self.pk)
-                if old_case.current_stage != self.current_stage:
-                    # Завершаем предыдущий открытый лог, если он есть
-                    previous_log = self.stage_logs_case.filter(
-                        stage=old_case.current_stage, end_time__isnull=True
-                    ).first()
-                    if previous_log:
-                        previous_log.end_time = now()
-                        previous_log.save()
-                    # Логируем переход на новую стадию
-                    self.log_transition(new_stage=self.current_stage)
-            except Case.DoesNotExist:
-                pass  # Если что-то пошло не так, пропускаем
-        else:  # Новый кейс
-            super().save(*args, **kwargs)  # Сначала сохраняем, чтобы был pk
-            self.log_transition(new_stage=self.current_stage)
-            return
-
-        super().save(*args, **kwargs)
+        with transaction.atomic(using=kwargs.get("using") or self.database):
+            if self.pk is None:  # Новый кейс
+                super().save(*args, **kwargs)  # Сначала сохраняем, чтобы был pk
+                self.log_transition(
+                    new_stage=self.current_stage, user=self.last_updated_by
+                )
+                return
+
+            # Обновление существующего кейса: логируем, если сменилась стадия
+            stage_changed = (
+                not Case.objects.using(self.database)
+                .filter(pk=self.pk, current_stage=self.current_stage)
+                .exists()
+            )
+            self._save_versioned(*args, **kwargs)
+            if stage_changed:
+                self.log_transition(
+                    new_stage=self.current_stage, user=self.last_updated_by
+                )
+
+    def _save_versioned(self, *args, **kwargs):
+        """
+        Save an existing case only if its version is still the one that was loaded,
+        see _do_update(). Raises CaseConflict otherwise.
+        """
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "version"}
+        self.version += 1
+        self._compare_version = True
+        try:
+            super().save(*args, **kwargs)
+        except Exception:
+            self.version -= 1
+            raise
+        finally:
+            self._compare_version = False
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        if not self._compare_version:
+            # Сырое сохранение (loaddata) перезаписывает строку без проверки версии
+            return super()._do_update(
+                base_qs, using, pk_val, values, update_fields, forced_update
+            )
+        # Compare-and-swap: the UPDATE only matches the row with the loaded version
+        if super()._do_update(
+            base_qs.filter(version=self.version - 1),
+            using,
+            pk_val,
+            values,
+            update_fields,
+            forced_update,
+        ):
+            return True
+        if base_qs.filter(pk=pk_val).exists():
+            raise CaseConflict(
+                f"Case #{self.case_number} was changed by someone else, please retry."
+            )
+        # Строки с этим pk ещё нет: Django вставит её
+        return False
 
     def transition_stage(self, new_stage, user=None, is_return=False, reason=None):
         """
         Transition to a new stage and log the transition, associating it with a user.
+        Raises CaseConflict if the case was changed since it was loaded.
         """
-        self.log_transition(
-            new_stage=new_stage, is_return=is_return, reason=reason, user=user
-        )
-        self.current_stage = new_stage
-        self.last_updated_by = user
-        self.updated_at = now()
-        self.save()
+        if new_stage.lab != self.lab:
+            raise ValueError(f"Stage {new_stage.name} belongs to another lab.")
+        with transaction.atomic(using=self.database):
+            self.current_stage = new_stage
+            self.last_updated_by = user
+            self.updated_at = now()
+            self.claimed_by = None
+            self.claimed_until = None
+            self._save_versioned()
+            self.log_transition(
+                new_stage=new_stage, is_return=is_return, reason=reason, user=user
+            )
 
     def log_transition(self, new_stage, is_return=False, reason=None, user=None):
         """
-        Log the transition to a new stage.
+        Log the transition to a new stage, closing the open log of the previous one.
         """
-        previous_log = self.stage_logs_case.filter(end_time__isnull=True).first()
-        if previous_log:
-            previous_log.end_time = now()
-            previous_log.save()
-        CaseStageLog.objects.create(
+        timestamp = now()
+        self.stage_logs_case.filter(end_time__isnull=True).update(end_time=timestamp)
+        CaseStageLog.objects.using(self.database).create(
+            lab=self.lab,
             case=self,
             stage=new_stage,
             user=user,
+            start_time=timestamp,
             is_returned=is_return,
+            reason=str(reason) if reason else None,
         )
 
     def process_return(self, reason=None, custom_reason=None, description=None):
@@ -272,7 +521,7 @@ class Case(models.Model):
         if self.is_returned:
             raise ValueError("This case has already been returned.")
 
-        with transaction.atomic():
+        with transaction.atomic(using=self.database):
             if reason:
                 self.return_reason = reason
             if custom_reason:
@@ -284,9 +533,17 @@ class Case(models.Model):
             self.save()
 
     def archive_case(self):
-        self.archived = True
-        self.archived_at = now()
-        self.save()
+        """
+        Archive the case. Its open log ends at archived_at: an archived case is
+        no longer on any stage (see core.history).
+        """
+        with transaction.atomic(using=self.database):
+            self.archived = True
+            self.archived_at = now()
+            self.save()
+            self.stage_logs_case.filter(end_time__isnull=True).update(
+                end_time=self.archived_at
+            )
 
 
 class CaseStageLog(models.Model):
@@ -294,6 +551,7 @@ class CaseStageLog(models.Model):
     Represents a log of a case's stage transitions.
     """
 
+    lab = models.CharField(max_length=32, default=current_lab, db_index=True)
     case = models.ForeignKey(
         Case, on_delete=models.PROTECT, related_name="stage_logs_case"
     )
@@ -306,6 +564,7 @@ class CaseStageLog(models.Model):
         null=True,
         blank=True,
         related_name="stage_logs",
+        db_constraint=False,
     )
     start_time = models.DateTimeField(default=now)
     end_time = models.DateTimeField(null=True, blank=True)
@@ -316,6 +575,240 @@ class CaseStageLog(models.Model):
         ordering = ["-start_time"]
         verbose_name = "Case Stage Log"
         verbose_name_plural = "Case Stage Logs"
+        indexes = [
+            # Latest log of a case (signals, timelines)
+            models.Index(fields=["case", "-start_time"], name="log_case_start_idx"),
+            # Latest log of a case on its current stage (case_list)
+            models.Index(
+                fields=["case", "stage", "-start_time"],
+                name="log_case_stage_start_idx",
+            ),
+            # delete_outdated_case_stage_logs
+            models.Index(fields=["start_time"], name="log_start_time_idx"),
+        ]
+        constraints = [
+            # A case has exactly one open log: the one of its current stage
+            models.UniqueConstraint(
+                fields=["case"],
+                condition=models.Q(end_time__isnull=True),
+                name="log_one_open_per_case",
+            ),
+        ]
 
     def __str__(self):
         return f"Log for Case {self.case.case_number} at {self.stage}"
+
+
+class BackupRecord(models.Model):
+    """
+    A database backup, incremental table backup or restore check and how long
+    it took (see core.backup).
+    """
+
+    FULL = "full"
+    INCREMENTAL = "incremental"
+    VERIFY = "verify"
+    KIND_CHOICES = [
+        (FULL, "Full backup"),
+        (INCREMENTAL, "Incremental backup"),
+        (VERIFY, "Restore check"),
+    ]
+    SUCCESS = "success"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (SUCCESS, "Success"),
+        (FAILED, "Failed"),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=SUCCESS)
+    # Алиас базы: основная или база лаборатории
+    database = models.CharField(max_length=100, default="default")
+    table = models.CharField(max_length=100, blank=True)
+    path = models.CharField(max_length=500, blank=True)
+    size = models.PositiveBigIntegerField(default=0)
+    rows = models.PositiveBigIntegerField(default=0)
+    started_at = models.DateTimeField(default=now)
+    duration = models.FloatField(default=0)  # seconds
+    details = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ["-started_at"]
+        verbose_name = "Backup"
+        verbose_name_plural = "Backups"
+        indexes = [
+            models.Index(
+                fields=["kind", "table", "-started_at"], name="backup_kind_started_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.started_at:%Y-%m-%d %H:%M} ({self.status})"
+
+
+class EmployeeStageHour(models.Model):
+    """
+    Precomputed activity of one employee on one stage during one hour, filled
+    incrementally from CaseStageLog (see core.productivity).
+    """
+
+    lab = models.CharField(max_length=32, default=current_lab)
+    user = models.ForeignKey(
+        CustomUser, on_delete=models.CASCADE, related_name="stage_hours"
+    )
+    # Этапы лабораторий с отдельной базой хранятся там, а не на основной
+    stage = models.ForeignKey(
+        Stage, on_delete=models.CASCADE, related_name="+", db_constraint=False
+    )
+    hour = models.DateTimeField()
+    # Переводы кейса сотрудником на этот этап
+    scans = models.PositiveIntegerField(default=0)
+    # Переводы на последний этап
+    completed = models.PositiveIntegerField(default=0)
+    # Возвраты кейсов, которые сотрудник последним перевёл на этот этап
+    returns = models.PositiveIntegerField(default=0)
+    # Время работы с кейсом на этом этапе (до перевода сотрудником дальше)
+    handled = models.PositiveIntegerField(default=0)
+    handling_seconds = models.FloatField(default=0)
+    handling_histogram = models.JSONField(default=dict)
+
+    class Meta:
+        verbose_name = "Employee stage hour"
+        verbose_name_plural = "Employee stage hours"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["lab", "user", "stage", "hour"],
+                name="employee_stage_hour_unique",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["lab", "hour"], name="employee_stage_hour_idx"),
+            models.Index(fields=["user", "hour"], name="employee_hour_idx"),
+        ]
+
+
+class AggregationCheckpoint(models.Model):
+    """
+    Last CaseStageLog processed by an incremental aggregation job, as its
+    (start_time, pk) position.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    last_id = models.PositiveBigIntegerField(default=0)
+    last_time = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.last_id}"
+
+
+class ScanStation(models.Model):
+    """
+    A scanner device that calls the scan API with its own long-lived token
+    instead of a user session. Only the SHA-256 of the token is stored.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    token_hash = models.CharField(max_length=64, unique=True, editable=False)
+    lab = models.CharField(
+        max_length=32, blank=True, help_text="Lab code, the default lab if empty"
+    )
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(default=now)
+
+    class Meta:
+        verbose_name = "Scan station"
+        verbose_name_plural = "Scan stations"
+
+    def __str__(self):
+        return self.name
+
+    @staticmethod
+    def hash_token(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def set_new_token(self):
+        """
+        Generate a new token, store its hash and return the token itself (it
+        cannot be recovered later).
+        """
+        token = secrets.token_urlsafe(32)
+        self.token_hash = self.hash_token(token)
+        return token
+
+
+class BarcodeSequence(models.Model):
+    """
+    Last number issued for generated barcodes with a prefix. Labels are
+    allocated as ranges of this counter, so generated barcodes never collide.
+    """
+
+    prefix = models.CharField(max_length=10, unique=True)
+    last_value = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.prefix}: {self.last_value}"
+
+
+class ProfileRecord(models.Model):
+    """
+    A profiled request or task run, kept while it is among the
+    PROFILING_BUFFER_SIZE slowest (see core.profiling).
+    """
+
+    REQUEST = "request"
+    TASK = "task"
+    KIND_CHOICES = [
+        (REQUEST, "Request"),
+        (TASK, "Celery task"),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    name = models.CharField(max_length=255)
+    created_at = models.DateTimeField(default=now)
+    duration = models.FloatField()  # seconds
+    query_count = models.PositiveIntegerField(default=0)
+    query_time = models.FloatField(default=0)  # seconds
+    stats = models.TextField(blank=True)
+    queries = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        ordering = ["-duration"]
+        verbose_name = "Profile"
+        verbose_name_plural = "Profiles"
+
+    def __str__(self):
+        return f"{self.name} ({self.duration:.3f}s)"
+
+
+class SlowQuery(models.Model):
+    """
+    Queries slower than SLOW_QUERY_THRESHOLD_MS, aggregated by fingerprint (the
+    SQL with literals and parameters removed, see core.query_log).
+    """
+
+    fingerprint = models.CharField(max_length=40, unique=True)
+    normalized_sql = models.TextField()
+    sample_sql = models.TextField(blank=True)
+    call_site = models.CharField(max_length=255, blank=True)
+    database = models.CharField(max_length=50, default="default")
+    count = models.PositiveBigIntegerField(default=0)
+    total_time = models.FloatField(default=0)  # seconds
+    max_time = models.FloatField(default=0)  # seconds
+    explain = models.TextField(blank=True)
+    first_seen = models.DateTimeField(default=now)
+    last_seen = models.DateTimeField(default=now)
+
+    class Meta:
+        ordering = ["-total_time"]
+        verbose_name = "Slow query"
+        verbose_name_plural = "Slow queries"
+
+    def __str__(self):
+        return f"{self.fingerprint[:12]} x{self.count}"
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.count if self.count else 0
@@ -0,0 +1,64 @@
+from django.conf import settings
+from guardian.core import ObjectPermissionChecker
+from rest_framework.permissions import BasePermission
+
+from .authentication import StationUser
+
+
+class CasePermissionCache:
+    """
+    Object permissions of one user for a set of cases. Permissions of all
+    prefetched cases are loaded at once (one query for user and one for group
+    permissions), later checks are answered from memory.
+
+    Grants are stored by case pk, and labs with their own database reuse the
+    same pks, so a grant only applies to cases of the user's own lab
+    (superusers keep every permission).
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.lab = getattr(user, "lab", "") or settings.DEFAULT_LAB
+        self.checker = ObjectPermissionChecker(user)
+
+    def in_lab(self, case):
+        return self.user.is_superuser or case.lab == self.lab
+
+    def prefetch(self, cases):
+        cases = [case for case in cases if case.pk is not None]
+        in_lab = [case for case in cases if self.in_lab(case)]
+        if in_lab:
+            self.checker.prefetch_perms(in_lab)
+        return cases
+
+    def has_perm(self, perm, case):
+        return self.in_lab(case) and self.checker.has_perm(perm, case)
+
+    def get_perms(self, case):
+        if not self.user.is_active or not self.in_lab(case):
+            return []
+        return self.checker.get_perms(case)
+
+
+def case_permissions(request):
+    """
+    Return the permission cache of the request's user, shared by every view and
+    admin page that handles the request.
+    """
+    if not hasattr(request, "_case_permissions"):
+        request._case_permissions = CasePermissionCache(request.user)
+    return request._case_permissions
+
+
+class ScanStationPermission(BasePermission):
+    """
+    With SCAN_REQUIRE_STATION_TOKEN only requests authenticated by a station
+    token may scan, otherwise anyone who opens the scan page may.
+    """
+
+    message = "A scan station token is required."
+
+    def has_permission(self, request, view):
+        if not settings.SCAN_REQUIRE_STATION_TOKEN:
+            return True
+        return isinstance(request.user, StationUser)
@@ -0,0 +1,311 @@
+"""
+Employee productivity metrics.
+
+``aggregate_stage_logs`` folds CaseStageLog rows created since the previous
+run into EmployeeStageHour (one row per employee, stage and hour). Logs are
+taken in (start_time, pk) order and only once they are older than
+COMMIT_WINDOW, so a log whose transaction commits after a newer one is not
+skipped and every log is folded exactly once. Each lab is folded from its own
+database with its own checkpoint (``aggregate_employee_productivity`` runs all
+labs). The dashboards
+read only that table, so they stay cheap during the shift. For every new log L
+of a case whose previous log is P:
+
+* L.user gets a scan on L.stage and, if L.stage is the last one, a completion;
+* L.user handled the case on P.stage for L.start_time - P.start_time;
+* if L is a return, the return is attributed to P.user on P.stage (the employee
+  who last moved the case before it came back).
+
+Handling times are kept as log-scale histograms (buckets about 10% wide), which
+can be summed across hours, so the medians are approximate.
+"""
+
+import math
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+from django.utils.timezone import now
+
+from .config_snapshot import get_config
+from .models import AggregationCheckpoint, CaseStageLog, EmployeeStageHour
+from .reference_data import stages as stage_list
+from .routers import current_lab
+
+CHECKPOINT = "employee_productivity"
+BATCH_SIZE = 5000
+HISTOGRAM_BASE = 1.1
+# Переход фиксируется за доли секунды; логи моложе этого ещё могут появиться
+# с более ранним start_time и пока не учитываются
+COMMIT_WINDOW = timedelta(minutes=2)
+
+
+def bucket(seconds):
+    return int(math.log(max(seconds, 1), HISTOGRAM_BASE))
+
+
+def histogram_median(histogram):
+    """
+    Approximate median (in seconds) of a {bucket: count} histogram.
+    """
+    total = sum(histogram.values())
+    if not total:
+        return None
+    seen = 0
+    for key in sorted(histogram, key=int):
+        seen += histogram[key]
+        if seen * 2 >= total:
+            # Середина корзины в логарифмической шкале
+            return HISTOGRAM_BASE ** (int(key) + 0.5)
+
+
+def merge_histograms(histograms):
+    merged = defaultdict(int)
+    for histogram in histograms:
+        for key, count in histogram.items():
+            merged[str(key)] += count
+    return dict(merged)
+
+
+def _previous(field):
+    return Subquery(
+        CaseStageLog.objects.filter(
+            case_id=OuterRef("case_id"), start_time__lt=OuterRef("start_time")
+        )
+        .order_by("-start_time")
+        .values(field)[:1]
+    )
+
+
+def _new_logs(lab, checkpoint, horizon, limit):
+    if checkpoint.last_time is None:
+        # Отметка старого формата: только по pk
+        after = Q(pk__gt=checkpoint.last_id)
+    else:
+        after = Q(start_time__gt=checkpoint.last_time) | Q(
+            start_time=checkpoint.last_time, pk__gt=checkpoint.last_id
+        )
+    return (
+        CaseStageLog.objects.filter(after, lab=lab, start_time__lte=horizon)
+        .order_by("start_time", "pk")
+        .annotate(
+            previous_start=_previous("start_time"),
+            previous_stage=_previous("stage_id"),
+            previous_user=_previous("user_id"),
+        )
+        .values(
+            "pk",
+            "user_id",
+            "stage_id",
+            "start_time",
+            "is_returned",
+            "previous_start",
+            "previous_stage",
+            "previous_user",
+        )[:limit]
+    )
+
+
+def _hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _collect(logs, last_stage_id):
+    deltas = defaultdict(
+        lambda: {
+            "scans": 0,
+            "completed": 0,
+            "returns": 0,
+            "handled": 0,
+            "seconds": 0.0,
+            "histogram": defaultdict(int),
+        }
+    )
+    for log in logs:
+        hour = _hour(log["start_time"])
+        if log["user_id"] is not None:
+            delta = deltas[(log["user_id"], log["stage_id"], hour)]
+            delta["scans"] += 1
+            if log["stage_id"] == last_stage_id:
+                delta["completed"] += 1
+        if log["previous_start"] is None:
+            continue
+        if log["user_id"] is not None and not log["is_returned"]:
+            seconds = (log["start_time"] - log["previous_start"]).total_seconds()
+            delta = deltas[(log["user_id"], log["previous_stage"], hour)]
+            delta["handled"] += 1
+            delta["seconds"] += seconds
+            delta["histogram"][str(bucket(seconds))] += 1
+        if log["is_returned"] and log["previous_user"] is not None:
+            deltas[(log["previous_user"], log["previous_stage"], hour)]["returns"] += 1
+    return deltas
+
+
+def _apply(lab, deltas):
+    existing = {
+        (row.user_id, row.stage_id, row.hour): row
+        for row in EmployeeStageHour.objects.select_for_update().filter(
+            lab=lab,
+            user_id__in={key[0] for key in deltas},
+            hour__in={key[2] for key in deltas},
+        )
+    }
+    created, updated = [], []
+    for (user_id, stage_id, hour), delta in deltas.items():
+        row = existing.get((user_id, stage_id, hour))
+        if row is None:
+            row = EmployeeStageHour(
+                lab=lab, user_id=user_id, stage_id=stage_id, hour=hour
+            )
+            created.append(row)
+        else:
+            updated.append(row)
+        row.scans += delta["scans"]
+        row.completed += delta["completed"]
+        row.returns += delta["returns"]
+        row.handled += delta["handled"]
+        row.handling_seconds += delta["seconds"]
+        row.handling_histogram = merge_histograms(
+            [row.handling_histogram, delta["histogram"]]
+        )
+    EmployeeStageHour.objects.bulk_create(created)
+    EmployeeStageHour.objects.bulk_update(
+        updated,
+        [
+            "scans",
+            "completed",
+            "returns",
+            "handled",
+            "handling_seconds",
+            "handling_histogram",
+        ],
+    )
+
+
+def aggregate_stage_logs(batch_size=BATCH_SIZE, horizon=None):
+    """
+    Fold the stage logs of the current lab started since the last run, but not
+    after ``horizon`` (now minus COMMIT_WINDOW by default), into
+    EmployeeStageHour. Returns the number of processed logs.
+    """
+    if horizon is None:
+        horizon = now() - COMMIT_WINDOW
+    lab = current_lab()
+    last_stage_id = get_config().last_stage.pk
+    # Номера логов разных баз пересекаются: у каждой лаборатории своя отметка
+    name = f"{CHECKPOINT}:{lab}"
+    AggregationCheckpoint.objects.get_or_create(name=name)
+    processed = 0
+    while True:
+        with transaction.atomic():
+            checkpoint = AggregationCheckpoint.objects.select_for_update().get(
+                name=name
+            )
+            logs = list(_new_logs(lab, checkpoint, horizon, batch_size))
+            if not logs:
+                return processed
+            _apply(lab, _collect(logs, last_stage_id))
+            checkpoint.last_time = logs[-1]["start_time"]
+            checkpoint.last_id = logs[-1]["pk"]
+            checkpoint.save()
+        processed += len(logs)
+
+
+def _period(days):
+    return now() - timedelta(days=days)
+
+
+def _rate(scans, hours):
+    return round(scans / hours, 1) if hours else 0
+
+
+def employee_summary(user, days=1):
+    """
+    Totals and per-stage handling times of one employee in the current lab for
+    the last ``days``.
+    """
+    rows = list(
+        EmployeeStageHour.objects.filter(
+            lab=current_lab(), user=user, hour__gte=_period(days)
+        )
+    )
+    hours = len({row.hour for row in rows})
+    scans = sum(row.scans for row in rows)
+    stages = defaultdict(list)
+    for row in rows:
+        stages[row.stage_id].append(row)
+    return {
+        "scans": scans,
+        "active_hours": hours,
+        "scans_per_hour": _rate(scans, hours),
+        "completed": sum(row.completed for row in rows),
+        "returns": sum(row.returns for row in rows),
+        "stages": [
+            {
+                "stage": display_name,
+                "scans": sum(row.scans for row in stages[pk]),
+                "handled": sum(row.handled for row in stages[pk]),
+                "returns": sum(row.returns for row in stages[pk]),
+                "median_handling": _median(stages[pk]),
+            }
+            for pk, _, display_name in stage_list()
+            if pk in stages
+        ],
+    }
+
+
+def _median(rows):
+    return _histograms_median(row.handling_histogram for row in rows)
+
+
+def _histograms_median(histograms):
+    median = histogram_median(merge_histograms(histograms))
+    return None if median is None else timedelta(seconds=round(median))
+
+
+def team_summary(days=1):
+    """
+    Per-employee totals of all employees in the current lab for the last
+    ``days``, busiest first, with the median handling time on every stage the
+    employee worked on.
+    """
+    hours = EmployeeStageHour.objects.filter(lab=current_lab(), hour__gte=_period(days))
+    rows = (
+        hours.values("user_id", "user__first_name", "user__last_name")
+        .annotate(
+            scans=Sum("scans"),
+            completed=Sum("completed"),
+            returns=Sum("returns"),
+            active_hours=Count("hour", distinct=True),
+        )
+        .order_by("-scans")
+    )
+    histograms = defaultdict(lambda: defaultdict(list))
+    for user_id, stage_id, histogram in hours.filter(handled__gt=0).values_list(
+        "user_id", "stage_id", "handling_histogram"
+    ):
+        histograms[user_id][stage_id].append(histogram)
+    stage_names = {pk: display_name for pk, _, display_name in stage_list()}
+    return [
+        {
+            "user_id": row["user_id"],
+            "name": f"{row['user__first_name']} {row['user__last_name']}".strip(),
+            "scans": row["scans"],
+            "active_hours": row["active_hours"],
+            "scans_per_hour": _rate(row["scans"], row["active_hours"]),
+            "completed": row["completed"],
+            "returns": row["returns"],
+            "stages": sorted(
+                (
+                    {
+                        "stage": stage_names.get(stage_id, str(stage_id)),
+                        "median_handling": _histograms_median(stage_histograms),
+                    }
+                    for stage_id, stage_histograms in histograms[row["user_id"]].items()
+                ),
+                key=lambda stage: stage["stage"],
+            ),
+        }
+        for row in rows
+    ]
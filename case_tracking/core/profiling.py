@@ -0,0 +1,160 @@
+"""
+Sampling profiler for requests and Celery tasks.
+
+Managers set PROFILING_SAMPLE_RATE (requests) and PROFILING_TASK_SAMPLE_RATE
+(task runs) in constance: the fraction of runs to profile, 0 to disable. While
+disabled, each request or task only reads the rate from the config snapshot.
+
+A sampled run is profiled with cProfile. Every database query it makes is
+recorded with its time and the project code that issued it. The run is then
+stored as a ProfileRecord if it is among the PROFILING_BUFFER_SIZE slowest, and
+the buffer is trimmed back to that size.
+"""
+
+import cProfile
+import io
+import pstats
+import random
+import sys
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+
+from .config_snapshot import get_config
+from .models import ProfileRecord
+
+STATS_LIMIT = 40
+QUERY_LIMIT = 20
+SQL_LENGTH = 300
+# Обёртки запросов, которые не считаются местом вызова
+INSTRUMENTATION_FILES = {__file__, str(Path(__file__).with_name("query_log.py"))}
+
+
+def sampled(rate):
+    return rate > 0 and random.random() < rate
+
+
+def request_sample_rate():
+    return get_config().PROFILING_SAMPLE_RATE
+
+
+def task_sample_rate():
+    return get_config().PROFILING_TASK_SAMPLE_RATE
+
+
+def call_site():
+    """
+    The innermost project frame (not Django, another library or the query
+    instrumentation) on the stack, as "path:line function".
+    """
+    root = str(settings.BASE_DIR)
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if (
+            filename.startswith(root)
+            and "site-packages" not in filename
+            and filename not in INSTRUMENTATION_FILES
+        ):
+            return f"{filename[len(root) + 1:]}:{frame.f_lineno} {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "-"
+
+
+class Profiler:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.queries = defaultdict(lambda: {"count": 0, "time": 0.0})
+        self.query_count = 0
+        self.query_time = 0.0
+        self.duration = 0.0
+        self._stack = None
+        self._started = None
+
+    def _record_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.query_count += 1
+            self.query_time += elapsed
+            query = self.queries[(call_site(), sql[:SQL_LENGTH])]
+            query["count"] += 1
+            query["time"] += elapsed
+
+    def start(self):
+        """
+        Start profiling; returns False if another profiler is already active in
+        this thread.
+        """
+        self._stack = ExitStack()
+        for connection in connections.all():
+            self._stack.enter_context(connection.execute_wrapper(self._record_query))
+        try:
+            self.profile.enable()
+        except ValueError:
+            self._stack.close()
+            return False
+        self._started = time.perf_counter()
+        return True
+
+    def stop(self):
+        self.profile.disable()
+        self.duration = time.perf_counter() - self._started
+        self._stack.close()
+
+    def stats_text(self):
+        output = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=output)
+        stats.sort_stats("cumulative").print_stats(STATS_LIMIT)
+        return output.getvalue()
+
+    def top_queries(self):
+        queries = sorted(
+            self.queries.items(), key=lambda item: item[1]["time"], reverse=True
+        )
+        return [
+            {
+                "caller": caller,
+                "sql": sql,
+                "count": query["count"],
+                "time": round(query["time"], 6),
+            }
+            for (caller, sql), query in queries[:QUERY_LIMIT]
+        ]
+
+    def save(self, kind, name):
+        return store_profile(
+            kind,
+            name,
+            duration=self.duration,
+            query_count=self.query_count,
+            query_time=self.query_time,
+            stats=self.stats_text(),
+            queries=self.top_queries(),
+        )
+
+
+def store_profile(kind, name, duration, **fields):
+    """
+    Keep a profile if it is among the PROFILING_BUFFER_SIZE slowest. Returns the
+    record, or None if it was faster than all of the buffered ones.
+    """
+    size = settings.PROFILING_BUFFER_SIZE
+    slowest = ProfileRecord.objects.order_by("-duration")
+    threshold = next(
+        iter(slowest.values_list("duration", flat=True)[size - 1 : size]), None
+    )
+    if threshold is not None and duration <= threshold:
+        return None
+    record = ProfileRecord.objects.create(
+        kind=kind, name=name[:255], duration=duration, **fields
+    )
+    keep = list(slowest.values_list("pk", flat=True)[:size])
+    ProfileRecord.objects.exclude(pk__in=keep).delete()
+    return record
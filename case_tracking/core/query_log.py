@@ -0,0 +1,174 @@
+"""
+Slow-query log.
+
+``install`` adds ``log_slow_queries`` to the execute wrappers of a connection
+(core.signals does this for every new connection). A query slower than
+SLOW_QUERY_THRESHOLD_MS is logged with its call site and added to the SlowQuery
+row of its fingerprint. The first time a process sees a fingerprint, and then
+at most once every SLOW_QUERY_EXPLAIN_INTERVAL seconds, the EXPLAIN plan is
+captured on the same connection. Rows are written when the current transaction
+commits (immediately in autocommit mode), so they never hold locks inside it
+and are dropped if it rolls back.
+"""
+
+import hashlib
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils.timezone import now
+
+from .models import SlowQuery
+from .profiling import call_site
+
+logger = logging.getLogger(__name__)
+
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+EXPLAIN_PREFIXES = {"sqlite": "EXPLAIN QUERY PLAN "}
+SAMPLE_LENGTH = 10_000
+
+_state = threading.local()
+# fingerprint -> время последнего EXPLAIN в этом процессе
+_explained = {}
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|\?")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+def normalize(sql):
+    """
+    SQL without literals and parameters, with IN lists collapsed, so that runs
+    of the same query get the same fingerprint.
+    """
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _PLACEHOLDER.sub("?", sql)
+    sql = _LIST.sub("(...)", sql)
+    return _SPACE.sub(" ", sql).strip()
+
+
+def fingerprint(sql):
+    normalized = normalize(sql)
+    return hashlib.sha1(normalized.encode()).hexdigest(), normalized
+
+
+def install(connection):
+    if log_slow_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(log_slow_queries)
+
+
+def log_slow_queries(execute, sql, params, many, context):
+    threshold = settings.SLOW_QUERY_THRESHOLD_MS
+    if not threshold or getattr(_state, "busy", False):
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    result = execute(sql, params, many, context)
+    elapsed = time.perf_counter() - started
+    if elapsed * 1000 >= threshold:
+        _state.busy = True
+        try:
+            _record(context["connection"], sql, params, many, elapsed)
+        finally:
+            _state.busy = False
+    return result
+
+
+def _explain_due(digest):
+    last = _explained.get(digest)
+    current = time.monotonic()
+    if last is not None and current - last < settings.SLOW_QUERY_EXPLAIN_INTERVAL:
+        return False
+    _explained[digest] = current
+    return True
+
+
+def explain(connection, sql, params):
+    """
+    The plan of a query, or "" for statements that cannot be explained.
+    """
+    if not sql.lstrip().upper().startswith(EXPLAINABLE):
+        return ""
+    prefix = EXPLAIN_PREFIXES.get(connection.vendor, "EXPLAIN ")
+    try:
+        # Точка сохранения: неудачный EXPLAIN не должен сломать транзакцию запроса
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                rows = cursor.fetchall()
+    except DatabaseError as e:
+        return f"EXPLAIN failed: {e}"
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+def _record(connection, sql, params, many, elapsed):
+    digest, normalized = fingerprint(sql)
+    site = call_site()
+    logger.warning(
+        "Slow query (%.1f ms) at %s: %s", elapsed * 1000, site, normalized[:500]
+    )
+    entry = {
+        "fingerprint": digest,
+        "normalized_sql": normalized,
+        "database": connection.alias,
+        "elapsed": elapsed,
+        "seen": now(),
+        "plan": None,
+    }
+    if not many and _explain_due(digest):
+        entry["plan"] = {
+            "explain": explain(connection, sql, params),
+            "sample_sql": f"{sql}\n-- params: {params!r}"[:SAMPLE_LENGTH],
+            "call_site": site[:255],
+        }
+    transaction.on_commit(lambda: _store(entry), using=connection.alias)
+
+
+def _store(entry):
+    busy = getattr(_state, "busy", False)
+    _state.busy = True
+    try:
+        store(entry)
+    except DatabaseError:
+        logger.exception("Could not store slow query %s", entry["fingerprint"])
+    finally:
+        _state.busy = busy
+
+
+def store(entry):
+    """
+    Add one slow run to the SlowQuery row of its fingerprint.
+    """
+    plan = entry["plan"] or {}
+    updated = SlowQuery.objects.filter(fingerprint=entry["fingerprint"]).update(
+        count=F("count") + 1,
+        total_time=F("total_time") + entry["elapsed"],
+        max_time=Greatest("max_time", Value(entry["elapsed"])),
+        last_seen=entry["seen"],
+        **plan,
+    )
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            SlowQuery.objects.create(
+                fingerprint=entry["fingerprint"],
+                normalized_sql=entry["normalized_sql"],
+                database=entry["database"],
+                count=1,
+                total_time=entry["elapsed"],
+                max_time=entry["elapsed"],
+                first_seen=entry["seen"],
+                last_seen=entry["seen"],
+                **plan,
+            )
+    except IntegrityError:
+        # Другой процесс успел создать запись
+        store(entry)
@@ -0,0 +1,139 @@
+"""
+Small, rarely changing lists (stages, employees) used by dropdowns and filters.
+
+They are kept in the configured cache as tuples of plain values and dropped by
+the model signals in core.signals whenever a Stage or CustomUser changes. Such a
+change also bumps version(), which the cached board rows include in their key.
+"""
+
+from uuid import uuid4
+
+from django.core.cache import cache
+
+from .labs import lab_codes
+from .models import CustomUser, Stage
+from .routers import current_lab
+
+STAGES_KEY = "reference_data:stages"
+EMPLOYEES_KEY = "reference_data:employees"
+STAGE_BARCODES_KEY = "reference_data:stage_barcodes"
+EMPLOYEE_BARCODES_KEY = "reference_data:employee_barcodes"
+VERSION_KEY = "reference_data:version"
+CACHE_TIMEOUT = 60 * 60
+
+
+def _stages_key(lab):
+    return f"{STAGES_KEY}:{lab}"
+
+
+def stages():
+    """
+    Return ``(id, name, display_name)`` of the stages of the current lab ordered
+    by name.
+    """
+    lab = current_lab()
+    data = cache.get(_stages_key(lab))
+    if data is None:
+        data = tuple(
+            Stage.objects.filter(lab=lab)
+            .order_by("name")
+            .values_list("id", "name", "display_name")
+        )
+        cache.set(_stages_key(lab), data, CACHE_TIMEOUT)
+    return data
+
+
+def employees():
+    """
+    Return ``(id, full_name, is_active)`` of all users ordered by name.
+    """
+    data = cache.get(EMPLOYEES_KEY)
+    if data is None:
+        data = tuple(
+            (pk, f"{first_name} {last_name}".strip(), is_active)
+            for pk, first_name, last_name, is_active in CustomUser.objects.order_by(
+                "last_name", "first_name"
+            ).values_list("id", "first_name", "last_name", "is_active")
+        )
+        cache.set(EMPLOYEES_KEY, data, CACHE_TIMEOUT)
+    return data
+
+
+def _stage_barcodes_key(lab):
+    return f"{STAGE_BARCODES_KEY}:{lab}"
+
+
+def stage_barcodes():
+    """
+    Return ``{barcode: (id, name, display_name, stage_group)}`` of the stages of
+    the current lab, for scanning.
+    """
+    lab = current_lab()
+    data = cache.get(_stage_barcodes_key(lab))
+    if data is None:
+        data = {
+            barcode: (pk, name, display_name, stage_group)
+            for barcode, pk, name, display_name, stage_group in Stage.objects.filter(
+                lab=lab, barcode__isnull=False
+            ).values_list("barcode", "id", "name", "display_name", "stage_group")
+        }
+        cache.set(_stage_barcodes_key(lab), data, CACHE_TIMEOUT)
+    return data
+
+
+def employee_barcodes():
+    """
+    Return ``{barcode: (id, full_name, is_active)}`` for scanning.
+    """
+    data = cache.get(EMPLOYEE_BARCODES_KEY)
+    if data is None:
+        data = {
+            barcode: (pk, f"{first_name} {last_name}".strip(), is_active)
+            for barcode, pk, first_name, last_name, is_active in CustomUser.objects.filter(
+                barcode__isnull=False
+            ).values_list(
+                "barcode", "id", "first_name", "last_name", "is_active"
+            )
+        }
+        cache.set(EMPLOYEE_BARCODES_KEY, data, CACHE_TIMEOUT)
+    return data
+
+
+def active_employees():
+    return tuple(employee for employee in employees() if employee[2])
+
+
+def stage_choices():
+    return [(pk, display_name) for pk, _, display_name in stages()]
+
+
+def employee_choices():
+    return [(pk, full_name) for pk, full_name, _ in employees()]
+
+
+def version():
+    """
+    Return a token that changes whenever stages, employees or return reasons
+    change.
+    """
+    value = cache.get(VERSION_KEY)
+    if value is None:
+        value = bump_version()
+    return value
+
+
+def bump_version():
+    value = uuid4().hex
+    cache.set(VERSION_KEY, value, None)
+    return value
+
+
+def invalidate_stages():
+    labs = lab_codes()
+    cache.delete_many([*map(_stages_key, labs), *map(_stage_barcodes_key, labs)])
+    bump_version()
+
+
+def invalidate_employees():
+    cache.delete_many([EMPLOYEES_KEY, EMPLOYEE_BARCODES_KEY])
+    bump_version()
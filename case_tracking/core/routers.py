@@ -0,0 +1,132 @@
+"""
+Lab and primary/replica database routing.
+
+Every Case, Stage, NextStage and CaseStageLog row belongs to a lab (its ``lab``
+code). ``LabRouter`` sends these models to the database of the current lab
+(``using_lab()``; requests use the lab of the user or scan station). Labs listed
+in ``settings.LAB_DATABASES`` have their own database; all others share the
+primary. Rows loaded from a lab database stay there (save, related objects).
+
+Everything else, and the labs on the primary, is routed by
+``PrimaryReplicaRouter``. Writes, transactions and everything by default go to
+the primary ("default"). Code that only reads (board pages, reports) opts in
+with ``replica_reads()``. Its queries are spread over the aliases listed in
+``settings.DATABASE_REPLICAS``, unless the request is pinned to the primary
+because the client has just written (see
+``core.middleware.PrimaryStickinessMiddleware``).
+"""
+
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Apps whose rows must be read right after they are written (login sessions)
+PRIMARY_ONLY_APPS = {"sessions"}
+# Models whose rows live in the database of their lab
+LAB_MODELS = {"case", "stage", "nextstage", "casestagelog"}
+
+_replica_reads = ContextVar("replica_reads", default=False)
+_pinned_to_primary = ContextVar("pinned_to_primary", default=False)
+_lab = ContextVar("lab", default=None)
+
+
+def current_lab():
+    """
+    Code of the lab the current request or task works in.
+    """
+    lab = _lab.get()
+    if callable(lab):
+        lab = lab()
+    return lab or settings.DEFAULT_LAB
+
+
+def lab_database(lab):
+    return settings.LAB_DATABASES.get(lab, DEFAULT_DB_ALIAS)
+
+
+@contextmanager
+def using_lab(lab):
+    """
+    Work in ``lab`` inside the block. ``lab`` may be a callable, resolved when
+    the lab is first needed.
+    """
+    token = _lab.set(lab)
+    try:
+        yield
+    finally:
+        _lab.reset(token)
+
+
+@contextmanager
+def replica_reads():
+    """
+    Allow reads inside the block (or the decorated view) to use a replica.
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+@contextmanager
+def pinned_to_primary(pinned=True):
+    """
+    Force reads inside the block to the primary, e.g. right after a write.
+    """
+    token = _pinned_to_primary.set(pinned)
+    try:
+        yield
+    finally:
+        _pinned_to_primary.reset(token)
+
+
+class LabRouter:
+    def _db_for_model(self, model, hints):
+        if not settings.LAB_DATABASES or (
+            model._meta.app_label != "core" or model._meta.model_name not in LAB_MODELS
+        ):
+            return None
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        alias = lab_database(current_lab())
+        # Лаборатории на основной базе маршрутизирует PrimaryReplicaRouter
+        return None if alias == DEFAULT_DB_ALIAS else alias
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_model(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_model(model, hints)
+
+
+class PrimaryReplicaRouter:
+    def __init__(self, replicas=None):
+        if replicas is None:
+            replicas = getattr(settings, "DATABASE_REPLICAS", [])
+        self.replicas = list(replicas)
+
+    def db_for_read(self, model, **hints):
+        if (
+            not self.replicas
+            or not _replica_reads.get()
+            or _pinned_to_primary.get()
+            or model._meta.app_label in PRIMARY_ONLY_APPS
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        return random.choice(self.replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in self.replicas
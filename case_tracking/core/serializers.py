@@ -1,6 +1,7 @@
 from rest_framework import serializers
 
 from .models import Case, CustomUser, Stage
+from .routers import current_lab
 
 
 class BarcodeScanSerializer(serializers.Serializer):
@@ -27,14 +28,15 @@ class BarcodeScanSerializer(serializers.Serializer):
 
     def validate_case_barcode(self, value):
         try:
-            case = Case.objects.get(barcode=value)
+            # Штрихкоды уникальны только в пределах лаборатории
+            case = Case.objects.get(lab=current_lab(), barcode=value)
             return case
         except Case.DoesNotExist:
             return value
 
     def validate_stage_barcode(self, value):
         try:
-            stage = Stage.objects.get(barcode=value)
+            stage = Stage.objects.get(lab=current_lab(), barcode=value)
             return stage
         except Stage.DoesNotExist:
             raise serializers.ValidationError(
@@ -45,6 +47,22 @@ class BarcodeScanSerializer(serializers.Serializer):
         return data
 
 
+class WorkQueueClaimSerializer(BarcodeScanSerializer):
+    case_barcode = None
+
+
+class WorkQueueReleaseSerializer(BarcodeScanSerializer):
+    stage_barcode = None
+
+    def validate_case_barcode(self, value):
+        case = super().validate_case_barcode(value)
+        if not isinstance(case, Case):
+            raise serializers.ValidationError(
+                {"case_barcode": f"Case with barcode {value} not found."}
+            )
+        return case
+
+
 class CaseSerializer(serializers.ModelSerializer):
     class Meta:
         model = Case
@@ -89,3 +107,18 @@ class StageBarcodeAssignSerializer(serializers.Serializer):
                 {"barcode": "This barcode is already asigned to another stage"}
             )
         return data
+
+
+class CaseTimelineEntrySerializer(serializers.Serializer):
+    stage = serializers.CharField()
+    stage_display_name = serializers.CharField()
+    user = serializers.CharField(allow_null=True)
+    start_time = serializers.DateTimeField()
+    end_time = serializers.DateTimeField(allow_null=True)
+    dwell = serializers.DurationField()
+    dwell_seconds = serializers.SerializerMethodField()
+    is_returned = serializers.BooleanField()
+    reason = serializers.CharField(allow_blank=True)
+
+    def get_dwell_seconds(self, entry):
+        return entry["dwell"].total_seconds()
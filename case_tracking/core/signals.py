@@ -1,36 +1,103 @@
-from django.db.models.signals import post_save, pre_save
+from celery.signals import task_postrun, task_prerun
+from constance.signals import config_updated
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
-from django.utils.timezone import now
+from guardian.models import UserObjectPermission
 
-from .models import Case, CaseStageLog
+from . import config_snapshot, query_log, reference_data
+from .models import Case, CustomUser, ProfileRecord, ReturnReason, ScanStation, Stage
+from .profiling import Profiler, sampled, task_sample_rate
 
+# Профили выполняемых сейчас задач по task_id
+_task_profilers = {}
 
-@receiver(pre_save, sender=CaseStageLog)
-def set_end_time(sender, instance, **kwargs):
+
+@receiver(config_updated)
+@receiver(post_save, sender=Stage)
+@receiver(post_delete, sender=Stage)
+def invalidate_config_snapshot(sender, **kwargs):
+    """
+    Drop the cached constance snapshot (and the stages resolved from it).
+    """
+    config_snapshot.invalidate()
+
+
+@receiver(post_save, sender=Stage)
+@receiver(post_delete, sender=Stage)
+def invalidate_stage_reference_data(sender, **kwargs):
+    reference_data.invalidate_stages()
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_employee_reference_data(sender, update_fields=None, **kwargs):
+    # Логин обновляет только last_login, список сотрудников не меняется
+    if update_fields is not None and set(update_fields) <= {"last_login"}:
+        return
+    reference_data.invalidate_employees()
+
+
+@receiver(post_save, sender=ReturnReason)
+@receiver(post_delete, sender=ReturnReason)
+def bump_return_reason_reference_version(sender, **kwargs):
+    # Причины возврата показываются в кэшированных строках returned_case
+    reference_data.bump_version()
+
+
+@receiver(pre_save, sender=CustomUser)
+def drop_case_permissions_on_lab_change(
+    sender, instance, raw=False, update_fields=None, **kwargs
+):
     """
-    Signal handler that sets the end time for the previous stage
-    when transitioning to a new stage. Also sets the start time for
-    the current stage.
+    Object permissions on cases are stored by case pk, which other lab databases
+    reuse: grants from the previous lab must not carry over to the new one.
     """
-    if instance.start_time and instance.end_time is None:
-        # Fetch the last stage log for the current case, ordered by start_time
-        # to ensure we are working with the most recent log.
-        last_log = (
-            CaseStageLog.objects.filter(case=instance.case)
-            .order_by("-start_time")
-            .first()
-        )
-
-        # If there is a previous log and its end_time is not set,
-        # we update the previous stage's end_time to the current time.
-        if last_log and last_log.end_time is None:
-            last_log.end_time = now()  # Set the end time for the previous stage.
-            last_log.save()
-
-        # Set the end_time for the current stage.
-        # If this is the first stage, the end_time will remain None,
-        # as it hasn't been completed yet.
-        instance.end_time = None if not last_log else now()
+    if raw or instance.pk is None:
+        return
+    if update_fields is not None and "lab" not in update_fields:
+        return
+    previous = (
+        CustomUser.objects.filter(pk=instance.pk).values_list("lab", flat=True).first()
+    )
+    if previous is None:
+        return
+    if (previous or settings.DEFAULT_LAB) != (instance.lab or settings.DEFAULT_LAB):
+        UserObjectPermission.objects.filter(
+            user=instance, content_type=ContentType.objects.get_for_model(Case)
+        ).delete()
+
+
+@receiver(post_save, sender=ScanStation)
+@receiver(post_delete, sender=ScanStation)
+def invalidate_scan_station_tokens(sender, **kwargs):
+    # Отложенный импорт: DRF нужен только веб-процессам
+    from .authentication import invalidate_station_tokens
+
+    invalidate_station_tokens()
+
+
+@receiver(connection_created)
+def install_slow_query_log(sender, connection, **kwargs):
+    query_log.install(connection)
+
+
+@task_prerun.connect
+def start_task_profile(task_id, **kwargs):
+    if sampled(task_sample_rate()):
+        profiler = Profiler()
+        if profiler.start():
+            _task_profilers[task_id] = profiler
+
+
+@task_postrun.connect
+def save_task_profile(task_id, task, **kwargs):
+    profiler = _task_profilers.pop(task_id, None)
+    if profiler is not None:
+        profiler.stop()
+        profiler.save(ProfileRecord.TASK, task.name)
 
 
 @receiver(pre_save, sender=Case)
@@ -40,36 +107,3 @@ def check_current_stage(sender, instance, **kwargs):
     """
     if not instance.current_stage:
         raise ValueError("Each case must be assigned to a stage before saving.")
-
-
-@receiver(post_save, sender=Case)
-def log_case_stage_transition(sender, instance, created, **kwargs):
-    if created:
-        # Новый кейс — логируем начальную стадию
-        CaseStageLog.objects.create(
-            case=instance,
-            stage=instance.current_stage,
-            start_time=now(),
-        )
-    else:
-        # Существующий кейс — проверяем изменение стадии
-        try:
-            old_case = Case.objects.get(pk=instance.pk)
-            if old_case.current_stage != instance.current_stage:
-                # Завершаем предыдущий лог, если он открыт
-                previous_log = instance.stage_logs_case.filter(
-                    stage=old_case.current_stage, end_time__isnull=True
-                ).first()
-                if previous_log:
-                    previous_log.end_time = now()
-                    previous_log.save()
-                # Создаём новый лог для текущей стадии
-                CaseStageLog.objects.create(
-                    case=instance,
-                    stage=instance.current_stage,
-                    start_time=now(),
-                )
-        except Case.DoesNotExist:
-            raise ValueError(
-                "Something went wrong."
-            )  # На случай, если что-то пошло не так
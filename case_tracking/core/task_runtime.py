@@ -0,0 +1,201 @@
+"""
+Runtime helpers for the periodic Celery tasks.
+
+With several beat or worker nodes the same periodic task can be started twice.
+``singleton`` lets only one run of a task proceed at a time, using a lock in
+Redis (TASK_LOCK_URL, the broker by default) or in the Django cache when no Redis
+is configured. Big maintenance jobs are split by ``shard_ranges`` into primary key
+ranges (per lab, see core.tasks.lab_shards) that ``fan_out`` processes on all
+workers as a chord; ``aggregate_shards``
+adds up the shard results and releases the job's lock. ``verify_beat_schedule``
+checks that the beat schedule only names registered tasks.
+"""
+
+import functools
+import logging
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+
+from celery import chord, shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Max, Min
+from django_celery_beat.models import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+REDIS_SCHEMES = ("redis://", "rediss://", "unix://")
+
+# Удаляем ключ, только если блокировка всё ещё наша
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+_held_lock = ContextVar("held_lock", default=None)
+
+
+@functools.lru_cache(maxsize=None)
+def _redis_client(url):
+    # Импорт redis заметно замедляет запуск процессов, которым блокировки не нужны
+    import redis
+
+    return redis.Redis.from_url(url)
+
+
+def lock_client():
+    url = getattr(settings, "TASK_LOCK_URL", "")
+    if url.startswith(REDIS_SCHEMES):
+        return _redis_client(url)
+    return None
+
+
+class TaskLock:
+    """
+    Non-blocking lock with an expiry, so a crashed worker cannot hold it forever.
+    """
+
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.key = f"task-lock:{name}"
+        self.timeout = timeout or settings.CELERY_TASK_TIME_LIMIT
+
+    def acquire(self):
+        token = uuid.uuid4().hex
+        client = lock_client()
+        if client is not None:
+            acquired = client.set(self.key, token, nx=True, ex=self.timeout)
+        else:
+            acquired = cache.add(self.key, token, self.timeout)
+        return token if acquired else None
+
+    def release(self, token):
+        client = lock_client()
+        if client is not None:
+            client.eval(_RELEASE_SCRIPT, 1, self.key, token)
+        elif cache.get(self.key) == token:
+            cache.delete(self.key)
+
+
+class HeldLock:
+    def __init__(self, lock, token):
+        self.lock = lock
+        self.token = token
+        self.handed_over = False
+
+
+def singleton(timeout=None):
+    """
+    Skip the task if another run of it still holds its lock. Goes under
+    ``@shared_task`` so the task keeps its name.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            lock = TaskLock(func.__name__, timeout)
+            token = lock.acquire()
+            if token is None:
+                logger.info(f"{func.__name__} is already running, skipped")
+                return f"Skipped: {func.__name__} is already running"
+
+            held = HeldLock(lock, token)
+            context_token = _held_lock.set(held)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _held_lock.reset(context_token)
+                # Если работа ушла в шарды, блокировку снимет aggregate_shards
+                if not held.handed_over:
+                    lock.release(token)
+
+        return wrapper
+
+    return decorator
+
+
+def shard_ranges(queryset, shard_size=None):
+    """
+    Split the primary key span of the queryset into ``[start, end)`` ranges.
+    """
+    shard_size = shard_size or settings.TASK_SHARD_SIZE
+    bounds = queryset.aggregate(start=Min("pk"), end=Max("pk"))
+    if bounds["start"] is None:
+        return []
+    return [
+        (start, min(start + shard_size, bounds["end"] + 1))
+        for start in range(bounds["start"], bounds["end"] + 1, shard_size)
+    ]
+
+
+def fan_out(shard_task, shards, job):
+    """
+    Run ``shard_task(*args)`` for the arguments of every shard, e.g. a
+    ``(start, end)`` range, and aggregate the results.
+
+    A single shard (or eager mode) is processed in place. Otherwise the shards
+    are sent to the workers as a chord and the lock held by the calling
+    ``singleton`` task is released by the aggregation step. If a shard fails the
+    lock expires on its own.
+    """
+    if len(shards) <= 1 or shard_task.app.conf.task_always_eager:
+        results = [shard_task(*args) for args in shards]
+        return aggregate_shards(results, job)
+
+    held = _held_lock.get()
+    lock_name, lock_token = (held.lock.name, held.token) if held else (None, None)
+    chord(shard_task.s(*args) for args in shards)(
+        aggregate_shards.s(job, lock_name, lock_token)
+    )
+    if held is not None:
+        held.handed_over = True
+    return f"{job}: dispatched {len(shards)} shards"
+
+
+@shared_task
+def aggregate_shards(results, job, lock_name=None, lock_token=None):
+    """
+    Sum the counters returned by the shards of a job.
+    """
+    totals = Counter()
+    for result in results:
+        totals.update(result)
+    if lock_name is not None:
+        TaskLock(lock_name).release(lock_token)
+    logger.info(f"{job} finished in {len(results)} shards: {dict(totals)}")
+    return dict(totals)
+
+
+def verify_beat_schedule(app):
+    """
+    Raise ImproperlyConfigured if the beat schedule names a task that is not
+    registered (e.g. after a task was renamed or moved).
+    """
+    registered = set(app.tasks.keys())
+    unknown = sorted(
+        f"{name} -> {entry['task']}"
+        for name, entry in (app.conf.beat_schedule or {}).items()
+        if entry["task"] not in registered
+    )
+    if unknown:
+        raise ImproperlyConfigured(
+            "CELERY_BEAT_SCHEDULE names unregistered tasks: " + ", ".join(unknown)
+        )
+    return registered
+
+
+def disable_unknown_periodic_tasks(registered):
+    """
+    Disable periodic tasks stored by the database scheduler that name tasks which
+    no longer exist (entries left from old schedules).
+    """
+    stale = PeriodicTask.objects.filter(enabled=True).exclude(task__in=registered)
+    for periodic_task in stale:
+        logger.warning(
+            f"Periodic task {periodic_task.name} names unknown task {periodic_task.task}, disabled"
+        )
+    return stale.update(enabled=False)
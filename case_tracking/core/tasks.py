@@ -1,27 +1,70 @@
 import logging
 
 from celery import shared_task
-from constance import config
-from django.core.management import call_command
 from django.utils.timezone import now, timedelta
 
-from .models import Case, CaseStageLog, Stage
+from . import backup, productivity
+from .config_snapshot import get_config
+from .labs import fan_out_labs, lab_codes
+from .models import Case, CaseConflict, CaseStageLog
+from .routers import current_lab, using_lab
+from .task_runtime import fan_out, shard_ranges, singleton
 
 logger = logging.getLogger(__name__)
 
 
+def lab_shards(queryset_factory):
+    """
+    ``(start, end, lab)`` shards of the queryset of every lab.
+    """
+    shards = []
+    for lab in lab_codes():
+        with using_lab(lab):
+            shards += [
+                (start, end, lab) for start, end in shard_ranges(queryset_factory())
+            ]
+    return shards
+
+
+def _idle_cases():
+    # Получаем все неархивные кейсы с приоритетом "standard"
+    return Case.objects.filter(
+        lab=current_lab(), archived=False, is_returned=False, priority="standard"
+    )
+
+
 @shared_task
+@singleton()
 def check_and_update_case_priorities():
     """
     Check all cases and update their priority to 'urgent' if they've been idle for more than 16 hours.
     """
-    # Получаем все неархивные кейсы с приоритетом "standard"
-    cases = Case.objects.filter(archived=False, is_returned=False, priority="standard")
+    return fan_out(
+        update_case_priorities_shard,
+        lab_shards(_idle_cases),
+        "check_and_update_case_priorities",
+    )
+
+
+@shared_task
+def update_case_priorities_shard(start, end, lab=None):
+    with using_lab(lab):
+        return _update_case_priorities(start, end)
+
+
+def _update_case_priorities(start, end):
+    escalated = 0
+    cases = _idle_cases().filter(pk__gte=start, pk__lt=end)
 
     for case in cases:
         if case.updated_at + timedelta(hours=16) < now():
             case.priority = "urgent"
-            case.save()
+            try:
+                case.save()
+            except CaseConflict:
+                # Кейс только что изменили, значит он больше не простаивает
+                continue
+            escalated += 1
             logger.info(
                 f"Case {case.case_number} priority escalated to 'urgent' due to 16+ hours of inactivity"
             )
@@ -30,60 +73,178 @@ def check_and_update_case_priorities():
                 f"Case {case.case_number} still within 16-hour window, no update needed"
             )
 
-    return "Priority check completed"
+    return {"escalated": escalated}
+
+
+def _outdated_logs():
+    config = get_config()
+    expiration_time = now() - config.CASE_STAGE_LOG_EXPIRES_AFTER
+    return CaseStageLog.objects.filter(
+        lab=current_lab(), start_time__lte=expiration_time
+    )
 
 
 @shared_task
+@singleton()
 def delete_outdated_case_stage_logs():
     """
     Deletes outdated logs of case stages based on the CASE_STAGE_LOG_EXPIRES_AFTER setting.
     """
-    expiration_time = now() - config.CASE_STAGE_LOG_EXPIRES_AFTER
-    deleted_count, _ = CaseStageLog.objects.filter(
-        created_at__lte=expiration_time
-    ).delete()
-    logger.info(
-        f"Deleted {deleted_count} case stage logs older than {config.CASE_STAGE_LOG_EXPIRES_AFTER}."
+    return fan_out(
+        delete_outdated_case_stage_logs_shard,
+        lab_shards(_outdated_logs),
+        "delete_outdated_case_stage_logs",
     )
-    return f"Deleted {deleted_count} logs"
 
 
 @shared_task
-def archive_completed_cases():
-    """
-    Archives completed cases that were completed earlier than AUTO_ARCHIVE_CASE_TIMEOUT.
-    It is assumed that a 'completed' case is a case at the last stage without next_state_intent.
-    """
+def delete_outdated_case_stage_logs_shard(start, end, lab=None):
+    with using_lab(lab):
+        deleted_count, _ = _outdated_logs().filter(pk__gte=start, pk__lt=end).delete()
+    logger.info(
+        f"Deleted {deleted_count} case stage logs older than {get_config().CASE_STAGE_LOG_EXPIRES_AFTER}."
+    )
+    return {"deleted": deleted_count}
+
+
+def _completed_cases():
+    config = get_config()
     archive_threshold = now() - config.AUTO_ARCHIVE_CASE_TIMEOUT
 
-    last_stage = Stage.objects.get(stage_group=config.LAST_STAGE_GROUP)
+    last_stage = config.last_stage
 
-    completed_cases = Case.objects.filter(
+    return Case.objects.filter(
+        lab=current_lab(),
         current_stage=last_stage,
         archived=False,
         next_state_intent__isnull=True,
         updated_at__lt=archive_threshold,
     )
 
+
+@shared_task
+@singleton()
+def archive_completed_cases():
+    """
+    Archives completed cases that were completed earlier than AUTO_ARCHIVE_CASE_TIMEOUT.
+    It is assumed that a 'completed' case is a case at the last stage without next_state_intent.
+    """
+    return fan_out(
+        archive_completed_cases_shard,
+        lab_shards(_completed_cases),
+        "archive_completed_cases",
+    )
+
+
+@shared_task
+def archive_completed_cases_shard(start, end, lab=None):
+    with using_lab(lab):
+        return _archive_completed_cases(start, end)
+
+
+def _archive_completed_cases(start, end):
+    completed_cases = _completed_cases().filter(pk__gte=start, pk__lt=end)
+
     archived_count = 0
     for case in completed_cases:
-        case.archive_case()
+        try:
+            case.archive_case()
+        except CaseConflict:
+            # Кейс изменили во время архивации, проверим при следующем запуске
+            continue
         logger.info(
             f"Archived case {case.case_number} (completed on {case.updated_at})"
         )
         archived_count += 1
 
     logger.info(
-        f"Archived {archived_count} completed cases older than {config.AUTO_ARCHIVE_CASE_TIMEOUT}."
+        f"Archived {archived_count} completed cases older than {get_config().AUTO_ARCHIVE_CASE_TIMEOUT}."
     )
-    return f"Archived {archived_count} cases"
+    return {"archived": archived_count}
+
+
+def _each_database(run):
+    """
+    Call ``run(alias)`` for the primary and every lab database. A failed
+    database does not stop the others; BackupError is raised at the end.
+    """
+    results, failed = [], []
+    for alias in backup.backup_databases():
+        try:
+            results.append(run(alias))
+        except backup.BackupError as e:
+            logger.error(f"Backup task failed for database {alias}: {e}")
+            failed.append(alias)
+    if failed:
+        raise backup.BackupError(f"Failed for {', '.join(failed)}")
+    return results
 
 
 @shared_task
+@singleton()
 def backup_database():
-    try:
-        call_command("dbbackup")
-        logger.info("Database backup completed")
-    except Exception as e:
-        logger.warning(f"Something went wrong {e}")
-    return "Database backup completed"
+    """
+    Full compressed backup of the primary and every lab database to BACKUP_DIR.
+    """
+
+    def run(alias):
+        record = backup.full_backup(using=alias)
+        logger.info(
+            f"Database {alias} backup {record.path} ({record.size} bytes) completed in {record.duration:.1f}s"
+        )
+        return record.duration
+
+    durations = _each_database(run)
+    return f"Database backup completed in {sum(durations):.1f}s"
+
+
+@shared_task
+@singleton()
+def backup_case_stage_logs():
+    """
+    Incremental backup of the case stage logs added or closed since the last
+    run, in the primary and every lab database.
+    """
+
+    def run(alias):
+        record = backup.incremental_backup(CaseStageLog, using=alias)
+        logger.info(
+            f"Backed up {record.rows} case stage logs of {alias} to {record.path} in {record.duration:.1f}s"
+        )
+        return record.rows
+
+    rows = _each_database(run)
+    return f"Backed up {sum(rows)} case stage logs"
+
+
+@shared_task
+@singleton()
+def verify_database_backup():
+    """
+    Restore the latest full backup of every database into a scratch database
+    and check it.
+    """
+
+    def run(alias):
+        record = backup.verify_backup(using=alias)
+        logger.info(
+            f"Backup {record.path} restored and verified in {record.duration:.1f}s"
+        )
+        return record.duration
+
+    durations = _each_database(run)
+    return f"Backup verified in {sum(durations):.1f}s"
+
+
+@shared_task
+@singleton()
+def aggregate_employee_productivity():
+    """
+    Fold new case stage logs of every lab into the precomputed employee
+    productivity table.
+    """
+    # Все лаборатории пишут в одну таблицу на основной базе: по очереди
+    results = fan_out_labs(productivity.aggregate_stage_logs, max_workers=1)
+    processed = sum(results.values())
+    logger.info(f"Aggregated {processed} case stage logs into employee productivity")
+    return f"Aggregated {processed} logs"
@@ -1 +1,2043 @@
-# Create your tests here.
+import gzip
+import io
+import json
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+from celery.signals import task_postrun, task_prerun
+from constance import config
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import F, Q, Sum
+from django.test import (
+    Client,
+    LiveServerTestCase,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+)
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils.timezone import now
+from guardian.shortcuts import assign_perm
+
+from case_tracking.celery import app as celery_app
+
+from . import (
+    authentication,
+    backup,
+    barcodes,
+    history,
+    labels,
+    labs,
+    load_simulation,
+    productivity,
+    profiling,
+    query_log,
+    reference_data,
+    tasks,
+    work_queue,
+)
+from .admin import CaseAdmin, CaseStageLogAdmin
+from .admin_paging import EstimatedCountPaginator
+from .authentication import invalidate_station_tokens
+from .benchmark import (
+    SCENARIOS,
+    compare_reports,
+    generate_dataset,
+    run_benchmarks,
+    run_startup_benchmarks,
+)
+from .config_snapshot import get_config
+from .forms import EmployeeBarcodeAssignForm, StageBarcodeAssignForm
+from .middleware import PRIMARY_PIN_COOKIE
+from .models import (
+    AggregationCheckpoint,
+    BackupRecord,
+    BarcodeSequence,
+    Case,
+    CaseConflict,
+    CaseQuerySet,
+    CaseStageLog,
+    CustomUser,
+    EmployeeStageHour,
+    Lab,
+    NextStage,
+    ProfileRecord,
+    ReturnReason,
+    ScanStation,
+    SlowQuery,
+    Stage,
+)
+from .permissions import CasePermissionCache
+from .routers import (
+    LabRouter,
+    PrimaryReplicaRouter,
+    pinned_to_primary,
+    replica_reads,
+    using_lab,
+)
+from .task_runtime import TaskLock, shard_ranges, verify_beat_schedule
+from .timeline import case_timeline
+
+
+class BenchmarkHarnessTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=5, stages=4, cases=60, logs_per_case=3)
+
+    def test_every_scenario_runs(self):
+        report = run_benchmarks(iterations=1, warmup=0)
+
+        self.assertEqual(report["dataset"]["cases"], 60)
+        expected = {name for name, entry in SCENARIOS.items() if not entry["optional"]}
+        self.assertEqual(set(report["scenarios"]), expected)
+        for name, result in report["scenarios"].items():
+            self.assertGreater(result["queries"], 0, name)
+            self.assertNotEqual(result["status"], 500, name)
+
+    def test_compare_reports_flags_regressions(self):
+        baseline = {"scenarios": {"board": {"median_ms": 10.0, "queries": 3}}}
+        report = {"scenarios": {"board": {"median_ms": 20.0, "queries": 4}}}
+
+        self.assertEqual(len(compare_reports(report, baseline, tolerance=0.25)), 2)
+        self.assertEqual(compare_reports(baseline, baseline), [])
+
+
+class StartupTests(SimpleTestCase):
+    def test_worker_start_skips_web_modules(self):
+        # Воркер не должен загружать админку, представления и клиент Redis
+        code = (
+            "import sys\n"
+            "from case_tracking.celery import app\n"
+            "app.loader.import_default_modules()\n"
+            "assert 'core.tasks' in sys.modules\n"
+            "print(','.join(m for m in ('core.admin', 'core.views', 'redis') if m in sys.modules))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+        )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "")
+
+    def test_startup_benchmark_report(self):
+        report = run_startup_benchmarks(
+            iterations=1, warmup=0, only=["startup_django_setup"]
+        )
+
+        self.assertEqual(list(report["scenarios"]), ["startup_django_setup"])
+        self.assertGreater(report["scenarios"]["startup_django_setup"]["median_ms"], 0)
+
+
+class HotQueryIndexTests(TestCase):
+    """
+    Every hot query from views, admin views and tasks must be answered from an index.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=5, stages=4, cases=200, logs_per_case=3)
+        cls.case = Case.objects.filter(archived=False).first()
+
+    def setUp(self):
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, msg=f"{queryset.query}\n{plan}")
+
+    def test_case_queries(self):
+        threshold = now() - timedelta(hours=16)
+        self.assertUsesIndex(
+            Case.objects.filter(archived=False, is_returned=False),
+            "case_active_created_idx",
+        )
+        self.assertUsesIndex(
+            Case.objects.filter(
+                archived=False,
+                is_returned=False,
+                priority="standard",
+                updated_at__lt=threshold,
+            ).order_by(),
+            "case_active_priority_idx",
+        )
+        self.assertUsesIndex(
+            Case.objects.filter(
+                current_stage=self.case.current_stage,
+                archived=False,
+                next_state_intent__isnull=True,
+                updated_at__lt=threshold,
+            ).order_by(),
+            "case_open_stage_updated_idx",
+        )
+        self.assertUsesIndex(
+            Case.objects.filter(archived=True), "case_archived_created_idx"
+        )
+        self.assertUsesIndex(
+            Case.objects.filter(is_returned=True, archived=False),
+            "case_returned_created_idx",
+        )
+
+    def test_case_stage_log_queries(self):
+        self.assertUsesIndex(
+            CaseStageLog.objects.filter(case=self.case).order_by("-start_time")[:1],
+            "log_case_start_idx",
+        )
+        self.assertUsesIndex(
+            self.case.stage_logs_case.filter(stage=self.case.current_stage).order_by(
+                "-start_time"
+            )[:1],
+            "log_case_stage_start_idx",
+        )
+        self.assertUsesIndex(
+            self.case.stage_logs_case.filter(end_time__isnull=True).order_by()[:1],
+            "log_one_open_per_case",
+        )
+        self.assertUsesIndex(
+            CaseStageLog.objects.filter(start_time__lte=now() - timedelta(days=30)),
+            "log_start_time_idx",
+        )
+
+
+class CasePermissionCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(
+            employees=2, stages=3, cases=500, logs_per_case=1, active_ratio=1.0
+        )
+        cls.cases = list(Case.objects.filter(archived=False, is_returned=False))
+        cls.allowed = cls.cases[::2]
+        cls.manager = CustomUser.objects.create_user(
+            "staff@example.com", "secret", is_staff=True, role=CustomUser.MANAGER
+        )
+        assign_perm(
+            "core.manage_case",
+            cls.manager,
+            Case.objects.filter(pk__in=[case.pk for case in cls.allowed]),
+        )
+        assign_perm("core.archive_cases", cls.manager, cls.allowed[0])
+
+    def test_checks_on_500_cases_cost_constant_queries(self):
+        permissions = CasePermissionCache(self.manager)
+        with self.assertNumQueries(2):
+            permissions.prefetch(self.cases)
+        with self.assertNumQueries(0):
+            granted = [
+                case
+                for case in self.cases
+                if permissions.has_perm("core.manage_case", case)
+            ]
+            permissions.get_perms(self.cases[-1])
+
+        self.assertEqual(granted, self.allowed)
+
+    def test_case_processing_uses_object_permissions(self):
+        self.client.force_login(self.manager)
+
+        response = self.client.get(reverse("case_processing:"))
+
+        cases_data = response.context["cases_data"]
+        self.assertEqual(len(cases_data), len(self.allowed))
+        perms = {case.pk: case_perms for _, _, case, case_perms in cases_data}
+        self.assertIn("archive_cases", perms[self.allowed[0].pk])
+        self.assertNotIn("archive_cases", perms[self.allowed[1].pk])
+
+
+class CaseProcessingBulkActionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(
+            employees=2, stages=3, cases=40, logs_per_case=1, active_ratio=1.0
+        )
+        cls.manager = CustomUser.objects.get(is_superuser=True)
+
+    def setUp(self):
+        self.client.force_login(self.manager)
+
+    def post(self, action, cases, **data):
+        return self.client.post(
+            reverse("case_processing:"),
+            {"bulk_action": action, "case_ids": [case.pk for case in cases], **data},
+        )
+
+    def test_bulk_archive(self):
+        cases = list(Case.objects.filter(archived=False))
+
+        self.post("archive", cases)
+
+        self.assertFalse(Case.objects.filter(archived=False).exists())
+        self.assertFalse(
+            Case.objects.filter(archived=True, last_updated_by__isnull=True).exists()
+        )
+
+    def test_bulk_archive_query_count_does_not_grow(self):
+        cases = list(Case.objects.filter(archived=False))
+        with CaptureQueriesContext(connection) as few:
+            self.post("archive", cases[:5])
+        with CaptureQueriesContext(connection) as many:
+            self.post("archive", cases[5:])
+
+        self.assertEqual(len(few), len(many))
+
+    def test_bulk_transition_moves_allowed_cases_and_logs(self):
+        stage = Stage.objects.get(name="stage_001")
+        movable = list(Case.objects.filter(current_stage__name="stage_000"))
+        others = list(Case.objects.exclude(current_stage__name="stage_000"))
+
+        response = self.post("transition", movable + others, transition=stage.pk)
+
+        self.assertEqual(
+            Case.objects.filter(current_stage=stage).count(),
+            len(movable) + sum(case.current_stage_id == stage.pk for case in others),
+        )
+        for case in movable:
+            logs = list(case.stage_logs_case.order_by("start_time"))
+            self.assertEqual(logs[-1].stage, stage)
+            self.assertEqual(
+                case.stage_logs_case.filter(end_time__isnull=True).count(), 1
+            )
+        messages = [str(message) for message in response.wsgi_request._messages]
+        self.assertIn(f"{len(movable)} case(s) transitioned to stage_001", messages)
+
+    def test_bulk_return(self):
+        cases = list(Case.objects.filter(archived=False))[:3]
+        reason = ReturnReason.objects.get(reason="chip")
+
+        self.post("return", cases, return_reason_id=reason.pk)
+
+        self.assertEqual(
+            Case.objects.filter(is_returned=True, return_reason=reason).count(), 3
+        )
+
+
+class CaseProcessingAsyncActionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(
+            employees=2, stages=3, cases=40, logs_per_case=1, active_ratio=1.0
+        )
+        cls.manager = CustomUser.objects.get(is_superuser=True)
+
+    def setUp(self):
+        self.client.force_login(self.manager)
+
+    def post(self, case, **data):
+        return self.client.post(
+            reverse("case_processing:"),
+            {"case_id": case.pk, **data},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+
+    def movable_case(self):
+        return next(
+            case
+            for case in Case.objects.filter(archived=False, is_returned=False)
+            if NextStage.objects.filter(current=case.current_stage).exists()
+        )
+
+    def test_transition_returns_updated_row(self):
+        case = self.movable_case()
+        stage = NextStage.objects.filter(current=case.current_stage).first().next
+
+        data = self.post(case, transition=stage.pk).json()
+
+        self.assertFalse(data["removed"])
+        self.assertIn(f'id="case-row-{case.pk}"', data["html"])
+        self.assertIn(f"state: {stage.name}", data["html"])
+        self.assertEqual(
+            data["messages"],
+            [
+                {
+                    "level": "success",
+                    "text": f"Case #{case.case_number} transitioned to {stage.name}",
+                }
+            ],
+        )
+
+    def test_archive_removes_row(self):
+        case = Case.objects.filter(archived=False).first()
+
+        data = self.post(case, archive="").json()
+
+        self.assertTrue(data["removed"])
+        self.assertEqual(data["html"], "")
+        self.assertTrue(Case.objects.get(pk=case.pk).archived)
+
+    def test_query_count_does_not_depend_on_active_cases(self):
+        first, second = Case.objects.filter(archived=False)[:2]
+        with CaptureQueriesContext(connection) as many:
+            self.post(first, archive="")
+        Case.objects.exclude(pk=second.pk).update(archived=True)
+        with CaptureQueriesContext(connection) as one:
+            self.post(second, archive="")
+
+        self.assertEqual(len(many), len(one))
+
+
+class ConfigSnapshotTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=1, stages=3, cases=1, logs_per_case=1)
+
+    def test_snapshot_is_read_from_memory(self):
+        get_config().first_stage
+        get_config().last_stage
+
+        with self.assertNumQueries(0):
+            snapshot = get_config()
+            first_stage, last_stage = snapshot.first_stage, snapshot.last_stage
+
+        self.assertEqual(first_stage.stage_group, config.FIRST_STAGE_GROUP)
+        self.assertEqual(last_stage.stage_group, config.LAST_STAGE_GROUP)
+
+    def test_constance_change_refreshes_snapshot(self):
+        old = get_config()
+        config.AUTO_ARCHIVE_CASE_TIMEOUT = timedelta(minutes=42)
+
+        snapshot = get_config()
+
+        self.assertIsNot(snapshot, old)
+        self.assertEqual(snapshot.AUTO_ARCHIVE_CASE_TIMEOUT, timedelta(minutes=42))
+
+    @override_settings(CONSTANCE_SNAPSHOT_TTL=0)
+    def test_snapshot_expires(self):
+        self.assertIsNot(get_config(), get_config())
+
+
+class ConcurrentScanTests(TransactionTestCase):
+    """
+    Stations that loaded the same case race to transition it. Every successful
+    transition must be kept and the case must keep exactly one open log.
+    """
+
+    stations = 8
+    moves_per_station = 5
+
+    def setUp(self):
+        generate_dataset(
+            employees=self.stations, stages=4, cases=1, logs_per_case=1, active_ratio=1
+        )
+        self.case = Case.objects.get()
+        self.stages = list(Stage.objects.order_by("pk"))
+        self.employees = list(CustomUser.objects.filter(barcode__isnull=False))
+
+    def test_parallel_transitions_lose_no_updates(self):
+        # SQLite allows a single writer, there the database steps are serialized
+        # but still interleave between stations.
+        lock = threading.Lock() if connection.vendor == "sqlite" else nullcontext()
+        conflicts = []
+
+        def station(index):
+            try:
+                moved = 0
+                while moved < self.moves_per_station:
+                    with lock:
+                        case = Case.objects.get(pk=self.case.pk)
+                    target = next(
+                        stage
+                        for stage in self.stages[index % len(self.stages) :]
+                        + self.stages
+                        if stage.pk != case.current_stage_id
+                    )
+                    time.sleep(0.001)
+                    try:
+                        with lock:
+                            case.transition_stage(target, user=self.employees[index])
+                        moved += 1
+                    except CaseConflict:
+                        conflicts.append(index)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=station, args=(index,))
+            for index in range(self.stations)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        transitions = self.stations * self.moves_per_station
+        case = Case.objects.get(pk=self.case.pk)
+        self.assertEqual(case.version, transitions)
+        self.assertEqual(case.stage_logs_case.count(), 1 + transitions)
+        open_logs = list(case.stage_logs_case.filter(end_time__isnull=True))
+        self.assertEqual(len(open_logs), 1)
+        self.assertEqual(open_logs[0].stage_id, case.current_stage_id)
+        self.assertTrue(conflicts)
+
+    def test_stale_case_raises_conflict(self):
+        first = Case.objects.get(pk=self.case.pk)
+        second = Case.objects.get(pk=self.case.pk)
+        first.transition_stage(self.stages[1])
+
+        with self.assertRaises(CaseConflict):
+            second.transition_stage(self.stages[2])
+
+        self.assertEqual(Case.objects.get().current_stage, self.stages[1])
+        self.assertEqual(CaseStageLog.objects.filter(end_time__isnull=True).count(), 1)
+
+    def test_save_with_new_pk_inserts(self):
+        case = Case(
+            pk=self.case.pk + 100,
+            case_number="NEW-1",
+            barcode="NEW1",
+            current_stage=self.stages[0],
+        )
+
+        case.save()
+
+        self.assertTrue(Case.objects.filter(pk=case.pk, case_number="NEW-1").exists())
+        self.assertEqual(case.stage_logs_case.count(), 1)
+
+    def test_raw_save_overwrites_without_version_check(self):
+        case = Case.objects.get(pk=self.case.pk)
+        case.case_number = "RAW-1"
+
+        case.save_base(raw=True)
+
+        self.assertEqual(Case.objects.get(pk=case.pk).case_number, "RAW-1")
+
+
+class PrimaryReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = PrimaryReplicaRouter(replicas=["replica_0"])
+
+    def test_reads_use_primary_unless_replica_reads_allowed(self):
+        self.assertEqual(self.router.db_for_read(Case), "default")
+        with replica_reads():
+            self.assertEqual(self.router.db_for_read(Case), "replica_0")
+            with pinned_to_primary():
+                self.assertEqual(self.router.db_for_read(Case), "default")
+
+    def test_writes_and_sessions_use_primary(self):
+        with replica_reads():
+            self.assertEqual(self.router.db_for_write(Case), "default")
+            self.assertEqual(self.router.db_for_read(Session), "default")
+
+
+class ReplicaReadYourWritesTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        generate_dataset(employees=2, stages=3, cases=10, logs_per_case=1)
+        self.replica = connections[settings.DATABASE_REPLICAS[0]]
+        self.employee = CustomUser.objects.filter(barcode__isnull=False).first()
+
+    def test_board_reads_replica_until_station_writes(self):
+        with CaptureQueriesContext(self.replica) as replica_queries:
+            self.client.get(reverse("case_list"))
+        self.assertGreater(len(replica_queries), 0)
+
+        response = self.client.post(
+            reverse("scan_barcodes"),
+            {
+                "employee_barcode": self.employee.barcode,
+                "case_barcode": "NEW-CASE",
+                "stage_barcode": get_config().first_stage.barcode,
+            },
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(PRIMARY_PIN_COOKIE, response.cookies)
+
+        with CaptureQueriesContext(self.replica) as replica_queries:
+            response = self.client.get(reverse("case_list"))
+        self.assertEqual(len(replica_queries), 0)
+        self.assertIn(
+            "CASE-NEW-CASE", [case["case_number"] for case in response.context["cases"]]
+        )
+
+
+class BoardConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(
+            employees=2, stages=3, cases=20, logs_per_case=1, returned_ratio=0.5
+        )
+
+    def test_unchanged_board_answers_304_without_heavy_query(self):
+        for name in ("case_list", "archived_cases", "returned_cases"):
+            response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, 200)
+
+            with self.assertNumQueries(1):
+                cached = self.client.get(
+                    reverse(name), HTTP_IF_NONE_MATCH=response["ETag"]
+                )
+            self.assertEqual(cached.status_code, 304, name)
+
+    def test_changed_board_is_rendered_again(self):
+        response = self.client.get(reverse("archived_cases"))
+        case = Case.objects.filter(archived=True).first()
+        case.shade = "A2"
+        case.save()
+
+        response = self.client.get(
+            reverse("archived_cases"), HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_case_list_query_count_does_not_grow(self):
+        Case.objects.update(archived=False, is_returned=False)
+        case = Case.objects.create(
+            case_number="BOARD-1",
+            barcode="BOARD-1",
+            current_stage=Stage.objects.first(),
+        )
+        case.stage_logs_case.update(start_time=now() - timedelta(hours=2, minutes=5))
+        self.client.get(reverse("case_list"))
+
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get(
+                reverse("case_list"), {"search": case.case_number}
+            )
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(reverse("case_list"))
+
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(
+            [row["time_on_stage"] for row in response.context["cases"]],
+            ["2 h., 5 min."],
+        )
+
+
+class ReferenceDataCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=3, stages=3, cases=5, logs_per_case=1)
+
+    def test_lists_are_served_from_cache(self):
+        stages = reference_data.stages()
+        employees = reference_data.employees()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(reference_data.stages(), stages)
+            self.assertEqual(reference_data.employees(), employees)
+            StageBarcodeAssignForm()
+            EmployeeBarcodeAssignForm()
+
+        self.assertEqual(len(stages), Stage.objects.count())
+        self.assertEqual(len(employees), CustomUser.objects.count())
+
+    def test_model_changes_invalidate_cache(self):
+        reference_data.stages()
+        reference_data.employees()
+        stage = Stage.objects.first()
+        stage.display_name = "Renamed"
+        stage.save()
+        employee = CustomUser.objects.filter(is_superuser=False).first()
+        employee.is_active = False
+        employee.save()
+
+        self.assertIn("Renamed", [name for _, _, name in reference_data.stages()])
+        self.assertNotIn(
+            employee.pk, [pk for pk, _, _ in reference_data.active_employees()]
+        )
+
+    def test_cached_board_rows_follow_reference_changes(self):
+        case = Case.objects.filter(archived=True).first()
+        self.assertContains(
+            self.client.get(reverse("archived_cases")), case.case_number
+        )
+        stage = case.current_stage
+        stage.name = "renamed_stage"
+        stage.save()
+
+        response = self.client.get(reverse("archived_cases"))
+
+        self.assertContains(response, "<td>renamed_stage</td>")
+
+    def test_login_keeps_employee_cache(self):
+        reference_data.employees()
+        employee = CustomUser.objects.filter(is_superuser=False).first()
+        self.client.force_login(employee)
+
+        with self.assertNumQueries(0):
+            reference_data.employees()
+
+
+class PeriodicTaskRuntimeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=2, stages=3, cases=30, logs_per_case=2)
+        Case.objects.update(updated_at=now() - timedelta(days=2))
+
+    def setUp(self):
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+
+    def test_beat_schedule_names_registered_tasks(self):
+        verify_beat_schedule(celery_app)
+
+        outdated = SimpleNamespace(
+            tasks=celery_app.tasks,
+            conf=SimpleNamespace(
+                beat_schedule={"old": {"task": "cases.tasks.archive_completed_cases"}}
+            ),
+        )
+        with self.assertRaises(ImproperlyConfigured):
+            verify_beat_schedule(outdated)
+
+    def test_running_task_is_not_started_twice(self):
+        urgent = Case.objects.filter(priority="urgent").count()
+        lock = TaskLock("check_and_update_case_priorities")
+        token = lock.acquire()
+        self.assertIsNotNone(token)
+
+        result = tasks.check_and_update_case_priorities()
+
+        self.assertTrue(result.startswith("Skipped"))
+        self.assertEqual(Case.objects.filter(priority="urgent").count(), urgent)
+        lock.release(token)
+        self.assertIsInstance(tasks.check_and_update_case_priorities(), dict)
+
+    def test_shard_ranges_cover_queryset(self):
+        queryset = Case.objects.all()
+        ranges = shard_ranges(queryset, shard_size=7)
+
+        self.assertEqual(len(ranges), 5)
+        covered = sum(
+            queryset.filter(pk__gte=start, pk__lt=end).count() for start, end in ranges
+        )
+        self.assertEqual(covered, queryset.count())
+        self.assertEqual(shard_ranges(Case.objects.none(), shard_size=7), [])
+
+    @override_settings(TASK_SHARD_SIZE=4)
+    def test_sharded_task_aggregates_results(self):
+        idle = Case.objects.filter(
+            archived=False, is_returned=False, priority="standard"
+        ).count()
+
+        result = tasks.check_and_update_case_priorities()
+
+        self.assertEqual(result, {"escalated": idle})
+        self.assertFalse(
+            Case.objects.filter(
+                archived=False, is_returned=False, priority="standard"
+            ).exists()
+        )
+        # Блокировка снята, следующий запуск проходит
+        self.assertEqual(
+            tasks.check_and_update_case_priorities().get("escalated", 0), 0
+        )
+
+
+class BackupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=3, stages=3, cases=20, logs_per_case=2)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(BACKUP_DIR=directory.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_parallel_compression_is_one_gzip_stream(self):
+        chunks = [bytes([i]) * 100_000 for i in range(10)]
+        with tempfile.TemporaryFile() as target:
+            size = backup.compress_chunks(chunks, target, workers=4)
+            target.seek(0)
+            self.assertEqual(gzip.decompress(target.read()), b"".join(chunks))
+        self.assertEqual(size, 1_000_000)
+
+    def test_full_backup_is_restored_and_verified(self):
+        # Многострочный текст со ";" восстанавливается по одному оператору
+        Case.objects.filter(pk=Case.objects.first().pk).update(
+            return_description="first line;\nsecond line"
+        )
+        record = backup.full_backup()
+
+        self.assertEqual(record.status, BackupRecord.SUCCESS)
+        self.assertGreater(record.size, 0)
+
+        check = backup.verify_backup()
+
+        self.assertEqual(check.status, BackupRecord.SUCCESS)
+        self.assertEqual(check.details["backup"], record.pk)
+        self.assertEqual(check.details["restored"], record.details["counts"])
+        self.assertEqual(
+            check.details["restored"]["core_casestagelog"], CaseStageLog.objects.count()
+        )
+
+    def test_failed_full_backup_leaves_no_partial_file(self):
+        with mock.patch.object(
+            backup, "compress_chunks", side_effect=OSError("No space left on device")
+        ):
+            with self.assertRaises(backup.BackupError):
+                backup.full_backup()
+
+        self.assertEqual(list(backup.backup_dir().iterdir()), [])
+        record = BackupRecord.objects.get(kind=BackupRecord.FULL)
+        self.assertEqual(record.status, BackupRecord.FAILED)
+
+    def test_dump_process_is_killed_when_consumer_stops(self):
+        processes = []
+        popen = subprocess.Popen
+
+        def start(*args, **kwargs):
+            processes.append(popen(*args, **kwargs))
+            return processes[-1]
+
+        endless = [sys.executable, "-c", "while True: print('x' * 1000)"]
+        with mock.patch.object(backup, "_pg_command", return_value=(endless, {})):
+            with mock.patch("subprocess.Popen", start):
+                chunks = backup._pg_dump_chunks({"NAME": "db"})
+                next(chunks)
+                chunks.close()
+
+        self.assertEqual(processes[0].returncode, -9)
+
+    def test_incremental_backup_exports_new_and_closed_logs(self):
+        first = backup.incremental_backup(CaseStageLog)
+        self.assertEqual(first.rows, CaseStageLog.objects.count())
+
+        case = Case.objects.filter(archived=False).first()
+        case.transition_stage(
+            new_stage=Stage.objects.exclude(pk=case.current_stage_id).first(),
+            user=CustomUser.objects.first(),
+        )
+        second = backup.incremental_backup(CaseStageLog)
+
+        # Новый лог и закрытый предыдущий
+        self.assertEqual(second.rows, 2)
+        self.assertEqual(second.details["previous"], first.pk)
+
+        CaseStageLog.objects.filter(case=case).delete()
+        backup.restore_incremental(first.path)
+        restored = backup.restore_incremental(second.path)
+
+        self.assertEqual(restored, 2)
+        self.assertEqual(
+            CaseStageLog.objects.filter(case=case, end_time__isnull=True).count(), 1
+        )
+
+    def test_incremental_backup_rereads_late_commits(self):
+        first = backup.incremental_backup(CaseStageLog)
+        case = Case.objects.filter(archived=False).first()
+        case.transition_stage(
+            new_stage=Stage.objects.exclude(pk=case.current_stage_id).first()
+        )
+        late = CaseStageLog.objects.latest("pk")
+        # pk выдан до прошлой копии, а строка зафиксирована уже после неё
+        first.details["last_pk"] = late.pk
+        first.save()
+
+        second = backup.incremental_backup(CaseStageLog)
+
+        with gzip.open(second.path, "rt") as source:
+            exported = {json.loads(line)["id"] for line in source}
+        self.assertIn(late.pk, exported)
+
+
+class EmployeeProductivityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(
+            employees=4, stages=4, cases=40, logs_per_case=3, returned_ratio=0.3
+        )
+        # Сгенерированные логи доходят до нескольких часов в будущее
+        CaseStageLog.objects.update(
+            start_time=F("start_time") - timedelta(days=1),
+            end_time=F("end_time") - timedelta(days=1),
+        )
+
+    def aggregate(self, **kwargs):
+        # Без окна фиксации: в тесте все переходы уже зафиксированы
+        return productivity.aggregate_stage_logs(horizon=now(), **kwargs)
+
+    def totals(self):
+        return EmployeeStageHour.objects.aggregate(
+            scans=Sum("scans"), handled=Sum("handled"), completed=Sum("completed")
+        )
+
+    def test_aggregation_matches_stage_logs(self):
+        processed = self.aggregate(batch_size=25)
+
+        self.assertEqual(processed, CaseStageLog.objects.count())
+        totals = self.totals()
+        self.assertEqual(totals["scans"], CaseStageLog.objects.count())
+        self.assertEqual(
+            totals["completed"],
+            CaseStageLog.objects.filter(stage=get_config().last_stage).count(),
+        )
+        # Время работы считается для каждого лога, кроме первого у кейса и возвратов
+        logs = CaseStageLog.objects.order_by("case", "start_time")
+        handled = sum(
+            1
+            for previous, log in zip(logs, logs[1:])
+            if previous.case_id == log.case_id and not log.is_returned
+        )
+        self.assertEqual(totals["handled"], handled)
+
+    def test_only_new_logs_are_processed(self):
+        self.aggregate()
+        before = self.totals()
+        self.assertEqual(self.aggregate(), 0)
+
+        case = Case.objects.filter(archived=False, is_returned=False).first()
+        employee = CustomUser.objects.filter(is_superuser=False).first()
+        case.transition_stage(
+            new_stage=Stage.objects.exclude(pk=case.current_stage_id).first(),
+            user=employee,
+        )
+
+        self.assertEqual(self.aggregate(), 1)
+        after = self.totals()
+        self.assertEqual(after["scans"], before["scans"] + 1)
+        self.assertEqual(after["handled"], before["handled"] + 1)
+        summary = productivity.employee_summary(employee)
+        self.assertEqual(summary["scans"], 1)
+        self.assertEqual(summary["active_hours"], 1)
+
+    def test_recent_logs_wait_for_commit_window(self):
+        self.aggregate()
+        case = Case.objects.filter(archived=False, is_returned=False).first()
+        case.transition_stage(
+            new_stage=Stage.objects.exclude(pk=case.current_stage_id).first()
+        )
+        log = CaseStageLog.objects.latest("pk")
+        # Лог с более ранним start_time, зафиксированный позже
+        CaseStageLog.objects.create(
+            case=case,
+            stage=log.stage,
+            start_time=log.start_time - timedelta(seconds=1),
+            end_time=log.start_time,
+        )
+
+        self.assertEqual(productivity.aggregate_stage_logs(), 0)
+        self.assertEqual(self.aggregate(), 2)
+        self.assertEqual(self.aggregate(), 0)
+        checkpoint = AggregationCheckpoint.objects.get(
+            name=f"{productivity.CHECKPOINT}:{settings.DEFAULT_LAB}"
+        )
+        self.assertEqual(
+            (checkpoint.last_time, checkpoint.last_id), (log.start_time, log.pk)
+        )
+
+    def test_histogram_median(self):
+        histogram = productivity.merge_histograms(
+            [{str(productivity.bucket(seconds)): 1} for seconds in (60, 600, 3600)]
+        )
+        self.assertAlmostEqual(
+            productivity.histogram_median(histogram), 600, delta=600 * 0.1
+        )
+
+    def test_dashboards_read_precomputed_table(self):
+        self.aggregate()
+        manager = CustomUser.objects.get(is_superuser=True)
+        employee = EmployeeStageHour.objects.values_list("user", flat=True).first()
+
+        self.client.force_login(manager)
+        response = self.client.get(reverse("manager_dashboard"), {"days": 30})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["days"], 30)
+        row = response.context["team"][0]
+        self.assertEqual(
+            [stage["stage"] for stage in row["stages"]],
+            sorted(stage["stage"] for stage in row["stages"]),
+        )
+        self.assertTrue(row["stages"])
+
+        self.client.force_login(CustomUser.objects.get(pk=employee))
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("employee_dashboard"), {"days": 30})
+        self.assertEqual(response.status_code, 200)
+
+
+class CaseTimelineTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=2, stages=3, cases=2, logs_per_case=1)
+        cls.case = Case.objects.first()
+        stages = list(Stage.objects.order_by("name"))
+        employee = CustomUser.objects.filter(is_superuser=False).first()
+        CaseStageLog.objects.filter(case=cls.case).delete()
+        start = now() - timedelta(days=30)
+        CaseStageLog.objects.bulk_create(
+            CaseStageLog(
+                case=cls.case,
+                stage=stages[index % len(stages)],
+                user=employee,
+                start_time=start + timedelta(minutes=10 * index),
+                end_time=(
+                    None if index == 299 else start + timedelta(minutes=10 * index + 10)
+                ),
+                is_returned=index == 150,
+                reason="defect" if index == 150 else None,
+            )
+            for index in range(300)
+        )
+
+    def test_timeline_is_one_query(self):
+        # Имена сотрудников берутся из закешированного справочника
+        reference_data.employees()
+        with self.assertNumQueries(1):
+            case, entries = case_timeline(self.case.pk)
+
+        self.assertEqual(case, self.case)
+        self.assertEqual(len(entries), 300)
+        self.assertTrue(
+            all(entry["dwell"] == timedelta(minutes=10) for entry in entries[:-1])
+        )
+        # Текущий этап длится до сих пор
+        self.assertGreater(entries[-1]["dwell"], timedelta(days=25))
+        self.assertEqual(entries[150]["reason"], "defect")
+        self.assertEqual(
+            entries[0]["user"],
+            CaseStageLog.objects.filter(case=self.case).first().user.full_name,
+        )
+
+    def test_timeline_page_and_api(self):
+        response = self.client.get(reverse("case_timeline", args=[self.case.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["returns"], 1)
+
+        response = self.client.get(reverse("case_timeline_api", args=[self.case.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["transitions"], 300)
+        self.assertEqual(response.json()["timeline"][0]["dwell_seconds"], 600)
+
+        missing = Case.objects.order_by("-pk").first().pk + 1
+        response = self.client.get(reverse("case_timeline", args=[missing]))
+        self.assertEqual(response.status_code, 404)
+
+
+class ScanStationAuthenticationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=2, stages=3, cases=2, logs_per_case=1)
+        cls.station = ScanStation(name="Station 1")
+        cls.token = cls.station.set_new_token()
+        cls.station.save()
+
+    def setUp(self):
+        # Кеш токенов живёт дольше, чем транзакция теста
+        invalidate_station_tokens()
+
+    def scan(self, client, case_barcode, **headers):
+        employee = CustomUser.objects.filter(barcode__isnull=False).first()
+        return client.post(
+            reverse("scan_barcodes"),
+            {
+                "employee_barcode": employee.barcode,
+                "case_barcode": case_barcode,
+                "stage_barcode": get_config().first_stage.barcode,
+            },
+            content_type="application/json",
+            **headers,
+        )
+
+    def test_station_token_scans_without_session_or_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        auth = {"HTTP_AUTHORIZATION": f"Station {self.token}"}
+        self.assertEqual(self.scan(client, "NEW-1", **auth).status_code, 201)
+
+        # Токены станций берутся из кеша, без сессии и загрузки пользователя
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.scan(client, "NEW-2", **auth).status_code, 201)
+        tables = " ".join(query["sql"] for query in queries)
+        self.assertNotIn("core_scanstation", tables)
+        self.assertNotIn("django_session", tables)
+
+    def test_invalid_or_rotated_token_is_rejected(self):
+        response = self.scan(Client(), "NEW-1", HTTP_AUTHORIZATION="Station wrong")
+        self.assertEqual(response.status_code, 401)
+
+        self.station.set_new_token()
+        self.station.save()
+        response = self.scan(
+            Client(), "NEW-1", HTTP_AUTHORIZATION=f"Station {self.token}"
+        )
+        self.assertEqual(response.status_code, 401)
+
+    def test_per_process_cache_keeps_tokens_briefly(self):
+        # Сигнал сбрасывает только кеш своего процесса
+        self.assertEqual(
+            authentication.station_tokens_timeout(),
+            authentication.LOCAL_STATION_TOKENS_TIMEOUT,
+        )
+        shared = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+        with override_settings(CACHES=shared):
+            self.assertEqual(
+                authentication.station_tokens_timeout(),
+                authentication.STATION_TOKENS_TIMEOUT,
+            )
+
+    @mock.patch.object(authentication, "_reloaded_at", None)
+    def test_unknown_token_reloads_a_stale_cache_once(self):
+        # Кеш другого процесса: станция создана после его заполнения
+        stale = authentication.station_tokens()
+        station = ScanStation(name="Station 2")
+        token = station.set_new_token()
+        station.save()
+        cache.set(authentication.STATION_TOKENS_KEY, stale)
+
+        response = self.scan(Client(), "NEW-1", HTTP_AUTHORIZATION=f"Station {token}")
+        self.assertEqual(response.status_code, 201)
+
+        # Повторная перезагрузка ограничена по времени
+        with CaptureQueriesContext(connection) as queries:
+            response = self.scan(Client(), "NEW-2", HTTP_AUTHORIZATION="Station wrong")
+        self.assertEqual(response.status_code, 401)
+        self.assertNotIn("core_scanstation", " ".join(q["sql"] for q in queries))
+
+    @override_settings(SCAN_REQUIRE_STATION_TOKEN=True)
+    def test_token_can_be_required(self):
+        response = self.scan(Client(), "NEW-1")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response["WWW-Authenticate"], "Station")
+        response = self.scan(
+            Client(), "NEW-1", HTTP_AUTHORIZATION=f"Station {self.token}"
+        )
+        self.assertEqual(response.status_code, 201)
+
+    def test_failed_login_hashes_password_once(self):
+        employee = CustomUser.objects.filter(is_superuser=False).first()
+        employee.set_password("secret")
+        employee.save()
+
+        with mock.patch.object(
+            PBKDF2PasswordHasher,
+            "encode",
+            autospec=True,
+            wraps=PBKDF2PasswordHasher.encode,
+        ) as encode:
+            response = self.client.post(
+                reverse("login"), {"username": employee.email, "password": "wrong"}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(encode.call_count, 1)
+
+        response = self.client.post(
+            reverse("login"), {"username": employee.email, "password": "secret"}
+        )
+        self.assertRedirects(
+            response, reverse("employee_dashboard"), fetch_redirect_response=False
+        )
+
+
+class BarcodeValidationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=2, stages=3, cases=2, logs_per_case=1)
+        station = ScanStation(name="Station 1")
+        cls.auth = {"HTTP_AUTHORIZATION": f"Station {station.set_new_token()}"}
+        station.save()
+        cls.employee = CustomUser.objects.filter(barcode__isnull=False).first()
+        cls.case = Case.objects.select_related("current_stage").first()
+
+    def setUp(self):
+        invalidate_station_tokens()
+        reference_data.invalidate_stages()
+        reference_data.invalidate_employees()
+
+    def validate(self, field, barcode, **params):
+        return self.client.get(
+            reverse("validate_barcode"),
+            {"field": field, "barcode": barcode, **params},
+            **self.auth,
+        )
+
+    def test_employee_and_case_barcodes(self):
+        response = self.validate("employee", self.employee.barcode)
+        self.assertEqual(
+            response.json(), {"valid": True, "employee": self.employee.full_name}
+        )
+        self.assertFalse(self.validate("employee", "UNKNOWN").json()["valid"])
+
+        self.employee.is_active = False
+        self.employee.save()
+        self.assertFalse(
+            self.validate("employee", self.employee.barcode).json()["valid"]
+        )
+
+        result = self.validate("case", self.case.barcode).json()
+        self.assertTrue(result["exists"])
+        self.assertEqual(result["current_stage"], self.case.current_stage.name)
+        self.assertFalse(self.validate("case", "NEW-1").json()["exists"])
+
+        self.assertEqual(self.validate("color", "X").status_code, 400)
+
+    def test_stage_validation_matches_scan_api(self):
+        first_stage = get_config().first_stage
+        Case.objects.filter(pk=self.case.pk).update(
+            current_stage=Stage.objects.exclude(pk=first_stage.pk).first()
+        )
+        for stage in Stage.objects.filter(barcode__isnull=False):
+            result = self.validate(
+                "stage", stage.barcode, case=self.case.barcode
+            ).json()
+            response = self.client.post(
+                reverse("scan_barcodes"),
+                {
+                    "employee_barcode": self.employee.barcode,
+                    "case_barcode": self.case.barcode,
+                    "stage_barcode": stage.barcode,
+                },
+                content_type="application/json",
+                **self.auth,
+            )
+            if result["valid"]:
+                # Допустимый возврат требует причину, которой в запросе нет
+                self.assertTrue(result["requires_reason"])
+                self.assertEqual(response.json()["error"], "Reason required")
+            else:
+                self.assertEqual(response.json()["detail"], result["detail"])
+
+    def test_employee_and_stage_lookups_use_the_cache(self):
+        stage = get_config().first_stage
+        self.validate("employee", self.employee.barcode)
+        self.validate("stage", stage.barcode)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(
+                self.validate("employee", self.employee.barcode).json()["valid"]
+            )
+            self.assertTrue(self.validate("stage", stage.barcode).json()["valid"])
+        self.assertEqual(len(queries), 0)
+
+
+class LabelGenerationTests(TestCase):
+    def test_code128_encoding(self):
+        # Префикс в наборе B, цифры парами в наборе C
+        self.assertEqual(
+            barcodes._symbols("CS0000000042"),
+            [barcodes.START_B, 35, 51, barcodes.CODE_C, 0, 0, 0, 0, 42],
+        )
+        self.assertEqual(barcodes._symbols("1234")[0], barcodes.START_C)
+        widths = barcodes.code128_widths("CS0000000042")
+        # 9 символов, контрольный и стоп: 11 модулей на символ, 13 на стоп
+        self.assertEqual(sum(widths), 10 * 11 + 13)
+        self.assertEqual(len(widths) % 2, 1)
+
+    def test_allocation_is_ranged_and_skips_existing_barcodes(self):
+        generate_dataset(employees=1, stages=2, cases=1, logs_per_case=1)
+        Case.objects.update(barcode=labels.format_barcode("CS", 41))
+
+        with CaptureQueriesContext(connection) as small:
+            first = labels.allocate_barcodes("case", 10)
+        with CaptureQueriesContext(connection) as large:
+            second = labels.allocate_barcodes("case", 5000)
+        self.assertEqual(first, range(42, 52))
+        self.assertEqual(second, range(52, 5052))
+        self.assertLessEqual(len(large), len(small))
+        self.assertEqual(BarcodeSequence.objects.get(prefix="CS").last_value, 5051)
+
+    def test_missing_stage_barcodes_are_assigned(self):
+        stage = Stage.objects.create(name="new", display_name="New stage")
+        self.assertEqual(
+            labels.assign_missing_barcodes("stage"),
+            [(labels.format_barcode("ST", 1), "New stage")],
+        )
+        stage.refresh_from_db()
+        self.assertIn(stage.barcode, reference_data.stage_barcodes())
+
+    def test_sheets_are_streamed_in_order(self):
+        batch = [(labels.format_barcode("CS", n), f"#{n}") for n in range(300)]
+        for workers in (1, 2):
+            output = io.StringIO()
+            self.assertEqual(labels.write_label_sheets(batch, output, workers), 300)
+            html = output.getvalue()
+            self.assertEqual(html.count('class="page"'), 13)
+            positions = [html.index(f"<div>{barcode}</div>") for barcode, _ in batch]
+            self.assertEqual(positions, sorted(positions))
+
+
+@override_settings(QUERY_COUNT_HEADER=True)
+class StationLoadSimulationTests(LiveServerTestCase):
+    def setUp(self):
+        generate_dataset(
+            employees=3, stages=4, cases=50, logs_per_case=2, active_ratio=1
+        )
+        station = ScanStation(name="Station 1")
+        self.token = station.set_new_token()
+        station.save()
+        invalidate_station_tokens()
+
+    def test_capacity_report(self):
+        # Живой сервер на SQLite делит с тестом одно соединение: параллельные
+        # станции там ломают транзакции, поэтому только одна
+        station_levels = [1] if connection.vendor == "sqlite" else [1, 2]
+        report = load_simulation.run_capacity_test(
+            self.live_server_url,
+            station_levels,
+            duration=0.5,
+            token=self.token,
+            max_p95_ms=10_000,
+            return_ratio=0.3,
+            mistake_ratio=0.1,
+            validate=True,
+        )
+        self.assertEqual(
+            [level["stations"] for level in report["levels"]], station_levels
+        )
+        for level in report["levels"]:
+            self.assertGreater(level["scans"], 0)
+            self.assertEqual(level["errors"], 0)
+            self.assertGreater(level["queries_mean"], 0)
+        self.assertEqual(
+            set(report["levels"][0]["kinds"]) - {"create", "return", "mistake"},
+            {"validate"},
+        )
+        self.assertIsNotNone(report["capacity"])
+        self.assertTrue(Case.objects.filter(barcode__startswith="SIM").exists())
+
+    def test_outcomes_and_capacity(self):
+        samples = [
+            ("create", 201, 10, 5),
+            ("mistake", 400, 20, 3),
+            ("return", None, 30, None),
+        ]
+        level = load_simulation.summarize(4, samples, elapsed=1)
+        self.assertEqual((level["ok"], level["rejected"], level["errors"]), (1, 1, 1))
+        self.assertEqual(level["queries_max"], 5)
+        levels = [level, {**level, "stations": 8, "error_rate": 0, "p95_ms": 500}]
+        self.assertIsNone(load_simulation.capacity(levels, 100, 0.01))
+        self.assertEqual(load_simulation.capacity(levels, 1000, 0.01)["stations"], 8)
+
+
+class ProfilingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=2, stages=3, cases=5, logs_per_case=2)
+        cls.manager = CustomUser.objects.get(email="manager@bench.local")
+
+    def set_rates(self, request_rate, task_rate=0):
+        config.PROFILING_SAMPLE_RATE = request_rate
+        config.PROFILING_TASK_SAMPLE_RATE = task_rate
+        self.addCleanup(setattr, config, "PROFILING_SAMPLE_RATE", 0)
+        self.addCleanup(setattr, config, "PROFILING_TASK_SAMPLE_RATE", 0)
+
+    def test_disabled_by_default(self):
+        self.client.get(reverse("case_list"))
+        self.assertFalse(ProfileRecord.objects.exists())
+
+    def test_sampled_request_is_profiled_with_query_callers(self):
+        self.set_rates(1)
+        self.client.get(reverse("case_list"))
+        profile = ProfileRecord.objects.get()
+        self.assertEqual(profile.name, "GET /")
+        self.assertGreater(profile.query_count, 0)
+        self.assertIn("cumulative", profile.stats)
+        self.assertTrue(
+            any(
+                query["caller"].startswith("core/views.py") for query in profile.queries
+            )
+        )
+
+    def test_sampled_task_is_profiled(self):
+        self.set_rates(0, task_rate=1)
+        task = tasks.aggregate_employee_productivity
+        # Сигналы, которые воркер Celery отправляет вокруг выполнения задачи
+        task_prerun.send(sender=task, task_id="1", task=task)
+        task()
+        task_postrun.send(sender=task, task_id="1", task=task)
+        profile = ProfileRecord.objects.get()
+        self.assertEqual(profile.kind, ProfileRecord.TASK)
+        self.assertEqual(profile.name, "core.tasks.aggregate_employee_productivity")
+
+    @override_settings(PROFILING_BUFFER_SIZE=2)
+    def test_buffer_keeps_the_slowest(self):
+        for duration in (1, 3, 2, 0.5):
+            profiling.store_profile(
+                ProfileRecord.REQUEST, f"GET /{duration}/", duration
+            )
+        self.assertEqual(
+            list(ProfileRecord.objects.values_list("duration", flat=True)), [3, 2]
+        )
+
+    def test_manager_views_and_toggles_profiles(self):
+        profile = profiling.store_profile(ProfileRecord.REQUEST, "GET /slow/", 2)
+        self.client.force_login(self.manager)
+        response = self.client.get(reverse("case_processing:profiles"))
+        self.assertContains(response, "GET /slow/")
+        response = self.client.get(
+            reverse("case_processing:profile_detail", args=[profile.pk])
+        )
+        self.assertEqual(response.status_code, 200)
+
+        self.addCleanup(setattr, config, "PROFILING_SAMPLE_RATE", 0)
+        self.addCleanup(setattr, config, "PROFILING_TASK_SAMPLE_RATE", 0)
+        self.client.post(
+            reverse("case_processing:profiles"), {"request_rate": 0.1, "task_rate": 0}
+        )
+        self.assertEqual(get_config().PROFILING_SAMPLE_RATE, 0.1)
+
+
+class SlowQueryLogTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=2, stages=3, cases=5, logs_per_case=2)
+
+    def setUp(self):
+        query_log._explained.clear()
+
+    def test_fingerprint_ignores_literals_and_list_sizes(self):
+        first, normalized = query_log.fingerprint(
+            "SELECT * FROM core_case WHERE id IN (%s, %s) AND case_number = 'A-1' LIMIT 21"
+        )
+        second, _ = query_log.fingerprint(
+            "SELECT *  FROM core_case WHERE id IN (%s, %s, %s) AND case_number = 'B' LIMIT 5"
+        )
+        self.assertEqual(first, second)
+        self.assertEqual(
+            normalized,
+            "SELECT * FROM core_case WHERE id IN (...) AND case_number = ? LIMIT ?",
+        )
+
+    def test_slow_queries_are_aggregated_with_plan_and_call_site(self):
+        self.assertIn(query_log.log_slow_queries, connection.execute_wrappers)
+        for _ in range(2):
+            with self.settings(SLOW_QUERY_THRESHOLD_MS=1e-6):
+                with self.assertLogs("core.query_log", "WARNING"):
+                    with self.captureOnCommitCallbacks(execute=True):
+                        list(Case.objects.filter(archived=False, pk__in=[1, 2, 3]))
+
+        query = SlowQuery.objects.get(normalized_sql__contains='FROM "core_case"')
+        self.assertEqual(query.count, 2)
+        self.assertGreater(query.max_time, 0)
+        self.assertTrue(query.call_site.startswith("core/tests.py"))
+        self.assertIn("core_case", query.explain)
+
+        output = io.StringIO()
+        call_command("slow_queries", "--explain", stdout=output)
+        self.assertIn(query.fingerprint[:12], output.getvalue())
+
+    def test_rolled_back_queries_are_not_stored(self):
+        with self.settings(SLOW_QUERY_THRESHOLD_MS=1e-6):
+            with self.assertLogs("core.query_log", "WARNING"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    with transaction.atomic():
+                        list(Stage.objects.all())
+                        transaction.set_rollback(True)
+        self.assertFalse(
+            SlowQuery.objects.filter(normalized_sql__contains='"core_stage"').exists()
+        )
+
+
+class LabRouterTests(SimpleTestCase):
+    @override_settings(LAB_DATABASES={"north": "lab_north"})
+    def test_lab_models_use_the_database_of_their_lab(self):
+        router = LabRouter()
+        with using_lab("north"):
+            self.assertEqual(router.db_for_read(Case), "lab_north")
+            self.assertEqual(router.db_for_write(CaseStageLog), "lab_north")
+            self.assertIsNone(router.db_for_read(CustomUser))
+        with using_lab(lambda: "south"):
+            self.assertIsNone(router.db_for_write(Stage))
+
+        case = Case()
+        case._state.db = "lab_north"
+        self.assertEqual(router.db_for_write(Stage, instance=case), "lab_north")
+
+
+class LabScopedScanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=2, stages=3, cases=2, logs_per_case=1)
+        cls.main_stage = get_config().first_stage
+        # Лаборатория на той же базе с теми же штрихкодами этапов
+        cls.north_stage = Stage.objects.create(
+            lab="north",
+            name=cls.main_stage.name,
+            barcode=cls.main_stage.barcode,
+            display_name="North intake",
+            stage_group=cls.main_stage.stage_group,
+        )
+        cls.auth = {}
+        for lab in ("", "north"):
+            station = ScanStation(name=f"Station {lab or 'main'}", lab=lab)
+            cls.auth[lab or "main"] = {
+                "HTTP_AUTHORIZATION": f"Station {station.set_new_token()}"
+            }
+            station.save()
+        cls.employee = CustomUser.objects.filter(barcode__isnull=False).first()
+
+    def setUp(self):
+        invalidate_station_tokens()
+        reference_data.invalidate_stages()
+
+    def scan(self, lab, case_barcode):
+        return self.client.post(
+            reverse("scan_barcodes"),
+            {
+                "employee_barcode": self.employee.barcode,
+                "case_barcode": case_barcode,
+                "stage_barcode": self.main_stage.barcode,
+            },
+            content_type="application/json",
+            **self.auth[lab],
+        )
+
+    def test_barcodes_resolve_within_the_lab_of_the_station(self):
+        main_case = Case.objects.filter(lab="main").first()
+        # Кейс другой лаборатории не виден: создаётся новый кейс north
+        self.assertEqual(self.scan("north", main_case.barcode).status_code, 201)
+        self.assertEqual(self.scan("main", "SHARED-1").status_code, 201)
+        self.assertEqual(self.scan("north", "SHARED-1").status_code, 201)
+
+        north_cases = Case.objects.filter(lab="north")
+        self.assertEqual(north_cases.count(), 2)
+        self.assertEqual(
+            set(north_cases.values_list("current_stage", flat=True)),
+            {self.north_stage.pk},
+        )
+        self.assertEqual(
+            set(north_cases.values_list("stage_logs_case__lab", flat=True)), {"north"}
+        )
+        self.assertTrue(Case.objects.filter(lab="main", barcode="SHARED-1").exists())
+
+        result = self.client.get(
+            reverse("validate_barcode"),
+            {"field": "case", "barcode": "SHARED-1"},
+            **self.auth["north"],
+        ).json()
+        self.assertEqual(result["case_number"], "CASE-SHARED-1")
+        self.assertEqual(result["current_stage"], self.north_stage.name)
+
+
+class LabScopedBoardTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(
+            employees=2, stages=3, cases=5, logs_per_case=1, active_ratio=1
+        )
+        with using_lab("north"):
+            cls.north_stage = Stage.objects.create(
+                name="intake", display_name="Intake", stage_group="intake"
+            )
+            cls.north_case = Case.objects.create(
+                case_number="N-1", barcode="N1", current_stage=cls.north_stage
+            )
+        cls.manager = CustomUser.objects.create_user(
+            "staff@example.com", "secret", is_staff=True, role=CustomUser.MANAGER
+        )
+        assign_perm("core.view_case_processing_all_cases", cls.manager)
+        # Выдано на кейс другой лаборатории, например с тем же pk в её базе
+        assign_perm("core.manage_case", cls.manager, cls.north_case)
+
+    def setUp(self):
+        self.client.force_login(self.manager)
+
+    def test_boards_show_only_the_current_lab(self):
+        response = self.client.get(reverse("case_list"))
+        ids = {case["id"] for case in response.context["cases"]}
+        self.assertTrue(ids)
+        self.assertNotIn(self.north_case.pk, ids)
+
+        response = self.client.get(reverse("case_processing:"))
+        ids = {case.pk for _, _, case, _ in response.context["cases_data"]}
+        self.assertTrue(ids)
+        self.assertNotIn(self.north_case.pk, ids)
+
+    def test_timeline_of_another_lab_is_not_found(self):
+        for name in ("case_timeline", "case_timeline_api"):
+            response = self.client.get(reverse(name, args=[self.north_case.pk]))
+            self.assertEqual(response.status_code, 404, name)
+
+    def test_stage_of_another_lab_is_rejected(self):
+        case = Case.objects.filter(
+            lab="main", archived=False, is_returned=False
+        ).first()
+        self.client.post(
+            reverse("case_processing:"),
+            {"case_id": case.pk, "transition": self.north_stage.pk},
+        )
+        case.refresh_from_db()
+        self.assertNotEqual(case.current_stage, self.north_stage)
+        with self.assertRaises(ValueError):
+            case.transition_stage(new_stage=self.north_stage)
+
+    def test_object_permissions_apply_in_the_users_lab(self):
+        permissions = CasePermissionCache(self.manager)
+        permissions.prefetch([self.north_case])
+        self.assertFalse(permissions.has_perm("core.manage_case", self.north_case))
+        self.assertEqual(permissions.get_perms(self.north_case), [])
+
+        # При переходе в другую лабораторию прежние права на кейсы удаляются
+        self.manager.lab = "north"
+        self.manager.save()
+        self.assertFalse(
+            CasePermissionCache(self.manager).has_perm(
+                "core.manage_case", self.north_case
+            )
+        )
+
+
+class CrossLabReportTests(TransactionTestCase):
+    def setUp(self):
+        generate_dataset(employees=2, stages=3, cases=10, logs_per_case=1)
+        Lab.objects.create(code="north", name="North")
+        with using_lab("north"):
+            stage = Stage.objects.create(
+                name="intake", display_name="Intake", stage_group="intake"
+            )
+            for index in range(3):
+                Case.objects.create(
+                    case_number=f"N-{index}", barcode=f"N{index}", current_stage=stage
+                )
+
+    def test_labs_are_queried_in_parallel_and_merged(self):
+        report = labs.cross_lab_report()
+
+        self.assertEqual(set(report["labs"]), {"main", "north"})
+        north = report["labs"]["north"]
+        self.assertEqual(north["database"], "default")
+        self.assertEqual(north["active"], 3)
+        self.assertEqual(north["stages"], {"intake": 3})
+        main_active = Case.objects.filter(
+            lab="main", archived=False, is_returned=False
+        ).count()
+        self.assertEqual(report["total"]["active"], main_active + 3)
+        self.assertEqual(report["total"]["stages"]["intake"], 3)
+        self.assertEqual(labs.cross_lab_report(max_workers=1), report)
+
+
+@override_settings(LAB_DATABASES={"x": "lab_x"})
+class LabDatabaseTests(TransactionTestCase):
+    """
+    A lab with its own database: case and log pks overlap with the primary, and
+    users and return reasons are only on the primary.
+    """
+
+    databases = {"default", "replica_0", "lab_x"}
+
+    def setUp(self):
+        generate_dataset(employees=2, stages=3, cases=5, logs_per_case=2)
+        with using_lab("x"):
+            self.first_stage = Stage.objects.create(
+                name="intake",
+                barcode="X-INTAKE",
+                display_name="Intake",
+                stage_group=config.FIRST_STAGE_GROUP,
+            )
+            self.last_stage = Stage.objects.create(
+                name="done",
+                barcode="X-DONE",
+                display_name="Done",
+                stage_group=config.LAST_STAGE_GROUP,
+            )
+        station = ScanStation(name="Station X", lab="x")
+        self.auth = {"HTTP_AUTHORIZATION": f"Station {station.set_new_token()}"}
+        station.save()
+        self.employee = CustomUser.objects.filter(barcode__isnull=False).first()
+        invalidate_station_tokens()
+        reference_data.invalidate_stages()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(BACKUP_DIR=directory.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def scan_new_case(self):
+        response = self.client.post(
+            reverse("scan_barcodes"),
+            {
+                "employee_barcode": self.employee.barcode,
+                "case_barcode": "X-CASE-1",
+                "stage_barcode": self.first_stage.barcode,
+            },
+            content_type="application/json",
+            **self.auth,
+        )
+        self.assertEqual(response.status_code, 201)
+        case = Case.objects.using("lab_x").get(barcode="X-CASE-1")
+        case.transition_stage(new_stage=self.last_stage, user=self.employee)
+        return case
+
+    def test_scan_timeline_and_productivity(self):
+        case = self.scan_new_case()
+        self.assertFalse(Case.objects.using("default").filter(barcode="X-CASE-1"))
+        self.assertEqual(CaseStageLog.objects.using("lab_x").count(), 2)
+
+        with using_lab("x"):
+            _, entries = case_timeline(case.pk)
+        self.assertEqual(
+            [(entry["stage"], entry["user"]) for entry in entries],
+            [("intake", self.employee.full_name), ("done", self.employee.full_name)],
+        )
+
+        with mock.patch.object(productivity, "COMMIT_WINDOW", timedelta(0)):
+            tasks.aggregate_employee_productivity()
+        lab_x = EmployeeStageHour.objects.filter(lab="x").aggregate(
+            scans=Sum("scans"), completed=Sum("completed"), handled=Sum("handled")
+        )
+        self.assertEqual(lab_x, {"scans": 2, "completed": 1, "handled": 1})
+        self.assertEqual(
+            EmployeeStageHour.objects.filter(lab="main").aggregate(Sum("scans"))[
+                "scans__sum"
+            ],
+            CaseStageLog.objects.using("default").count(),
+        )
+        checkpoint = AggregationCheckpoint.objects.get(
+            name=f"{productivity.CHECKPOINT}:x"
+        )
+        self.assertEqual(
+            checkpoint.last_id, CaseStageLog.objects.using("lab_x").latest("pk").pk
+        )
+
+    def test_every_database_is_backed_up_and_verified(self):
+        self.scan_new_case()
+
+        tasks.backup_database()
+        tasks.backup_case_stage_logs()
+        tasks.verify_database_backup()
+
+        records = BackupRecord.objects.filter(database="lab_x")
+        full = records.get(kind=BackupRecord.FULL)
+        self.assertEqual(full.details["counts"]["core_case"], 1)
+        self.assertEqual(records.get(kind=BackupRecord.INCREMENTAL).rows, 2)
+        self.assertEqual(records.get(kind=BackupRecord.VERIFY).status, "success")
+        self.assertEqual(BackupRecord.objects.filter(database="default").count(), 3)
+
+    def test_bulk_action_rolls_back_on_the_lab_database(self):
+        case = self.scan_new_case()
+        manager = CustomUser.objects.create_superuser(
+            "admin@example.com", "secret", lab="x"
+        )
+        self.client.force_login(manager)
+
+        def failing_archive(queryset, user=None):
+            queryset.update(shade="A1")
+            raise DatabaseError("failed midway")
+
+        with mock.patch.object(CaseQuerySet, "bulk_archive", failing_archive):
+            self.client.post(
+                reverse("case_processing:"),
+                {"bulk_action": "archive", "case_ids": [case.pk]},
+            )
+
+        case.refresh_from_db()
+        self.assertIsNone(case.shade)
+
+    def test_benchmark_rolls_back_lab_databases(self):
+        def create_lab_case(ctx):
+            with using_lab("x"):
+                Case.objects.create(
+                    case_number="BENCH-X",
+                    barcode="BENCH-X",
+                    current_stage=self.first_stage,
+                )
+
+        entry = {"func": create_lab_case, "mutates": True, "optional": False}
+        with mock.patch.dict(SCENARIOS, {"lab_write": entry}):
+            report = run_benchmarks(iterations=2, warmup=0, only=["lab_write"])
+
+        self.assertGreater(report["scenarios"]["lab_write"]["queries"], 0)
+        self.assertFalse(Case.objects.using("lab_x").exists())
+        self.assertFalse(CaseStageLog.objects.using("lab_x").exists())
+
+    def test_board_rows_are_cached_per_lab(self):
+        archived_at = now()
+        main_case = Case.objects.using("default").first()
+        Case.objects.using("default").filter(pk=main_case.pk).update(
+            archived=True, archived_at=archived_at, version=1
+        )
+        # Та же пара (pk, version) в базе лаборатории x
+        Case.objects.using("lab_x").bulk_create(
+            [
+                Case(
+                    pk=main_case.pk,
+                    lab="x",
+                    case_number="X-ROW",
+                    barcode="X-ROW",
+                    current_stage=self.first_stage,
+                    archived=True,
+                    archived_at=archived_at,
+                    version=1,
+                )
+            ]
+        )
+        main_user = CustomUser.objects.create_user("main@example.com", "secret")
+        lab_user = CustomUser.objects.create_user("x@example.com", "secret", lab="x")
+        cache.clear()
+
+        for user, shown, hidden in (
+            (main_user, main_case.case_number, "X-ROW"),
+            (lab_user, "X-ROW", main_case.case_number),
+        ):
+            self.client.force_login(user)
+            response = self.client.get(reverse("archived_cases"))
+            self.assertContains(response, shown)
+            self.assertNotContains(response, f">{hidden}<")
+
+
+class BoardHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=2, stages=3, cases=6, logs_per_case=1)
+        cls.stages = list(Stage.objects.order_by("name"))
+        cls.start = now() - timedelta(days=2)
+        CaseStageLog.objects.all().delete()
+        # Кейс i проходит этапы по очереди, каждый этап длится (i + 1) часов
+        logs = []
+        for index, case in enumerate(Case.objects.order_by("pk")):
+            for step, stage in enumerate(cls.stages):
+                logs.append(
+                    CaseStageLog(
+                        case=case,
+                        stage=stage,
+                        start_time=cls.start + timedelta(hours=(index + 1) * step),
+                        end_time=(
+                            None
+                            if step == len(cls.stages) - 1
+                            else cls.start + timedelta(hours=(index + 1) * (step + 1))
+                        ),
+                    )
+                )
+        CaseStageLog.objects.bulk_create(logs)
+        cls.manager = CustomUser.objects.create_user(
+            "history@example.com", "secret", role=CustomUser.MANAGER
+        )
+
+    def expected(self, at):
+        occupancy = {}
+        for log in CaseStageLog.objects.all():
+            if log.start_time <= at and (log.end_time is None or log.end_time > at):
+                occupancy.setdefault(log.stage.name, set()).add(log.case_id)
+        return occupancy
+
+    def test_board_matches_the_logs_at_any_time(self):
+        for hours in (-1, 0, 1, 2, 3.5, 6, 11, 12, 40):
+            at = self.start + timedelta(hours=hours)
+            board = history.board_at(at)
+            self.assertEqual(
+                {
+                    stage["stage"]: {case["id"] for case in stage["cases"]}
+                    for stage in board
+                },
+                self.expected(at),
+                hours,
+            )
+        # Лог, закончившийся ровно в момент запроса, уже не учитывается
+        at = self.start + timedelta(hours=1)
+        first_case = Case.objects.order_by("pk").first()
+        stage = next(
+            stage
+            for stage in history.board_at(at)
+            if first_case.pk in {case["id"] for case in stage["cases"]}
+        )
+        self.assertEqual(stage["stage"], self.stages[1].name)
+
+    def test_archived_cases_leave_the_board(self):
+        first, second = Case.objects.order_by("pk")[:2]
+        Case.objects.filter(pk__in=[first.pk, second.pk]).update(
+            archived=False, archived_at=None
+        )
+        first.refresh_from_db()
+        first.archive_case()
+        Case.objects.filter(pk=second.pk).bulk_archive()
+
+        def on_board(at):
+            return {
+                case["id"] for stage in history.board_at(at) for case in stage["cases"]
+            }
+
+        first.refresh_from_db()
+        before = first.archived_at - timedelta(minutes=1)
+        self.assertTrue({first.pk, second.pk} <= on_board(before))
+        self.assertFalse({first.pk, second.pk} & on_board(now()))
+        self.assertFalse(
+            CaseStageLog.objects.filter(
+                case__in=[first, second], end_time__isnull=True
+            ).exists()
+        )
+
+    def test_board_page(self):
+        self.client.force_login(self.manager)
+        at = self.start + timedelta(hours=3)
+        response = self.client.get(
+            reverse("board_as_of"), {"at": at.strftime("%Y-%m-%dT%H:%M:%S")}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.context["total"],
+            sum(len(cases) for cases in self.expected(at).values()),
+        )
+        response = self.client.get(reverse("board_as_of"), {"at": "yesterday"})
+        self.assertEqual(response.context["total"], Case.objects.count())
+
+
+class WorkQueueTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=3, stages=3, cases=1, logs_per_case=1)
+        cls.stage = Stage.objects.order_by("name")[1]
+        cls.employees = list(CustomUser.objects.filter(barcode__isnull=False))
+        Case.objects.filter(current_stage=cls.stage).update(archived=True)
+        start = now() - timedelta(hours=10)
+        cls.cases = {}
+        for index, priority in enumerate(["standard", "urgent", "standard", "urgent"]):
+            cls.cases[index] = Case.objects.create(
+                case_number=f"Q-{index}",
+                barcode=f"Q{index}",
+                priority=priority,
+                current_stage=cls.stage,
+                created_at=start + timedelta(hours=index),
+            )
+        station = ScanStation(name="Station 1")
+        cls.auth = {"HTTP_AUTHORIZATION": f"Station {station.set_new_token()}"}
+        station.save()
+
+    def setUp(self):
+        invalidate_station_tokens()
+        reference_data.invalidate_stages()
+        reference_data.invalidate_employees()
+
+    def next_case(self, employee):
+        return self.client.post(
+            reverse("next_case"),
+            {"employee_barcode": employee.barcode, "stage_barcode": self.stage.barcode},
+            content_type="application/json",
+            **self.auth,
+        )
+
+    def test_cases_are_claimed_urgent_then_oldest_without_double_assignment(self):
+        first, second, third = self.employees
+        numbers = [
+            self.next_case(employee).json()["case"]["case_number"]
+            for employee in (first, second, third)
+        ]
+        self.assertEqual(numbers, ["Q-1", "Q-3", "Q-0"])
+        # Повторный запрос возвращает уже взятый кейс и продлевает аренду
+        self.assertEqual(self.next_case(first).json()["case"]["case_number"], "Q-1")
+
+        fourth, fifth = (
+            CustomUser.objects.create_user(f"{name}@example.com", barcode=name)
+            for name in ("fourth", "fifth")
+        )
+        self.assertEqual(self.next_case(fourth).json()["case"]["case_number"], "Q-2")
+        self.assertEqual(self.next_case(fifth).status_code, 204)
+
+    def test_expired_released_and_moved_cases_return_to_the_queue(self):
+        first, second, _ = self.employees
+        case = work_queue.claim_next(self.stage, first)
+        self.assertEqual(case, self.cases[1])
+
+        Case.objects.filter(pk=case.pk).update(
+            claimed_until=now() - timedelta(seconds=1)
+        )
+        self.assertEqual(work_queue.claim_next(self.stage, second), case)
+
+        response = self.client.post(
+            reverse("release_case"),
+            {"employee_barcode": first.barcode, "case_barcode": case.barcode},
+            content_type="application/json",
+            **self.auth,
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertTrue(work_queue.release(case, second))
+        self.assertEqual(work_queue.claim_next(self.stage, first), case)
+
+        case.refresh_from_db()
+        case.transition_stage(
+            Stage.objects.exclude(pk=self.stage.pk).first(), user=first
+        )
+        case.refresh_from_db()
+        self.assertIsNone(case.claimed_by)
+        self.assertEqual(work_queue.claim_next(self.stage, first), self.cases[3])
+
+    def test_stale_candidate_is_not_claimed(self):
+        case = Case.objects.get(pk=self.cases[1].pk)
+        Case.objects.filter(pk=case.pk).update(version=F("version") + 1)
+        self.assertIsNone(
+            work_queue._lease(
+                case, self.employees[0], now(), Q(claimed_by__isnull=True)
+            )
+        )
+
+
+class AdminChangelistTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        generate_dataset(employees=3, stages=3, cases=30, logs_per_case=3)
+        cls.manager = CustomUser.objects.get(is_superuser=True)
+
+    def setUp(self):
+        reference_data.invalidate_stages()
+        reference_data.invalidate_employees()
+        self.client.force_login(self.manager)
+
+    def test_case_changelist_query_count_does_not_grow(self):
+        url = reverse("admin:core_case_changelist")
+        self.client.get(url)
+        with mock.patch.object(CaseAdmin, "list_per_page", 5):
+            with CaptureQueriesContext(connection) as few:
+                self.client.get(url)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(url)
+
+        self.assertEqual(len(response.context["cl"].result_list), 30)
+        self.assertEqual(len(few), len(many))
+        user = Case.objects.exclude(last_updated_by=None).first().last_updated_by
+        self.assertContains(response, f"{user.first_name} {user.last_name}")
+
+    def test_estimated_count_paginator(self):
+        cases = Case.objects.order_by("pk")
+        with mock.patch("core.admin_paging.estimated_count", return_value=50_000):
+            paginator = EstimatedCountPaginator(cases, 10)
+            self.assertEqual(paginator.count, 50_000)
+            self.assertEqual(list(paginator.page(3).object_list), list(cases[20:30]))
+            self.assertEqual(list(paginator.page(500).object_list), [])
+        with mock.patch("core.admin_paging.estimated_count", return_value=100):
+            self.assertEqual(EstimatedCountPaginator(cases, 10).count, 30)
+
+    def test_log_changelist_cursor_walks_every_log(self):
+        stage = Stage.objects.order_by("name").first()
+        url = reverse("admin:core_casestagelog_changelist") + f"?stage={stage.pk}"
+        self.client.get(url)
+        seen = []
+        queries = set()
+        with mock.patch.object(CaseStageLogAdmin, "list_per_page", 7):
+            while url:
+                with CaptureQueriesContext(connection) as captured:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                changelist = response.context["cl"]
+                seen += [log.pk for log in changelist.result_list]
+                queries.add(len(captured))
+                next_url = changelist.next_page_url
+                url = (
+                    next_url
+                    and reverse("admin:core_casestagelog_changelist") + next_url
+                )
+                self.assertIn(f"stage={stage.pk}", next_url or f"stage={stage.pk}")
+
+        expected = CaseStageLog.objects.filter(stage=stage).order_by(
+            "-start_time", "-pk"
+        )
+        self.assertEqual(seen, list(expected.values_list("pk", flat=True)))
+        self.assertEqual(len(queries), 1)
+
+    def test_log_changelist_rejects_bad_cursor(self):
+        response = self.client.get(
+            reverse("admin:core_casestagelog_changelist") + "?cursor=nonsense"
+        )
+
+        self.assertRedirects(
+            response,
+            reverse("admin:core_casestagelog_changelist") + "?e=1",
+            fetch_redirect_response=False,
+        )
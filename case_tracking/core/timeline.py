@@ -0,0 +1,53 @@
+from django.db.models import DurationField, ExpressionWrapper, F, Window
+from django.db.models.functions import Coalesce, Lead, Now
+
+from . import reference_data
+from .models import CaseStageLog
+from .routers import current_lab
+
+
+def timeline_logs(case_id):
+    """
+    Stage logs of a case of the current lab, oldest first, joined with the case
+    and stage.
+    ``left_at`` and ``dwell`` are computed in SQL: a log lasts until its
+    end_time, the start of the next log, or now for the current stage.
+    """
+    next_start = Window(
+        Lead("start_time"), partition_by=[F("case_id")], order_by=F("start_time").asc()
+    )
+    return (
+        CaseStageLog.objects.filter(lab=current_lab(), case_id=case_id)
+        .select_related("case__current_stage", "stage")
+        .annotate(left_at=Coalesce("end_time", next_start, Now()))
+        .annotate(
+            dwell=ExpressionWrapper(
+                F("left_at") - F("start_time"), output_field=DurationField()
+            )
+        )
+        .order_by("start_time", "pk")
+    )
+
+
+def case_timeline(case_id):
+    """
+    Return ``(case, entries)`` for a case, with one query. ``case`` is None if
+    the case has no stage logs.
+    """
+    logs = list(timeline_logs(case_id))
+    # Сотрудники хранятся на основной базе, а не в базе лаборатории
+    employees = {pk: full_name for pk, full_name, _ in reference_data.employees()}
+    entries = [
+        {
+            "stage": log.stage.name,
+            "stage_display_name": log.stage.display_name,
+            "user": employees.get(log.user_id),
+            "start_time": log.start_time,
+            "end_time": log.end_time,
+            "dwell": log.dwell,
+            "is_returned": log.is_returned,
+            "reason": log.reason or "",
+        }
+        for log in logs
+    ]
+    return (logs[0].case if logs else None), entries
@@ -1,14 +1,20 @@
+import hashlib
 import logging
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
-from django.shortcuts import redirect, render
-from django.utils.timezone import now
+from django.db.models import Max, OuterRef, Q, Subquery
+from django.shortcuts import get_object_or_404, redirect, render
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, localtime, make_aware, now
+from django.views.decorators.http import condition
 
+from . import history, productivity, reference_data, timeline
 from .forms import EmployeeBarcodeAssignForm, StageBarcodeAssignForm, UserLoginForm
-from .models import Case, CustomUser, ReturnReason, Stage
+from .models import Case, CaseStageLog, CustomUser, ReturnReason, Stage
+from .routers import current_lab, replica_reads
 
 logger = logging.getLogger(__name__)
 
@@ -52,6 +58,55 @@ def format_timedelta(td):
         return f"{minutes} min."
 
 
+def board_last_modified(request, *args, **kwargs):
+    """
+    Change marker of the boards of the current lab: the latest Case.updated_at
+    (index lookup). Computed once per request.
+    """
+    if not hasattr(request, "_board_last_modified"):
+        request._board_last_modified = Case.objects.filter(lab=current_lab()).aggregate(
+            last=Max("updated_at")
+        )["last"]
+    return request._board_last_modified
+
+
+def board_etag(request, *args, **kwargs):
+    """
+    ETag of a board page: the change marker plus the client's session, since the
+    page header depends on the logged in user.
+    """
+    marker = board_last_modified(request)
+    client = "|".join(
+        request.COOKIES.get(name, "")
+        for name in (settings.SESSION_COOKIE_NAME, settings.CSRF_COOKIE_NAME)
+    )
+    key = f"{current_lab()}|{marker.isoformat() if marker else ''}|{client}"
+    return hashlib.md5(key.encode(), usedforsecurity=False).hexdigest()
+
+
+def live_board_etag(request, *args, **kwargs):
+    """
+    ETag of case_list: stage times are shown in minutes, so it also changes
+    every minute.
+    """
+    return f"{board_etag(request)}-{int(now().timestamp() // 60)}"
+
+
+def _current_stage_log(field):
+    """
+    Field of the latest log of the case on its current stage, as a subquery.
+    """
+    return Subquery(
+        CaseStageLog.objects.filter(
+            case_id=OuterRef("pk"), stage_id=OuterRef("current_stage_id")
+        )
+        .order_by("-start_time")
+        .values(field)[:1]
+    )
+
+
+@replica_reads()
+@condition(etag_func=live_board_etag)
 def case_list(request):
     """
     Display a list of cases with filtering options for priority and stage.
@@ -61,8 +116,13 @@ def case_list(request):
     user_id = request.GET.get("user", None)
     search_query = request.GET.get("search", None)
 
-    cases = Case.objects.filter(archived=False, is_returned=False).select_related(
-        "current_stage", "last_updated_by"
+    cases = (
+        Case.objects.filter(lab=current_lab(), archived=False, is_returned=False)
+        .select_related("current_stage")
+        .annotate(
+            stage_start=_current_stage_log("start_time"),
+            stage_end=_current_stage_log("end_time"),
+        )
     )
 
     if priority:
@@ -70,46 +130,41 @@ def case_list(request):
     if stage_id:
         cases = cases.filter(current_stage__id=stage_id)
     if user_id:
-        cases = cases.filter(last_updated_by__id=user_id)
+        cases = cases.filter(last_updated_by_id=user_id)
     if search_query:
         cases = cases.filter(
             Q(case_number__icontains=search_query) | Q(barcode__icontains=search_query)
         )
 
+    # Сотрудники хранятся на основной базе, а не в базе лаборатории
+    employees = {pk: full_name for pk, full_name, _ in reference_data.employees()}
     case_data = []
     for case in cases:
-        last_stage_log = (
-            case.stage_logs_case.filter(stage=case.current_stage)
-            .order_by("-start_time")
-            .first()
-        )
         # Если end_time есть, используем его, иначе считаем до текущего времени
         time_on_stage = (
-            (last_stage_log.end_time - last_stage_log.start_time)
-            if last_stage_log and last_stage_log.end_time
-            else (now() - last_stage_log.start_time)
-            if last_stage_log
+            (case.stage_end or now()) - case.stage_start
+            if case.stage_start
             else (now() - case.created_at)
         )
         case_data.append(
             {
+                "id": case.pk,
+                "version": case.version,
                 "case_number": case.case_number,
                 "current_stage": case.current_stage.name,
                 "priority": case.priority,
                 "time_on_stage": format_timedelta(time_on_stage),
-                "last_updated_by": case.last_updated_by.full_name
-                if case.last_updated_by
-                else "N/A",  # Добавляем пользователя
+                "last_updated_by": employees.get(case.last_updated_by_id, "N/A"),
             }
         )
     case_data.sort(key=lambda x: x["priority"] != "urgent")
 
-    stages = Stage.objects.all()
-    employees = CustomUser.objects.filter(is_active=True)
     context = {
         "cases": case_data,
-        "stages": stages,
-        "employees": employees,
+        "lab": current_lab(),
+        "reference_version": reference_data.version(),
+        "stages": reference_data.stages(),
+        "employees": reference_data.active_employees(),
         "priority": priority,
         "stage_id": stage_id,
         "user_id": user_id,
@@ -119,13 +174,19 @@ def case_list(request):
     return render(request, "cases/case_list.html", context)
 
 
+@replica_reads()
+@condition(etag_func=board_etag, last_modified_func=board_last_modified)
 def archived_case(request):
     """
     Display a list of archived cases.
     """
-    archived_cases = Case.objects.filter(archived=True)
+    archived_cases = Case.objects.filter(
+        lab=current_lab(), archived=True
+    ).select_related("current_stage")
     archived_case_data = [
         {
+            "id": case.pk,
+            "version": case.version,
             "case_number": case.case_number,
             "current_stage": case.current_stage.name,
             "archived_at": case.archived_at,
@@ -135,21 +196,37 @@ def archived_case(request):
 
     context = {
         "archived_cases": archived_case_data,
+        "lab": current_lab(),
+        "reference_version": reference_data.version(),
     }
 
     return render(request, "cases/archive_case.html", context)
 
 
+@replica_reads()
+@condition(etag_func=board_etag, last_modified_func=board_last_modified)
 def returned_case(request):
     """
     Display a list of returned cases.
     """
-    returned_cases = Case.objects.filter(is_returned=True, archived=False)
+    returned_cases = list(
+        Case.objects.filter(
+            lab=current_lab(), is_returned=True, archived=False
+        ).select_related("current_stage")
+    )
+    # Причины возврата хранятся на основной базе, а не в базе лаборатории
+    reasons = dict(
+        ReturnReason.objects.filter(
+            pk__in={case.return_reason_id for case in returned_cases}
+        ).values_list("pk", "reason")
+    )
     returned_case_data = [
         {
+            "id": case.pk,
+            "version": case.version,
             "case_number": case.case_number,
             "current_stage": case.current_stage.name,
-            "return_reason": case.return_reason.reason if case.return_reason else "",
+            "return_reason": reasons.get(case.return_reason_id, ""),
             "return_description": case.return_description or "No description",
         }
         for case in returned_cases
@@ -157,11 +234,77 @@ def returned_case(request):
 
     context = {
         "returned_cases": returned_case_data,
+        "lab": current_lab(),
+        "reference_version": reference_data.version(),
     }
 
     return render(request, "cases/returned_case.html", context)
 
 
+@replica_reads()
+def case_timeline(request, case_id):
+    """
+    Display the full stage history of a case.
+    """
+    case, entries = timeline.case_timeline(case_id)
+    if case is None:
+        case = get_object_or_404(
+            Case.objects.select_related("current_stage"), lab=current_lab(), pk=case_id
+        )
+    for entry in entries:
+        entry["dwell"] = format_timedelta(entry["dwell"])
+
+    context = {
+        "case": case,
+        "entries": entries,
+        "returns": sum(entry["is_returned"] for entry in entries),
+    }
+
+    return render(request, "cases/case_timeline.html", context)
+
+
+@login_required
+@replica_reads()
+def board_as_of(request):
+    """
+    Display the case board as it was at a past moment (?at=).
+    """
+    if request.user.role != CustomUser.MANAGER:
+        messages.error(request, "You don't have permission to access this page.")
+        return redirect("employee_dashboard")
+
+    at = parse_datetime(request.GET.get("at", "")) if request.GET.get("at") else None
+    if at is None:
+        if request.GET.get("at"):
+            messages.error(request, "Invalid date and time, showing the current board.")
+        at = now()
+    elif is_naive(at):
+        at = make_aware(at)
+
+    stages = history.board_at(at)
+    for stage in stages:
+        for case in stage["cases"]:
+            case["on_stage"] = format_timedelta(case["on_stage"])
+
+    context = {
+        "at": localtime(at),
+        "stages": stages,
+        "total": sum(len(stage["cases"]) for stage in stages),
+    }
+    return render(request, "cases/board_as_of.html", context)
+
+
+PRODUCTIVITY_PERIODS = (1, 7, 30)
+
+
+def productivity_days(request):
+    """
+    Period (in days) of the productivity tables, from ?days=.
+    """
+    days = request.GET.get("days", "")
+    return int(days) if days.isdigit() and int(days) in PRODUCTIVITY_PERIODS else 1
+
+
 @login_required
 def manager_dashboard(request):
     if request.user.role != CustomUser.MANAGER:
@@ -169,11 +312,19 @@ def manager_dashboard(request):
             request, "You don't have permission to access the manager dashboard."
         )
         return redirect("employee_dashboard")
+    days = productivity_days(request)
+    team = productivity.team_summary(days)
+    for row in team:
+        for stage in row["stages"]:
+            stage["median_handling"] = format_timedelta(stage["median_handling"])
     context = {
         "user": request.user,
         "title": "Manager Dashboard",
         "can_access_admin": request.user.is_staff,
         "can_access_custom_admin": request.user.role == CustomUser.MANAGER,
+        "days": days,
+        "periods": PRODUCTIVITY_PERIODS,
+        "team": team,
     }
     return render(request, "users/manager_dashboard.html", context)
 
@@ -266,10 +417,16 @@ def employee_dashboard(request):
             return redirect("manager_dashboard")
         messages.error(request, "You don't have permission to access this page.")
         return redirect("login")
-    # Здесь можно добавить логику для сотрудника
+    days = productivity_days(request)
+    summary = productivity.employee_summary(request.user, days)
+    for row in summary["stages"]:
+        row["median_handling"] = format_timedelta(row["median_handling"])
     context = {
         "user": request.user,
         "title": "Employee Dashboard",
+        "days": days,
+        "periods": PRODUCTIVITY_PERIODS,
+        "summary": summary,
     }
     return render(request, "users/employee_dashboard.html", context)
 
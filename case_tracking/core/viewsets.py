@@ -1,19 +1,215 @@
-from constance import config
 from django.db import transaction
 from django.utils.timezone import now
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
-from .models import Case, ReturnReason, Stage
-from .serializers import BarcodeScanSerializer, CaseSerializer
+from . import reference_data, work_queue
+from .authentication import StationTokenAuthentication
+from .config_snapshot import get_config
+from .models import Case, CaseConflict, ReturnReason
+from .permissions import ScanStationPermission
+from .routers import current_lab, replica_reads
+from .serializers import (
+    BarcodeScanSerializer,
+    CaseSerializer,
+    CaseTimelineEntrySerializer,
+    WorkQueueClaimSerializer,
+    WorkQueueReleaseSerializer,
+)
+from .timeline import case_timeline
+
+
+def scan_transition_error(current_stage_id, stage_id, stage_group, first_stage_group):
+    """
+    Why scanning a case onto a stage is not allowed, or None. An existing case
+    can only be scanned back to the first stage (a return, which needs a reason).
+    """
+    if stage_id == current_stage_id:
+        return "Case is already on this stage"
+    if current_stage_id is not None and stage_group != first_stage_group:
+        return "Cannot return case to a non-initial stage"
+    return None
+
+
+def _scanned_case(barcode):
+    return (
+        Case.objects.filter(lab=current_lab(), barcode=barcode)
+        .values("id", "case_number", "current_stage_id", "archived", "is_returned")
+        .first()
+    )
+
+
+def validate_employee_barcode(barcode, params):
+    employee = reference_data.employee_barcodes().get(barcode)
+    if employee is None:
+        return {"valid": False, "detail": f"Employee with barcode {barcode} not found."}
+    if not employee[2]:
+        return {"valid": False, "detail": "Employee is not active"}
+    return {"valid": True, "employee": employee[1]}
+
+
+def validate_case_barcode(barcode, params):
+    case = _scanned_case(barcode)
+    if case is None:
+        return {"valid": True, "exists": False, "detail": "A new case will be created"}
+
+    stage_names = {pk: name for pk, name, _ in reference_data.stages()}
+    first_stage = get_config().first_stage
+    # Существующий кейс можно только вернуть на первый этап
+    next_stages = []
+    if case["current_stage_id"] != first_stage.pk:
+        next_stages.append(
+            {
+                "name": first_stage.name,
+                "display_name": first_stage.display_name,
+                "requires_reason": True,
+            }
+        )
+    return {
+        "valid": True,
+        "exists": True,
+        "case_number": case["case_number"],
+        "current_stage": stage_names.get(case["current_stage_id"]),
+        "archived": case["archived"],
+        "is_returned": case["is_returned"],
+        "next_stages": next_stages,
+    }
+
+
+def validate_stage_barcode(barcode, params):
+    stage = reference_data.stage_barcodes().get(barcode)
+    if stage is None:
+        return {"valid": False, "detail": f"Stage with barcode {barcode} not found."}
+    stage_id, name, display_name, stage_group = stage
+    result = {"valid": True, "stage": name, "display_name": display_name}
+
+    case_barcode = params.get("case", "").strip()
+    case = _scanned_case(case_barcode) if case_barcode else None
+    if case is None:
+        return result
+    first_stage_group = get_config().FIRST_STAGE_GROUP
+    error = scan_transition_error(
+        case["current_stage_id"], stage_id, stage_group, first_stage_group
+    )
+    if error:
+        return {"valid": False, "detail": error}
+    result["requires_reason"] = stage_group == first_stage_group
+    return result
+
+
+BARCODE_VALIDATORS = {
+    "employee": validate_employee_barcode,
+    "case": validate_case_barcode,
+    "stage": validate_stage_barcode,
+}
+
+
+SCAN_AUTHENTICATION_CLASSES = [
+    StationTokenAuthentication,
+    *api_settings.DEFAULT_AUTHENTICATION_CLASSES,
+]
 
 
 class CaseViewSet(viewsets.ModelViewSet):
     queryset = Case.objects.all()
     serializer_class = BarcodeScanSerializer
 
-    @action(detail=False, methods=["post"])
+    def get_queryset(self):
+        return Case.objects.filter(lab=current_lab())
+
+    @action(detail=True, methods=["get"])
+    def timeline(self, request, pk=None):
+        """
+        Полная история этапов кейса с временем на каждом этапе
+        """
+        with replica_reads():
+            case, entries = case_timeline(pk)
+            if case is None:
+                case = self.get_object()
+        return Response(
+            {
+                "case": CaseSerializer(case).data,
+                "transitions": len(entries),
+                "returns": sum(entry["is_returned"] for entry in entries),
+                "timeline": CaseTimelineEntrySerializer(entries, many=True).data,
+            }
+        )
+
+    @action(
+        detail=False,
+        methods=["get"],
+        authentication_classes=SCAN_AUTHENTICATION_CLASSES,
+        permission_classes=[ScanStationPermission],
+    )
+    def validate_barcode(self, request):
+        """
+        Проверка одного штрихкода сразу после сканирования, до отправки всей формы
+        """
+        field = request.query_params.get("field")
+        barcode = request.query_params.get("barcode", "").strip()
+        if field not in BARCODE_VALIDATORS or not barcode:
+            return Response(
+                {
+                    "error": "Invalid request",
+                    "detail": "field must be one of employee, case, stage and barcode is required",
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(BARCODE_VALIDATORS[field](barcode, request.query_params))
+
+    @action(
+        detail=False,
+        methods=["post"],
+        authentication_classes=SCAN_AUTHENTICATION_CLASSES,
+        permission_classes=[ScanStationPermission],
+    )
+    def next_case(self, request):
+        """
+        Следующий кейс из очереди этапа: срочные, затем самые старые
+        """
+        serializer = WorkQueueClaimSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        case = work_queue.claim_next(
+            serializer.validated_data["stage_barcode"],
+            serializer.validated_data["employee_barcode"],
+        )
+        if case is None:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(
+            {"case": CaseSerializer(case).data, "claimed_until": case.claimed_until}
+        )
+
+    @action(
+        detail=False,
+        methods=["post"],
+        authentication_classes=SCAN_AUTHENTICATION_CLASSES,
+        permission_classes=[ScanStationPermission],
+    )
+    def release_case(self, request):
+        """
+        Вернуть взятый кейс в очередь этапа
+        """
+        serializer = WorkQueueReleaseSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        case = serializer.validated_data["case_barcode"]
+        if not work_queue.release(case, serializer.validated_data["employee_barcode"]):
+            return Response(
+                {
+                    "error": "Not claimed",
+                    "detail": f"Case #{case.case_number} is not held by this employee",
+                },
+                status=status.HTTP_409_CONFLICT,
+            )
+        return Response({"message": f"Case #{case.case_number} returned to the queue"})
+
+    @action(
+        detail=False,
+        methods=["post"],
+        authentication_classes=SCAN_AUTHENTICATION_CLASSES,
+        permission_classes=[ScanStationPermission],
+    )
     def scan_barcodes(self, request):
         """
         Обработка сканирования трех штрихкодов: сотрудник-кейс-стадия
@@ -26,37 +222,32 @@ class CaseViewSet(viewsets.ModelViewSet):
             case_barcode = serializer.validated_data["case_barcode"]
             stage = serializer.validated_data["stage_barcode"]
 
-            with transaction.atomic():
+            with transaction.atomic(using=stage._state.db):
                 if isinstance(case_barcode, Case):
                     # Если case_barcode уже объект Case, используем его
                     case = case_barcode
                     current_stage = case.current_stage
 
-                    first_stage = Stage.objects.get(
-                        stage_group=config.FIRST_STAGE_GROUP
-                    )
+                    first_stage = get_config().first_stage
 
-                    if stage == current_stage:
+                    transition_error = scan_transition_error(
+                        current_stage.pk if current_stage else None,
+                        stage.pk,
+                        stage.stage_group,
+                        first_stage.stage_group,
+                    )
+                    if transition_error:
                         return Response(
                             {
                                 "error": "Invalid transition",
-                                "detail": "Case is already on this stage",
+                                "detail": transition_error,
                             },
                             status=status.HTTP_400_BAD_REQUEST,
                         )
 
                     # Проверяем, является ли это возвратом
                     if current_stage is not None:  # Не новый кейс
-                        if stage.stage_group != first_stage.stage_group:
-                            # Возврат на любую стадию кроме первой - ошибка
-                            return Response(
-                                {
-                                    "error": "Invalid transition",
-                                    "detail": "Cannot return case to a non-initial stage",
-                                },
-                                status=status.HTTP_400_BAD_REQUEST,
-                            )
-                        elif stage.stage_group == first_stage.stage_group:
+                        if stage.stage_group == first_stage.stage_group:
                             # Возврат на первую стадию - требуем причину
                             reason_key = request.data.get("reason", None)
                             custom_reason = request.data.get("custom_reason", None)
@@ -103,6 +294,7 @@ class CaseViewSet(viewsets.ModelViewSet):
 
                 else:
                     case = Case.objects.create(
+                        lab=stage.lab,
                         case_number=f"CASE-{case_barcode}",
                         barcode=case_barcode,
                         last_updated_by=employee,
@@ -125,6 +317,12 @@ class CaseViewSet(viewsets.ModelViewSet):
                     status=status_code,
                 )
 
+        except CaseConflict as e:
+            # Другая станция успела изменить кейс: клиент может повторить скан
+            return Response(
+                {"error": "Conflict", "detail": str(e), "retry": True},
+                status=status.HTTP_409_CONFLICT,
+            )
         except Exception as e:
             return Response(
                 {"error": "Unexpected Error", "detail": str(e)},
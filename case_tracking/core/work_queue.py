@@ -0,0 +1,96 @@
+"""
+Per-stage work queues.
+
+The queue of a stage is its active cases, urgent first and then oldest first
+(the case_stage_queue_idx index). An employee takes the next case with
+``claim_next``. The case is leased to them for WORK_QUEUE_LEASE and skipped
+by everyone else until the lease expires or the case moves to another stage.
+
+Candidates are locked with ``SELECT ... FOR UPDATE SKIP LOCKED``, so employees
+claiming at the same stage each lock a different row instead of waiting on
+the first one. The lease itself is set by a conditional update that only
+matches an unleased case, which also keeps claims exclusive on databases
+without row locks (SQLite). A claim bumps the case version like any other
+write (see Case._do_update).
+"""
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils.timezone import now
+
+from .config_snapshot import get_config
+from .models import Case
+
+CLAIM_ATTEMPTS = 5
+
+
+def stage_queue(stage):
+    return Case.objects.filter(
+        lab=stage.lab, current_stage=stage, archived=False, is_returned=False
+    ).order_by("-priority", "created_at", "pk")
+
+
+def _unleased(timestamp):
+    return Q(claimed_until__isnull=True) | Q(claimed_until__lte=timestamp)
+
+
+def claim_next(stage, employee, lease=None):
+    """
+    Lease the next case of the stage queue to ``employee`` and return it, or
+    None if every case is taken. An employee who already holds a case of this
+    stage gets the same case back with a renewed lease.
+    """
+    timestamp = now()
+    until = timestamp + (lease or get_config().WORK_QUEUE_LEASE)
+    queue = stage_queue(stage)
+    using = queue.select_for_update().db
+    with transaction.atomic(using=using):
+        held = (
+            queue.filter(claimed_by=employee, claimed_until__gt=timestamp)
+            .select_for_update(skip_locked=True)
+            .first()
+        )
+        if held is not None:
+            renewed = _lease(held, employee, until, Q(claimed_by=employee))
+            if renewed is not None:
+                return renewed
+
+        for _ in range(CLAIM_ATTEMPTS):
+            case = (
+                queue.filter(_unleased(timestamp))
+                .select_for_update(skip_locked=True)
+                .first()
+            )
+            if case is None:
+                return None
+            leased = _lease(case, employee, until, _unleased(timestamp))
+            if leased is not None:
+                return leased
+    return None
+
+
+def _lease(case, employee, until, condition):
+    updated = (
+        Case.objects.using(case._state.db)
+        .filter(condition, pk=case.pk, version=case.version)
+        .update(claimed_by=employee, claimed_until=until, version=F("version") + 1)
+    )
+    if not updated:
+        # Кейс успели взять или изменить между выборкой и обновлением
+        return None
+    case.claimed_by = employee
+    case.claimed_until = until
+    case.version += 1
+    return case
+
+
+def release(case, employee):
+    """
+    Give a leased case back to the queue. Returns False if ``employee`` does
+    not hold it.
+    """
+    return bool(
+        Case.objects.using(case._state.db)
+        .filter(pk=case.pk, claimed_by=employee)
+        .update(claimed_by=None, claimed_until=None, version=F("version") + 1)
+    )
@@ -6,6 +6,9 @@ import sys
 
 def main():
     """Run administrative tasks."""
+    # The test command runs with the test databases (replica mirror, lab database)
+    if sys.argv[1:2] == ["test"]:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "case_tracking.test_settings")
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "case_tracking.settings")
     try:
         from django.core.management import execute_from_command_line